@@ -0,0 +1,39 @@
+#!/usr/bin/python3
+"""How fast is each JSON codec at the work we actually do?
+
+   Decodes every event from a recorded stream (or a made-up one), and
+   encodes attribute-sized payloads, with each codec that's installed.
+"""
+
+import argparse
+
+from common import mbta2mqtt, sample_stream, sample_resources, rate
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--file', help="a recorded stream (see record.py) instead of a made-up one")
+    parser.add_argument('--count', type=int, default=2000, help="resources in the made-up stream")
+    args = parser.parse_args()
+
+    if args.file:
+        with open(args.file, 'rb') as f:
+            stream = f.read()
+    else:
+        stream = sample_stream(args.count)
+    events = [data for (event, data, last_id) in mbta2mqtt.SSEParser().feed(stream)]
+    payloads = [resource['attributes'] for resource in sample_resources(args.count)]
+    print(f"{len(events):,} events ({len(stream):,} bytes), {len(payloads):,} payloads to encode")
+
+    for codec in ('json', 'msgspec', 'orjson'):
+        if mbta2mqtt.use_json_codec(codec) != codec:
+            print(f"{codec}: not installed")
+            continue
+        loads = mbta2mqtt.json_loads
+        dumps = mbta2mqtt.json_dumps
+        rate(f"{codec} decode (events)", len(events), lambda: [loads(data) for data in events])
+        rate(f"{codec} encode (payloads)", len(payloads), lambda: [dumps(payload) for payload in payloads])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Shared bits for the benchmarks: loading the default config without
+   any of `load_config()`'s side effects, and making up MBTA resources.
+"""
+
+import os, sys
+import random
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+# The defaults want this, but nothing here talks to the MBTA.
+os.environ.setdefault('MBTA_API_KEY', '0' * 32)
+
+import yaml
+from yaml_env_tag import construct_env_tag
+
+import mbta2mqtt
+mbta2mqtt.deferred_imports()
+
+
+def load_defaults(stops=("110", "2168", "22549")):
+    """The shipped `defaults.conf`, plus a list of stops."""
+
+    yaml.Loader.add_constructor('!ENV', construct_env_tag)
+    with open(os.path.join(os.path.dirname(here), "defaults.conf")) as cf:
+        config = yaml.load(cf, Loader=yaml.Loader)
+    config['mbta']['stops'] = list(stops)
+    return config
+
+
+def sample_resources(count, stops=("110", "2168", "22549"), seed=0):
+    """A mix of stops, routes, trips, vehicles and predictions, roughly
+       in the proportions a `/predictions` reset has them.
+    """
+
+    rng = random.Random(seed)
+    resources = []
+    for stop in stops:
+        resources.append({'type': 'stop', 'id': stop,
+                          'attributes': {'name': f"Stop {stop}", 'location_type': 0},
+                          'relationships': {'parent_station': {'data': None}}})
+    i = 0
+    while len(resources) < count:
+        stop = rng.choice(stops)
+        route = str(rng.choice((1, 47, 77, 87, 96)))
+        resources.append({'type': 'route', 'id': route,
+                          'attributes': {'long_name': f"Route {route}", 'type': 3},
+                          'relationships': {'line': {'data': {'id': f"line-{route}", 'type': 'line'}}}})
+        resources.append({'type': 'trip', 'id': f"trip-{i}",
+                          'attributes': {'headsign': "Harvard", 'direction_id': i % 2},
+                          'relationships': {'route': {'data': {'id': route, 'type': 'route'}},
+                                            'stops': {'data': [{'id': str(s), 'type': 'stop'} for s in range(30)]}}})
+        resources.append({'type': 'vehicle', 'id': f"y{1000 + i}",
+                          'attributes': {'current_status': 'IN_TRANSIT_TO', 'current_stop_sequence': 3},
+                          'relationships': {'trip': {'data': {'id': f"trip-{i}", 'type': 'trip'}}}})
+        resources.append({'type': 'prediction', 'id': f"prediction-{i}-{stop}",
+                          'attributes': {'departure_time': "2099-10-17T10:00:00-04:00",
+                                         'arrival_time': None, 'direction_id': i % 2, 'stop_sequence': 7},
+                          'relationships': {'route': {'data': {'id': route, 'type': 'route'}},
+                                            'stop': {'data': {'id': stop, 'type': 'stop'}},
+                                            'trip': {'data': {'id': f"trip-{i}", 'type': 'trip'}},
+                                            'vehicle': {'data': {'id': f"y{1000 + i}", 'type': 'vehicle'}}}})
+        i += 1
+    return resources[:count]
+
+
+def rate(label, count, function, repeat=3):
+    """Runs `function` a few times and prints the best rate."""
+
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"{label:<40} {count / best:>12,.0f} /s")
+    return count / best
+
+
+def sample_stream(count, updates_per_resource=4, keepalive_every=50, seed=0):
+    """Server-sent event bytes, like the MBTA streaming API sends: a
+       reset with `count` resources, and then a lot of updates to them,
+       with keep-alives sprinkled in.
+    """
+
+    import json
+    rng = random.Random(seed)
+    resources = sample_resources(count, seed=seed)
+    out = [b"event: reset\ndata: ", json.dumps(resources).encode(), b"\n\n"]
+    for i in range(count * updates_per_resource):
+        if i % keepalive_every == 0:
+            out.append(b": keep-alive\n")
+        out += [b"event: update\ndata: ", json.dumps(rng.choice(resources)).encode(), b"\n\n"]
+    return b"".join(out)
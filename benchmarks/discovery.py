@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+"""How many Home Assistant discovery payloads can we build per second?
+
+   "before" is the old approach of copying the `entity` defaults and
+   running `mergedeep.merge()` with the per-type and `individual`
+   config for every resource; "after" is `discovery_payload()` with
+   templates from `compile_templates()`.
+
+   Then, how fast retained discovery messages (like the ones the broker
+   sends when we subscribe at startup) go into the entity registry.
+"""
+
+import argparse
+import re
+
+from mergedeep import merge, Strategy
+
+from common import mbta2mqtt, load_defaults, sample_resources, rate
+
+
+def merged_every_time(config, resource):
+    ha = config['homeassistant']
+    payload = ha['entity'].copy()
+    if resource['type'] in ha and type(ha[resource['type']]) == dict:
+        merge(payload, ha[resource['type']], strategy=Strategy.ADDITIVE)
+    try:
+        merge(payload, ha['individual'][resource['type']][resource['id']], strategy=Strategy.ADDITIVE)
+    except KeyError:
+        pass
+    return payload
+
+
+class Message:
+    """Enough of paho's `MQTTMessage`."""
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+        self.retain = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=20000, help="resources per run")
+    parser.add_argument('--retained', type=int, default=50000, help="retained discovery messages per run")
+    args = parser.parse_args()
+
+    config = load_defaults()
+    resources = sample_resources(args.count)
+    mbta2mqtt.compile_templates(config)
+
+    def before():
+        for resource in resources:
+            merged_every_time(config, resource)
+            mbta2mqtt.discovery_payload(config, resource)
+
+    def after():
+        for resource in resources:
+            mbta2mqtt.discovery_payload(config, resource)
+
+    # "before" pays for the merge on top of the data-derived part,
+    # which is the same in both.
+    slow = rate("before (merge per resource)", args.count, before)
+    fast = rate("after (precompiled templates)", args.count, after)
+    print(f"{'speedup':<40} {fast / slow:>12.2f}x")
+
+    mbta2mqtt.quiet_logging()
+    mbta2mqtt.discovery_topic = mbta2mqtt.discovery_matcher(config)
+    prefix = f"{config['homeassistant']['discovery_prefix']}/sensor/{config['homeassistant']['node_id']}"
+    messages = [Message(f"{prefix}/mbta_prediction_{i}/config", b'{"name": "77"}') for i in range(args.retained)]
+
+    def matched_every_time():
+        # What this used to do: build the pattern for every message.
+        for message in messages:
+            re.match(f"^{config['homeassistant']['discovery_prefix']}/[a-z0-9_-]+/[A-Za-z0-9_/-]+/config$", message.topic)
+            mbta2mqtt.entities.found(message.topic, mbta2mqtt.PayloadCache.digest(message.payload))
+
+    def ingested():
+        for message in messages:
+            mbta2mqtt.mqtt_discovery_message(None, config, message)
+
+    rate("retained, pattern per message", args.retained, matched_every_time)
+    rate("retained, mqtt_discovery_message()", args.retained, ingested)
+    print(f"{'registry size':<40} {len(mbta2mqtt.entities.known()):>12,}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/python3
+"""Makes up an MBTA-like event stream, for any number of stops.
+
+   Starts with a reset (stops, routes, trips, vehicles, and a bunch of
+   predictions for each stop), and then `--rate` events per second
+   for `--seconds`: mostly updates to predictions and vehicles, with
+   predictions (and their trips) coming and going as buses do.
+   Writes it out in server-sent event format, for `replay.py --file`.
+"""
+
+import argparse
+import json
+import random
+
+from common import sample_resources
+
+
+def synthetic_stream(stops=10, rate=50, seconds=60, predictions=8, seed=0):
+    """Server-sent event bytes: a reset, then `rate` × `seconds` events."""
+
+    rng = random.Random(seed)
+    stop_ids = tuple(str(1000 + i) for i in range(stops))
+    # sample_resources() makes four resources per prediction, plus the stops.
+    resources = sample_resources(stops + stops * predictions * 4, stops=stop_ids, seed=seed)
+    live = {r['id']: r for r in resources if r['type'] == 'prediction'}
+    vehicles = [r for r in resources if r['type'] == 'vehicle']
+    serial = len(resources)
+
+    out = [b"event: reset\ndata: ", json.dumps(resources).encode(), b"\n\n"]
+    def event(name, resource):
+        out.extend((b"event: ", name.encode(), b"\ndata: ", json.dumps(resource).encode(), b"\n\n"))
+
+    for i in range(int(rate * seconds)):
+        if i % (rate * 5 or 1) == 0:
+            out.append(b": keep-alive\n")
+        roll = rng.random()
+        if roll < 0.05 and live:
+            gone = live.pop(rng.choice(list(live)))
+            event('remove', {'type': 'prediction', 'id': gone['id']})
+        elif roll < 0.10:
+            serial += 1
+            (trip, prediction) = [r for r in sample_resources(len(stop_ids) + 4, stops=stop_ids, seed=serial)
+                                  if r['type'] in ('trip', 'prediction')][:2]
+            trip['id'] = prediction['relationships']['trip']['data']['id'] = f"trip-{serial}"
+            prediction['id'] = f"prediction-{serial}"
+            event('add', trip)
+            event('add', prediction)
+            live[prediction['id']] = prediction
+        elif roll < 0.30:
+            vehicle = rng.choice(vehicles)
+            vehicle['attributes']['current_stop_sequence'] = rng.randint(1, 30)
+            event('update', vehicle)
+        elif live:
+            prediction = live[rng.choice(list(live))]
+            prediction['attributes']['departure_time'] = f"2099-10-17T10:{rng.randint(0, 59):02d}:00-04:00"
+            event('update', prediction)
+    return b"".join(out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('output', help="file to write the stream to")
+    parser.add_argument('--stops', type=int, default=10, help="how many stops")
+    parser.add_argument('--rate', type=int, default=50, help="events per second after the reset")
+    parser.add_argument('--seconds', type=float, default=60, help="how many seconds of events")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    stream = synthetic_stream(args.stops, args.rate, args.seconds, seed=args.seed)
+    with open(args.output, 'wb') as f:
+        f.write(stream)
+    print(f"{len(stream):,} bytes to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+#!/usr/bin/python3
+"""Records the raw server-sent event stream from the MBTA to a file.
+
+   The file is exactly the bytes the API sent (keep-alives and all),
+   so `sse.py`, `codec.py`, and `replay.py` can use it with `--file`.
+   This one does need a network connection, and `MBTA_API_KEY`.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import requests
+
+from common import mbta2mqtt, load_defaults
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('output', help="file to write the stream to")
+    parser.add_argument('--stops', default="110,2168,22549", help="comma-separated stop IDs")
+    parser.add_argument('--seconds', type=float, default=300, help="how long to record")
+    args = parser.parse_args()
+
+    if not os.environ.get('MBTA_API_KEY') or set(os.environ['MBTA_API_KEY']) == {'0'}:
+        sys.exit("Set MBTA_API_KEY to record a stream.")
+
+    config = load_defaults(args.stops.split(','))
+    stream = mbta2mqtt.mbta_streams(config)['predictions']
+    headers = {"X-API-Key": config['mbta']['api_key'], "Accept": "text/event-stream"}
+
+    count = 0
+    start = time.monotonic()
+    with open(args.output, 'wb') as f:
+        with requests.get(stream['url'], headers=headers, stream=True, timeout=(30.05, 60)) as result:
+            result.raise_for_status()
+            for data in result.iter_content(chunk_size=None):
+                f.write(data)
+                count += len(data)
+                if time.monotonic() - start > args.seconds:
+                    break
+    print(f"{count:,} bytes in {time.monotonic() - start:.0f}s to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
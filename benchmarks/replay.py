@@ -0,0 +1,201 @@
+#!/usr/bin/python3
+"""Runs a whole event stream through the real bridge, start to finish.
+
+   Parses, decodes, and handles every event in a recorded (`record.py`)
+   or generated (`generate.py`) stream with `handle_event()` — so
+   `add_entity()`, `update_entity()`, `remove_entity()` and resets,
+   with the payload cache and publish window — into a broker stand-in
+   that lives in this process. (Or, with `--broker`, a real MQTT broker
+   on this machine.) Then it reports events per second, the latency
+   from each event "arriving" to the broker acknowledging it, and
+   memory use.
+"""
+
+import argparse
+import collections
+import resource
+import threading
+import time
+import tracemalloc
+
+from common import mbta2mqtt, load_defaults
+from generate import synthetic_stream
+
+
+class Message:
+    """Enough of paho's `MQTTMessageInfo` for `publish()`."""
+
+    __slots__ = ('mid', 'done')
+
+    def __init__(self, mid):
+        self.mid = mid
+        self.done = threading.Event()
+
+    def is_published(self):
+        return self.done.is_set()
+
+    def wait_for_publish(self, timeout=None):
+        self.done.wait(timeout)
+
+
+class Broker:
+    """Stands in for the paho client and a broker: keeps retained
+       messages, and acknowledges each one from another thread (like
+       paho's network loop) after `delay` seconds.
+    """
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.retained = {}
+        self.mid = 0
+        self.messages = 0
+        self.pending = collections.deque()
+        self.waiting = threading.Condition()
+        threading.Thread(target=self.acknowledge, daemon=True).start()
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        self.mid += 1
+        self.messages += 1
+        message = Message(self.mid)
+        if retain:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+        if qos == 0:
+            message.done.set()
+        else:
+            with self.waiting:
+                self.pending.append((time.monotonic() + self.delay, message))
+                self.waiting.notify()
+        return message
+
+    def acknowledge(self):
+        while True:
+            with self.waiting:
+                self.waiting.wait_for(lambda: self.pending)
+                (due, message) = self.pending.popleft()
+            wait = due - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            message.done.set()
+            mbta2mqtt.mqtt_publish(self, None, message.mid)
+
+
+def local_broker(address):
+    import paho.mqtt.client as mqtt
+
+    (host, port) = (address.split(':') + ['1883'])[:2]
+    client = mqtt.Client(client_id="mbta2mqtt-replay")
+    client.on_publish = mbta2mqtt.mqtt_publish
+    client.connect(host, int(port))
+    client.loop_start()
+    return client
+
+
+def percentile(histogram, fraction):
+    """The bucket bound under which `fraction` of observations fall."""
+    wanted = histogram.count * fraction
+    for (bound, count) in histogram.cumulative():
+        if count >= wanted:
+            return bound
+    return float('inf')
+
+
+def replay(config, client, stream, size, pace, whole=False):
+    """Feeds `stream` through in `size` byte pieces, as fast as it can
+       (or, with `pace`, that many events per second), and returns how
+       many events it handled. Resets come a resource at a time, like in
+       `mbta_events()` (unless `whole`).
+    """
+
+    parser = mbta2mqtt.SSEParser(split=() if whole else ('reset',))
+    count = 0
+    start = time.monotonic()
+    for i in range(0, len(stream), size):
+        received = time.monotonic()
+        for (event, data, last_id) in parser.feed(stream[i:i+size]):
+            if pace:
+                ahead = start + count / pace - time.monotonic()
+                if ahead > 0:
+                    time.sleep(ahead)
+                received = time.monotonic()
+            decoded = mbta2mqtt.decode_event(event, data)
+            if decoded:
+                mbta2mqtt.handle_event(config, client, 'predictions', *decoded, received)
+                # (A reset a resource at a time is still one event.)
+                if event.partition(':')[2] in ('', 'begin'):
+                    count += 1
+    # Updates held back to be coalesced haven't been sent yet.
+    while mbta2mqtt.held.pending:
+        time.sleep(0.01)
+    mbta2mqtt.publish_wait()
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--file', help="a recorded or generated stream instead of making one up")
+    parser.add_argument('--stops', type=int, default=10, help="stops in the made-up stream")
+    parser.add_argument('--rate', type=int, default=200, help="events per second in the made-up stream")
+    parser.add_argument('--seconds', type=float, default=30, help="seconds of events in the made-up stream")
+    parser.add_argument('--pace', type=int, default=0, help="replay at this many events per second (default: flat out)")
+    parser.add_argument('--size', type=int, default=16384, help="bytes per read")
+    parser.add_argument('--delay', type=float, default=0.0, help="stand-in broker's acknowledgement delay, in seconds")
+    parser.add_argument('--broker', help="host[:port] of a local MQTT broker to use instead of the stand-in")
+    parser.add_argument('--memory', action='store_true', help="also trace Python allocations (slower)")
+    parser.add_argument('--whole', action='store_true', help="decode resets all at once, the old way")
+    parser.add_argument('--coalesce', type=float, default=0,
+                        help="hold prediction and vehicle updates back this many seconds (which mostly measures the window)")
+    args = parser.parse_args()
+
+    if args.file:
+        with open(args.file, 'rb') as f:
+            stream = f.read()
+    else:
+        stream = synthetic_stream(args.stops, args.rate, args.seconds)
+
+    config = load_defaults([str(1000 + i) for i in range(args.stops)])
+    mbta2mqtt.quiet_logging()
+    mbta2mqtt.mbta_streams(config)
+    for section in config['homeassistant'].values():
+        if type(section) == dict:
+            section.pop('coalesce', None)
+    if args.coalesce:
+        for kind in ('prediction', 'vehicle'):
+            config['homeassistant'][kind]['coalesce'] = args.coalesce
+    mbta2mqtt.compile_templates(config)
+    mbta2mqtt.use_json_codec(config['engine']['json_codec'])
+    mbta2mqtt.published = mbta2mqtt.PayloadCache(config['mqtt']['dedup_cache_size'])
+    # Much finer than the real buckets, so the percentiles mean something:
+    # 50µs up to 30s, about 10% apart.
+    bounds = [0.00005]
+    while bounds[-1] < 30:
+        bounds.append(round(bounds[-1] * 1.1, 6))
+    mbta2mqtt.metrics.latency = mbta2mqtt.Histogram(tuple(bounds))
+
+    client = local_broker(args.broker) if args.broker else Broker(args.delay)
+    mbta2mqtt.broker.set()
+
+    if args.memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    count = replay(config, client, stream, args.size, args.pace, args.whole)
+    elapsed = time.perf_counter() - start
+    if args.memory:
+        (current, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    latency = mbta2mqtt.metrics.latency
+    print(f"{len(stream):,} bytes, {count:,} events, {mbta2mqtt.metrics.as_dict().get('publishes', 0):,} publishes")
+    print(f"{'throughput':<40} {count / elapsed:>12,.0f} events/s")
+    for (label, fraction) in (('p50', 0.5), ('p99', 0.99), ('p99.9', 0.999)):
+        print(f"{label + ' latency (event to ack)':<40} {percentile(latency, fraction) * 1000:>12.2f} ms")
+    print(f"{'payload cache':<40} {mbta2mqtt.published.stats()}")
+    if args.memory:
+        print(f"{'peak traced memory':<40} {peak / 1048576:>12.1f} MiB")
+    print(f"{'max resident set size':<40} {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:>12.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+"""How many server-sent events per second can we parse and decode?
+
+   Replays a recorded stream (or makes one up) in network-sized
+   pieces. "before" is the old `iter_lines(delimiter=b'\n\n')` and
+   regular expression approach; "after" is `SSEParser`. Both are
+   timed with and without `json.loads()` of the data.
+"""
+
+import argparse
+import json
+import re
+
+from common import mbta2mqtt, sample_stream, rate
+
+
+def split_and_match(stream, size, decode=True):
+    eventsplit = re.compile('^(?:: keep-alive\n)*event: (.*)\ndata: (.*)')
+    pending = b''
+    count = 0
+    for i in range(0, len(stream), size):
+        (*chunks, pending) = (pending + stream[i:i+size]).split(b'\n\n')
+        for chunk in chunks:
+            if chunk == b'':
+                continue
+            match = eventsplit.match(chunk.decode('UTF-8'))
+            if match:
+                (event, data) = match.groups()
+                if decode:
+                    json.loads(data)
+                count += 1
+    return count
+
+
+def parse(stream, size, decode=True):
+    parser = mbta2mqtt.SSEParser()
+    count = 0
+    for i in range(0, len(stream), size):
+        for (event, data, last_id) in parser.feed(stream[i:i+size]):
+            if decode:
+                json.loads(data)
+            count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--file', help="a recorded stream (see record.py) instead of a made-up one")
+    parser.add_argument('--count', type=int, default=2000, help="resources in the made-up stream")
+    parser.add_argument('--size', type=int, default=16384, help="bytes per read")
+    args = parser.parse_args()
+
+    if args.file:
+        with open(args.file, 'rb') as f:
+            stream = f.read()
+    else:
+        stream = sample_stream(args.count)
+
+    events = parse(stream, args.size)
+    print(f"{len(stream):,} bytes, {events:,} events")
+    for decode in (False, True):
+        print("parsing and JSON decoding:" if decode else "just parsing:")
+        slow = rate("  before (split + regex)", events, lambda: split_and_match(stream, args.size, decode))
+        fast = rate("  after (SSEParser)", events, lambda: parse(stream, args.size, decode))
+        print(f"{'  speedup':<40} {fast / slow:>12.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/python3
+"""How long does mbta2mqtt take to start up?
+
+   Times `mbta2mqtt.py --check-config` (which loads and checks the
+   config, and then exits before connecting to anything) in a fresh
+   interpreter each time: with the parsed-config cache turned off,
+   and with it warm. Also times just importing what used to be
+   imported up front, for comparison.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import here
+
+script = os.path.join(os.path.dirname(here), "mbta2mqtt.py")
+
+
+def run(command, environment, count):
+    best = None
+    for _ in range(count):
+        start = time.perf_counter()
+        result = subprocess.run(command, env=environment, capture_output=True, text=True)
+        elapsed = time.perf_counter() - start
+        if result.returncode != 0:
+            sys.exit(f"{' '.join(command)} failed:\n{result.stdout}{result.stderr}")
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=10, help="runs of each (the best is reported)")
+    args = parser.parse_args()
+
+    environment = dict(os.environ)
+    # (Not all digits, or YAML makes it a number.)
+    environment['MBTA_API_KEY'] = '0123456789abcdef' * 2
+    check = [sys.executable, script, '--check-config', '110']
+
+    with tempfile.TemporaryDirectory() as cache:
+        environment['MBTA2MQTT_CONFIG_CACHE'] = ''
+        cold = run(check, environment, args.count)
+        environment['MBTA2MQTT_CONFIG_CACHE'] = os.path.join(cache, 'config.json')
+        run(check, environment, 1)
+        warm = run(check, environment, args.count)
+    imports = run([sys.executable, '-c', 'import requests, yaml, paho.mqtt.client'], environment, args.count)
+
+    print(f"{'--check-config, no config cache':<40} {cold * 1000:>10.0f} ms")
+    print(f"{'--check-config, cached config':<40} {warm * 1000:>10.0f} ms")
+    print(f"{'(importing requests, yaml and paho)':<40} {imports * 1000:>10.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,25 +4,1745 @@ import os,sys
 import re
 import logging, logging.config
 import json
-import requests
-import queue
-import yaml
-from yaml_env_tag import construct_env_tag
-import paho.mqtt.client as mqtt
 import threading
+import time
+import collections
+import hashlib
+import copy
+import random
+import socket
+import bisect
+import heapq
+import datetime
+import sqlite3
+import argparse
+import queue
+import contextlib
+import signal
+import math
 from mergedeep import merge,Strategy
 
+# These take a while to import, and checking the config doesn't need
+# them, so they're imported by `deferred_imports()` once it has passed.
+# (yaml is only needed if the cached config is out of date.)
+requests = None
+mqtt = None
+asyncio = None
+concurrent = None
+http = None
+PacketTypes = None
+
 VERSION='0.1.0'
 
-# Keep track of messages for creating Home Assistant entities via MQTT discovery.
-# Since these are retained by the broker, we should get the list of any already
-# existing ones when start... and we can clean those up when we get a 'reset' from
-# the MBTA streaming API (which happens on initial connection). This should keep us
-# from having lingering zombie entities in Home Asisstant.
-entities = queue.SimpleQueue()
+# Whether TRACE (5) and DEBUG messages actually go anywhere. Checked before
+# logging on busy paths, so we don't format strings nobody will ever see.
+# See `quiet_logging()`.
+tracing = True
+debugging = True
+verbose = True
+
+class Entity:
+    """What we know about one Home Assistant discovery topic."""
+
+    __slots__ = ('digest', 'key', 'owners', 'holder')
+
+    def __init__(self,digest,key=None):
+        self.digest = digest    # hash of the payload
+        self.key = key          # (type, id), if we sent it
+        self.owners = set()     # names of the streams it came from
+        self.holder = None      # its availability topic — which instance sent it
+
+
+class EntityRegistry:
+    """Keeps track of messages for creating Home Assistant entities via MQTT
+       discovery: which topics exist, a hash of what's in each, and which of
+       our MBTA streams it came from.
+
+       Since these are retained by the broker, we should get the list of any
+       already existing ones when we start... and we can reconcile those when
+       we get a 'reset' from the MBTA streaming API (which happens on initial
+       connection). This should keep us from having lingering zombie entities
+       in Home Asisstant, without clearing and re-creating the ones that are
+       still perfectly fine.
+
+       Several streams can mention the same resource (a vehicle, say), so an
+       entity only goes away when none of them want it any more. Ones we found
+       on the broker have no owners until some stream claims them.
+
+       Retained messages arrive on paho's thread, and each stream may have its
+       own thread, hence the lock.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.topics = {}    # discovery topic -> Entity
+        self.keys = {}      # (type, id) -> discovery topic
+
+    def found(self,topic,digest,holder=None):
+        """A discovery message from the broker (or, with sharding, from
+           another instance). We don't know what resource it was for."""
+        with self.lock:
+            if topic not in self.topics:
+                self.topics[topic] = Entity(digest)
+            self.topics[topic].digest = digest
+            self.topics[topic].holder = holder
+
+    def unchanged(self,topic,digest):
+        with self.lock:
+            return topic in self.topics and self.topics[topic].digest == digest
+
+    def published(self,key,topic,digest,owner,holder=None):
+        with self.lock:
+            if topic not in self.topics:
+                self.topics[topic] = Entity(digest,key)
+            entity = self.topics[topic]
+            entity.digest = digest
+            entity.key = key
+            entity.owners.add(owner)
+            entity.holder = holder
+            self.keys[key] = topic
+
+    def interested(self,key,topic,owner):
+        """We'd publish this, but another instance already has. (See `Shards`.)"""
+        with self.lock:
+            entity = self.topics.get(topic)
+            if entity:
+                entity.key = key
+                entity.owners.add(owner)
+                self.keys[key] = topic
+
+    def holder_of(self,topic):
+        with self.lock:
+            entity = self.topics.get(topic)
+            return entity.holder if entity else None
+
+    def wanted(self,where):
+        """(topic, key, owner) for entities we want, which are either held
+           by `where` (an availability topic) or are topic `where`."""
+        with self.lock:
+            return [(topic, entity.key, next(iter(entity.owners))) for (topic, entity) in self.topics.items()
+                    if (topic == where or entity.holder == where) and entity.key and entity.owners]
+
+    def disown(self,topic,owner):
+        """`owner` doesn't want this any more. True if nobody else does, either."""
+        with self.lock:
+            if topic not in self.topics:
+                return False
+            self.topics[topic].owners.discard(owner)
+            return not self.topics[topic].owners
+
+    def cleared(self,topic):
+        with self.lock:
+            entity = self.topics.pop(topic,None)
+            if entity and entity.key and self.keys.get(entity.key) == topic:
+                del self.keys[entity.key]
+
+    def topic_for(self,key):
+        with self.lock:
+            return self.keys.get(key)
+
+    def key_of(self,topic):
+        """The (type, id) we sent this topic for, if it's still the topic for it."""
+        with self.lock:
+            entity = self.topics.get(topic)
+            if entity and entity.key and self.keys.get(entity.key) == topic:
+                return entity.key
+            return None
+
+    def has(self,topic):
+        with self.lock:
+            return topic in self.topics
+
+    def known(self):
+        with self.lock:
+            return set(self.topics)
+
+    def owned_by(self,owner):
+        with self.lock:
+            return {topic for (topic, entity) in self.topics.items() if owner in entity.owners}
+
+    def orphans(self):
+        with self.lock:
+            return {topic for (topic, entity) in self.topics.items() if not entity.owners}
+
+
+def status_topic(config):
+    """Our availability topic. With sharding, each instance has its own."""
+    if config['sharding']['instance']:
+        return f"{config['mqtt']['prefix']}/instances/{config['sharding']['instance']}"
+    return f"{config['mqtt']['prefix']}/status"
+
+entities = EntityRegistry()
+
+# Streams which have sent us a reset. Once they all have, any
+# discovery topics nobody has claimed are zombies.
+reset_streams = set()
+
+
+class Record:
+    """The latest version of one MBTA resource."""
+
+    __slots__ = ('key', 'resource', 'attributes', 'related', 'owners')
+
+    def __init__(self,key,resource,related):
+        self.key = key                  # (type, id)
+        self.resource = resource        # straight from the API
+        self.attributes = resource.get('attributes') or {}
+        self.related = related          # relationship name -> tuple of (type, id)
+        self.owners = set()             # names of the streams it came from
+
+    def __repr__(self):
+        return f"Record{self.key}"
+
+
+class ResourceStore:
+    """Every resource our streams have told us about (and haven't taken
+       back), by (type, id), so things like a prediction's trip, or a
+       stop's predictions, are a lookup instead of a search. `related`
+       follows a resource's own `relationships`; `referring` goes the
+       other way, using an index kept up to date as things change.
+
+       Like `entities`, a resource can come from several streams, and
+       only goes away when none of them has it any more.
+
+       Anything that wants to know about changes can `listen()`. Each
+       call gets a list of (key, old record, new record) for just what
+       changed — old is None for something new, and new is None for
+       something gone. Listeners are called outside the lock, on
+       whatever thread made the change. (For a reset, that's once, at
+       the end of it.)
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records = {}       # (type, id) -> Record
+        self.referrers = collections.defaultdict(set)   # (type, id) -> keys of records relating to it
+        self.listeners = []
+        self.resetting = {}     # stream -> (keys it's sent, changes) so far in a reset
+
+    @staticmethod
+    def relationships(resource):
+        related = {}
+        for (name, relationship) in (resource.get('relationships') or {}).items():
+            data = relationship.get('data') if type(relationship) == dict else None
+            if type(data) == dict:
+                related[name] = ((data['type'], data['id']),)
+            elif type(data) == list:
+                related[name] = tuple((item['type'], item['id']) for item in data)
+        return related
+
+    def listen(self,listener):
+        self.listeners.append(listener)
+
+    def notify(self,changes):
+        if changes:
+            for listener in self.listeners:
+                listener(changes)
+
+    def _index(self,record,add):
+        for keys in record.related.values():
+            for key in keys:
+                if add:
+                    self.referrers[key].add(record.key)
+                else:
+                    referrers = self.referrers.get(key)
+                    if referrers:
+                        referrers.discard(record.key)
+                        if not referrers:
+                            del self.referrers[key]
+
+    def _put(self,resource,stream,changes):
+        key = (resource['type'], resource['id'])
+        old = self.records.get(key)
+        record = Record(key,resource,self.relationships(resource))
+        if old:
+            record.owners = old.owners
+            if old.related != record.related:
+                self._index(old,False)
+                self._index(record,True)
+        else:
+            self._index(record,True)
+        record.owners.add(stream)
+        self.records[key] = record
+        changes.append((key, old, record))
+
+    def _drop(self,key,stream,changes):
+        old = self.records.get(key)
+        if not old:
+            return
+        old.owners.discard(stream)
+        if not old.owners:
+            del self.records[key]
+            self._index(old,False)
+            changes.append((key, old, None))
+
+    def put(self,resource,stream):
+        """From an 'add' or 'update'."""
+        changes = []
+        with self.lock:
+            self._put(resource,stream,changes)
+        self.notify(changes)
+
+    def remove(self,resource,stream):
+        """From a 'remove' (which only has type and id)."""
+        changes = []
+        with self.lock:
+            self._drop((resource['type'], resource['id']),stream,changes)
+        self.notify(changes)
+
+    def forget(self,key):
+        """Drops a record, whichever streams it came from. (See `Evictions`.)"""
+        changes = []
+        with self.lock:
+            old = self.records.get(key)
+            if old:
+                for stream in list(old.owners):
+                    self._drop(key,stream,changes)
+        self.notify(changes)
+
+    def reset_begin(self,stream):
+        """Everything `stream` has, replacing whatever it had before — a
+           resource at a time, from `reset_item()`, as they arrive. (See
+           `StreamReset`.)"""
+        with self.lock:
+            self.resetting[stream] = (set(), [])
+
+    def reset_item(self,resource,stream):
+        with self.lock:
+            (keep, changes) = self.resetting[stream]
+            self._put(resource,stream,changes)
+            keep.add((resource['type'], resource['id']))
+
+    def reset_end(self,stream,complete=True):
+        """Drops whatever `stream` had which it didn't send again (unless
+           the reset was cut short), and lets the listeners know."""
+        with self.lock:
+            (keep, changes) = self.resetting.pop(stream)
+            if complete:
+                for (key, record) in list(self.records.items()):
+                    if stream in record.owners and key not in keep:
+                        self._drop(key,stream,changes)
+        self.notify(changes)
+
+    def get(self,kind,id):
+        return self.records.get((kind, id))
+
+    def related(self,record,name):
+        """The records `record` points at with relationship `name`."""
+        with self.lock:
+            return [self.records[key] for key in record.related.get(name,()) if key in self.records]
+
+    def referring(self,key,kind=None):
+        """The records (optionally, only of type `kind`) which point at `key`."""
+        with self.lock:
+            return [self.records[referrer] for referrer in self.referrers.get(key,())
+                    if (kind is None or referrer[0] == kind) and referrer in self.records]
+
+store = ResourceStore()
+
+
+class DepartureBoards:
+    """The next few departures from each stop we're watching, in each
+       direction — what docs/NOTES.md is after — published as one
+       retained JSON message per stop, to `<prefix>/departures/<stop>`.
+
+       It listens to `store`, so only predictions which changed (or whose
+       trip, vehicle, or route changed) are looked at, and a stop's message
+       is only sent when what it shows actually changes.
+    """
+
+    def __init__(self,config,client):
+        self.config = config
+        self.client = client
+        self.count = config['departures']['count']
+        self.watched = set(config['mbta']['stops'])
+        self.lock = threading.Lock()
+        self.boards = collections.defaultdict(dict)   # (stop, direction) -> prediction key -> departure
+        self.placed = {}                                # prediction key -> (stop, direction)
+        self.shown = {}                                 # stop -> payload we last sent
+
+    def board_stop(self,prediction):
+        """Which watched stop a prediction is for: its own stop, or that
+           stop's parent station (since predictions are for platforms)."""
+        for stop in prediction.related.get('stop',()):
+            if stop[1] in self.watched:
+                return stop[1]
+            record = store.get(*stop)
+            if record:
+                for parent in record.related.get('parent_station',()):
+                    if parent[1] in self.watched:
+                        return parent[1]
+        return None
+
+    def place(self,key,prediction):
+        """Moves a prediction to the board it belongs on now (if any),
+           and returns the stops whose boards that touched."""
+        touched = set()
+        if key in self.placed:
+            where = self.placed.pop(key)
+            del self.boards[where][key]
+            touched.add(where[0])
+        if prediction:
+            when = prediction.attributes.get('departure_time') or prediction.attributes.get('arrival_time')
+            stop = self.board_stop(prediction)
+            if when and stop:
+                where = (stop, prediction.attributes.get('direction_id'))
+                self.boards[where][key] = datetime.datetime.fromisoformat(when)
+                self.placed[key] = where
+                touched.add(stop)
+        return touched
+
+    def changed(self,changes):
+        touched = set()
+        with self.lock:
+            for (key, old, new) in changes:
+                match key[0]:
+                    case 'prediction':
+                        touched |= self.place(key,new)
+                    case 'trip' | 'vehicle' | 'route':
+                        for prediction in store.referring(key,'prediction'):
+                            if prediction.key in self.placed:
+                                touched.add(self.placed[prediction.key][0])
+            payloads = {}
+            for stop in touched:
+                # Another instance does this stop's board now.
+                if shards and not shards.has_stop(stop):
+                    continue
+                payload = json_dumps(self.board(stop))
+                if self.shown.get(stop) != payload:
+                    self.shown[stop] = payload
+                    payloads[stop] = payload
+        for (stop, payload) in payloads.items():
+            publish(self.config,self.client,f"{self.config['mqtt']['prefix']}/departures/{stop}",payload=payload,qos=1,retain=True)
+
+    def board(self,stop):
+        directions = {}
+        for direction in (0, 1):
+            board = self.boards.get((stop, direction),{})
+            upcoming = heapq.nsmallest(self.count,board.items(),key=lambda item: item[1])
+            directions[str(direction)] = [self.departure(key) for (key, when) in upcoming]
+        return {'stop': stop, 'directions': directions}
+
+    def departure(self,key):
+        prediction = store.get(*key)
+        trip = next(iter(store.related(prediction,'trip')),None)
+        route = next(iter(store.related(prediction,'route')),None)
+        vehicle = next(iter(store.related(prediction,'vehicle')),None)
+        attributes = prediction.attributes
+        departure = {
+            'prediction': key[1],
+            'route': route.attributes.get('short_name') or route.key[1] if route else None,
+            'headsign': trip.attributes.get('headsign') if trip else None,
+            'direction': None,
+            'time': attributes.get('departure_time') or attributes.get('arrival_time'),
+            'status': attributes.get('status'),
+            'vehicle': vehicle.key[1] if vehicle else None,
+            'vehicle_status': None,
+            'stops_away': None }
+        if route and route.attributes.get('direction_names'):
+            try:
+                departure['direction'] = route.attributes['direction_names'][attributes['direction_id']]
+            except (IndexError, KeyError, TypeError):
+                pass
+        # If the vehicle isn't on this trip yet, it's finishing up a
+        # previous one, and how far it is from here is anyone's guess.
+        if vehicle and trip and trip.key in vehicle.related.get('trip',()):
+            departure['vehicle_status'] = vehicle.attributes.get('current_status')
+            departure['stops_away'] = self.stops_away(prediction,trip,vehicle)
+        return departure
+
+    @staticmethod
+    def stops_away(prediction,trip,vehicle):
+        """Stop sequence numbers only promise to go up (for trains, in
+           big jumps), so count places in the trip's list of stops
+           instead. Failing that (no stop list), subtract, which is
+           right for buses."""
+        stops = [stop[1] for stop in trip.related.get('stops',())]
+        here = [stop[1] for stop in prediction.related.get('stop',())]
+        there = [stop[1] for stop in vehicle.related.get('stop',())]
+        if stops and here and there and here[0] in stops and there[0] in stops:
+            return stops.index(here[0]) - stops.index(there[0])
+        try:
+            return prediction.attributes['stop_sequence'] - vehicle.attributes['current_stop_sequence']
+        except (KeyError, TypeError):
+            return None
+
+    def clear(self):
+        """Removes the retained messages, when we're shutting down."""
+        for stop in list(self.shown):
+            publish(self.config,self.client,f"{self.config['mqtt']['prefix']}/departures/{stop}",payload='',qos=1,retain=True)
+        self.shown.clear()
+
+
+class Shards:
+    """Splits the stops between several instances of mbta2mqtt, sharing
+       one MQTT prefix and Home Assistant `node_id`. Each has a name
+       (`sharding: instance`), and its own availability topic,
+       `<prefix>/instances/<name>`, which is also its last will — so
+       everyone knows who's up. Every stop goes to whichever live
+       instance scores highest for it (rendezvous hashing), so they all
+       agree without talking it over, and only a few stops move when an
+       instance comes or goes. Streams with filters of their own (not by
+       stop) are handed out the same way, by name.
+
+       An instance only streams a stop once it holds the retained lease,
+       `<prefix>/lease/<stop>`: a stop moves when its old owner lets go,
+       or when the old owner is gone. Nobody claims anything until it's
+       seen all the retained leases (see `start()`), and nobody lets go
+       of a lease that isn't (still) theirs.
+
+       Entities are marked by their availability topic, so we can tell
+       which instance's each one is. We never clear another instance's,
+       and for things several instances have (a route serving stops on
+       both, say), the first to publish keeps it — until it's gone, or
+       clears it, and then someone else who wants it takes over.
+    """
+
+    def __init__(self,config,client):
+        self.config = config
+        self.client = client
+        self.instance = config['sharding']['instance']
+        self.prefix = config['mqtt']['prefix']
+        self.me = status_topic(config)
+        self.legacy = f"{self.prefix}/status"
+        self.changed = threading.Condition(threading.RLock())
+        self.live = {self.instance: True}   # instance -> online?
+        self.leases = {}                    # stop -> instance holding it
+        self.stops = set()                  # stops we have the lease for
+        self.streams = set()                # other streams we run
+        self.started = False                # seen all the leases yet?
+        self.tasks = queue.Queue()
+        threading.Thread(target=self.run,name="shards",daemon=True).start()
+
+    def subscribe(self,client,wait=False):
+        for (topic, callback) in ((f"{self.prefix}/instances/+", self.instance_message),
+                                  (f"{self.prefix}/lease/+", self.lease_message)):
+            client.message_callback_add(topic,callback)
+            if wait:
+                mqtt_subscribe_wait(client,topic)
+            else:
+                client.subscribe(topic)
+
+    # These two are called on paho's thread, which mustn't wait on
+    # anything (like publishing), so the real work goes to `run()`.
+    def instance_message(self,client,userdata,message):
+        name = message.topic.rsplit('/',1)[1]
+        if name == self.instance:
+            return
+        online = message.payload == b'online'
+        with self.changed:
+            was = self.live.get(name,False)
+            self.live[name] = online
+        if online != was:
+            logging.log(25,f"Shards: Instance '{name}' is {'online' if online else 'offline'}")
+            self.tasks.put(('rebalance', None))
+            if was:
+                self.tasks.put(('takeover', message.topic))
+
+    def lease_message(self,client,userdata,message):
+        stop = message.topic.rsplit('/',1)[1]
+        with self.changed:
+            self.leases[stop] = message.payload.decode('utf-8') or None
+        self.tasks.put(('rebalance', None))
+
+    def dropped(self,topic):
+        """Another instance cleared a discovery topic. If we want it, it's ours now."""
+        holder = entities.holder_of(topic)
+        if not holder or holder == self.me:
+            return
+        if entities.wanted(topic):
+            entities.found(topic,None,None)
+            self.tasks.put(('takeover', topic))
+        else:
+            key = entities.key_of(topic)
+            entities.cleared(topic)
+            self.tasks.put(('forget', (topic, key)))
+
+    def start(self):
+        """Once we're in sync with the broker. (See `mqtt_sync()`.)"""
+        with self.changed:
+            self.started = True
+        self.tasks.put(('rebalance', None))
+
+    def release(self,stops):
+        for stop in stops:
+            with self.changed:
+                mine = self.leases.get(stop) == self.instance
+            if mine:
+                self.client.publish(f"{self.prefix}/lease/{stop}",payload='',qos=1,retain=True)
+
+    def run(self):
+        while True:
+            (task, argument) = self.tasks.get()
+            try:
+                match task:
+                    case 'rebalance':
+                        self.rebalance()
+                    case 'takeover':
+                        self.takeover(argument)
+                    case 'forget':
+                        self.forget(*argument)
+            except Exception as ex:
+                logging.error(f"Shards: {task} failed: {ex}")
+
+    def owner(self,key):
+        with self.changed:
+            live = [name for (name, online) in self.live.items() if online]
+        return max(live,key=lambda name: hashlib.blake2b(f"{name}/{key}".encode('utf-8'),digest_size=8).digest())
+
+    def rebalance(self):
+        with self.changed:
+            if not self.started:
+                return
+            wanted = {stop for stop in self.config['mbta']['stops'] if self.owner(stop) == self.instance}
+            released = self.stops - wanted
+            claimed = {stop for stop in wanted - self.stops
+                       if self.leases.get(stop) in (None, self.instance) or not self.live.get(self.leases[stop],False)}
+            waiting = wanted - self.stops - claimed
+            self.stops = (self.stops - released) | claimed
+            # (Before the broker tells us, so we can let go of them again.)
+            self.leases.update((stop, self.instance) for stop in claimed)
+            streams = {name for (name, stream) in self.config['mbta']['streams'].items()
+                       if not stream['by_stop'] and self.owner(name) == self.instance}
+            restart = streams ^ self.streams
+            if released or claimed:
+                restart |= {name for (name, stream) in self.config['mbta']['streams'].items() if stream['by_stop']}
+            self.streams = streams
+            self.changed.notify_all()
+
+        # Claim, switch streams over, and only then let go.
+        for stop in claimed:
+            self.client.publish(f"{self.prefix}/lease/{stop}",payload=self.instance,qos=1,retain=True)
+        for name in restart:
+            if name in watchdogs:
+                watchdogs[name].hang_up()
+        self.release(released)
+        if claimed or released:
+            logging.log(25,f"Shards: Now have stops {sorted(self.stops)} (claimed {sorted(claimed)}, released {sorted(released)})")
+        if waiting:
+            logging.debug(f"Shards: Waiting for other instances to let go of stops {sorted(waiting)}")
+
+    def takeover(self,what):
+        """Publishes entities we want which were `what`'s (an instance's
+           availability topic), or just `what` (a discovery topic)."""
+        for (topic, key, owner) in entities.wanted(what):
+            self.forget(topic,key)
+            record = store.get(*key)
+            if record:
+                if debugging:
+                    logging.debug(f"Shards: Taking over '{key[0]} {key[1]}'")
+                add_entity(self.config,self.client,record.resource,owner)
+
+    def forget(self,topic,key):
+        """Whoever had this entity since we last sent it may have changed
+           or cleared it, so don't skip sending it again. (This waits on
+           publishing, so not on paho's thread.)"""
+        topics = [DeviceBundles.split(topic)[0]] + (status_topics(self.config,key) if key else [])
+        with publish_lock:
+            published.forget(topics)
+
+    def stream_url(self,name):
+        """The URL for stream `name`, once we have anything for it."""
+        stream = self.config['mbta']['streams'][name]
+        with self.changed:
+            if stream['by_stop']:
+                if not self.stops:
+                    logging.info(f"Shards: No stops for '{name}' yet.")
+                self.changed.wait_for(lambda: self.stops)
+                return stream_url(self.config,stream,sorted(self.stops))
+            if name not in self.streams:
+                logging.info(f"Shards: Stream '{name}' belongs to another instance for now.")
+            self.changed.wait_for(lambda: name in self.streams)
+            return stream['url']
+
+    def running(self):
+        """The streams we're running now."""
+        with self.changed:
+            by_stop = {name for (name, stream) in self.config['mbta']['streams'].items() if stream['by_stop']}
+            return (by_stop if self.stops else set()) | self.streams
+
+    def has_stop(self,stop):
+        return stop in self.stops
+
+    def ours(self,topic):
+        """Is this discovery topic ours to clear?"""
+        return entities.holder_of(topic) in (None, self.me, self.legacy)
+
+    def elsewhere(self,topic):
+        """Does another live instance have this one?"""
+        holder = entities.holder_of(topic)
+        if holder in (None, self.me, self.legacy) or not holder.startswith(f"{self.prefix}/instances/"):
+            return False
+        with self.changed:
+            return self.live.get(holder.rsplit('/',1)[1],False)
+
+    def release_all(self):
+        with self.changed:
+            (stops, self.stops) = (self.stops, set())
+        self.release(stops)
+
+# Set up in main(), if there's a `sharding: instance`.
+shards = None
+
+
+# Home Assistant's short versions of the discovery keys we use.
+# https://www.home-assistant.io/integrations/mqtt/#supported-abbreviations-in-mqtt-discovery-messages
+discovery_abbreviations = {
+    'availability_topic': 'avty_t',
+    'components': 'cmps',
+    'device': 'dev',
+    'device_class': 'dev_cla',
+    'entity_category': 'ent_cat',
+    'expire_after': 'exp_aft',
+    'icon': 'ic',
+    'identifiers': 'ids',
+    'json_attributes_template': 'json_attr_tpl',
+    'json_attributes_topic': 'json_attr_t',
+    'manufacturer': 'mf',
+    'model': 'mdl',
+    'object_id': 'obj_id',
+    'origin': 'o',
+    'platform': 'p',
+    'state_class': 'stat_cla',
+    'state_topic': 'stat_t',
+    'sw_version': 'sw',
+    'unique_id': 'uniq_id',
+    'unit_of_measurement': 'unit_of_meas',
+    'value_template': 'val_tpl',
+}
+
+def abbreviate(payload,base=None):
+    """A discovery payload with Home Assistant's short keys, and topics
+       under `base` written as `~/...` (`~` itself is set elsewhere)."""
+    short = {}
+    for (key, value) in payload.items():
+        if type(value) == dict:
+            value = abbreviate(value)
+        elif base and type(value) == str and key.endswith('_topic') and value.startswith(f"{base}/"):
+            value = f"~{value[len(base):]}"
+        short[discovery_abbreviations.get(key,key)] = value
+    return short
+
+
+def device_topic_prefix(config):
+    return f"{config['homeassistant']['discovery_prefix']}/device/{config['homeassistant']['node_id']}_stop_"
+
+
+class DeviceBundles:
+    """With `homeassistant: discovery: device`, each stop we follow gets
+       one device discovery message, `<discovery_prefix>/device/<node_id>_
+       stop_<stop>/config`, with the stop and all of its predictions in it
+       as components — instead of a discovery message each, every one
+       repeating the same device block. It uses the short keys, and `~`
+       for our topic prefix, too.
+
+       The entity registry still keeps track of each component, under a
+       made-up topic: the device topic, `#`, and the component's id. So
+       resets, removes, and so on work just like for the others. Changes
+       are gathered up and the device message sent once for all of them
+       — at the end of a `batch()` (or between `hold()` and `release()`,
+       like for a reset), or right away outside of one. A component that's gone is sent once as just `{"p":
+       "sensor"}`, which is how Home Assistant knows to remove it; a
+       device with nothing left is cleared altogether.
+    """
+
+    def __init__(self,config,client):
+        self.config = config
+        self.client = client
+        self.lock = threading.RLock()
+        self.prefix = device_topic_prefix(config)
+        self.devices = {}       # stop -> device block
+        self.components = collections.defaultdict(dict)     # stop -> component id -> component
+        self.removed = collections.defaultdict(set)         # stop -> ids to send as removed
+        self.dirty = set()
+        self.batching = 0
+
+    def topic(self,stop,component=None):
+        topic = f"{self.prefix}{stop}/config"
+        return f"{topic}#{component}" if component else topic
+
+    @staticmethod
+    def split(topic):
+        """(device topic, component id) for a component's made-up topic."""
+        (topic, _, component) = topic.partition('#')
+        return (topic, component)
+
+    def stop_of(self,topic):
+        return self.split(topic)[0][len(self.prefix):-len("/config")]
+
+    def component(self,payload):
+        """A per-entity discovery payload, as a component of its stop's device."""
+        component = {'platform': 'sensor'}
+        component.update((key, value) for (key, value) in payload.items() if key not in ('device', 'availability_topic'))
+        return abbreviate(component,self.config['mqtt']['prefix'])
+
+    def put(self,stop,device,component,changed=True):
+        """Adds (or updates) a component. Unchanged ones are still needed
+           for the whole message, the next time it's sent."""
+        with self.lock:
+            # The stop's own entity is the one with the device's name.
+            if stop not in self.devices or 'name' in device:
+                self.devices[stop] = abbreviate(device)
+            self.components[stop][component['obj_id']] = component
+            self.removed[stop].discard(component['obj_id'])
+            if changed:
+                self.dirty.add(stop)
+        self.flush()
+
+    def drop(self,topic):
+        stop = self.stop_of(topic)
+        component = self.split(topic)[1]
+        with self.lock:
+            self.components[stop].pop(component,None)
+            self.removed[stop].add(component)
+            self.dirty.add(stop)
+        self.flush()
+
+    def hold(self):
+        """Holds on to device messages until `release()`. (Not just this
+           thread's: the asyncio engine handles a reset's resources on
+           whichever of its threads is free.)"""
+        with self.lock:
+            self.batching += 1
+
+    def release(self):
+        with self.lock:
+            self.batching -= 1
+        self.flush()
+
+    @contextlib.contextmanager
+    def batch(self):
+        self.hold()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def flush(self):
+        with self.lock:
+            if self.batching:
+                return
+            (dirty, self.dirty) = (self.dirty, set())
+            messages = {}
+            for stop in dirty:
+                messages[stop] = self.message(stop)
+                self.removed[stop].clear()
+                if not self.components[stop]:
+                    del self.components[stop]
+                    self.devices.pop(stop,None)
+        for (stop, payload) in messages.items():
+            if debugging:
+                logging.debug(f"MQTT: Sending device discovery message for stop {stop}")
+            publish(self.config,self.client,self.topic(stop),payload=payload,qos=1,retain=True)
+
+    def message(self,stop):
+        components = self.components[stop]
+        if not components:
+            return ''
+        payload = {
+            'dev': self.devices.get(stop) or {'ids': f"mbta stop {stop}"},
+            'o': {'name': 'mbta2mqtt', 'sw': VERSION},
+            '~': self.config['mqtt']['prefix'],
+            'avty_t': status_topic(self.config),
+            'cmps': dict(components),
+        }
+        for component in self.removed[stop]:
+            payload['cmps'][component] = {'p': 'sensor'}
+        return json_dumps(payload)
+
+    def found(self,topic,payload,retain):
+        """A device discovery message from the broker (or another instance)."""
+        try:
+            payload = json_loads(payload)
+            (holder, components) = (payload.get('avty_t'), payload['cmps'])
+        except json_errors + (AttributeError, KeyError, TypeError) as ex:
+            logging.warning(f"MQTT: Couldn't make sense of device discovery message '{topic}': {ex}")
+            return
+        if shards and not retain and holder == shards.me:
+            return
+        for (component, value) in components.items():
+            if list(value) == ['p']:
+                continue
+            entities.found(self.topic(self.stop_of(topic),component),PayloadCache.digest(json_dumps(value)),holder)
+
+    def cleared(self,topic):
+        """Someone else cleared a whole device."""
+        for known in entities.known():
+            if known.startswith(f"{topic}#"):
+                shards.dropped(known)
+
+# Set up in main(), with `homeassistant: discovery: device`.
+bundles = None
+
+# QoS 1 messages handed to paho which we haven't (yet) seen acknowledged.
+# Rather than waiting on every single publish, we let up to
+# `mqtt: publish_window` of these pile up. See `publish()`.
+inflight = collections.deque()
+publish_lock = threading.Lock()
+
+# Set while we're connected to the broker. Publishing waits for this,
+# so if the broker goes away, we just pause until paho reconnects.
+broker = threading.Event()
+broker_connections = 0
+
+
+class MQTT5:
+    """The extras we use with `mqtt: protocol: 5`. Each message to a
+       state or attributes topic gets:
+
+       * a topic alias, so after the first time on this connection,
+         it's sent as a number instead of the whole topic. The busiest
+         topics keep theirs; the rest take turns.
+       * a message expiry interval, for types with `message_expiry` set,
+         so the broker forgets retained predictions and vehicles on its
+         own if we stop updating them (say, because we're gone).
+       * user properties, with when the event it came from arrived, and
+         the resource's own `updated_at`, if it has one.
+
+       Aliases only last as long as the connection, and paho resends
+       unacknowledged messages after reconnecting exactly as they were
+       first sent — which is no good for ones sent with just an alias.
+       So we remember the topics of those until they're acknowledged,
+       and put them back (without the alias) before paho gets to them. (This means poking
+       at paho's list of outgoing messages, but there's no other way. So
+       with a version of paho we don't know that works with, we don't use
+       aliases at all.)
+    """
+
+    # Versions of paho whose insides `connected()` knows its way around.
+    # (2.x would need the client made with a `callback_api_version`,
+    # too, and we don't do that yet.)
+    paho_versions = ('1.6.',)
+
+    def __init__(self,config):
+        self.lock = threading.Lock()
+        self.wanted = config['mqtt']['topic_aliases']
+        import paho.mqtt
+        if self.wanted and not paho.mqtt.__version__.startswith(self.paho_versions):
+            logging.warning(f"MQTT: Not using topic aliases, since they need paho-mqtt 1.6, and this is {paho.mqtt.__version__}")
+            self.wanted = 0
+        self.maximum = 0            # what the broker allows, this connection
+        self.aliases = collections.OrderedDict()    # topic -> alias, least recently used first
+        self.pending = {}           # mid -> topic, for messages sent with just an alias
+
+    def connected(self,client,properties):
+        """A new connection: aliases start over."""
+        with self.lock:
+            self.maximum = min(self.wanted,getattr(properties,'TopicAliasMaximum',0))
+            self.aliases.clear()
+            if not self.wanted:
+                return
+            # Anything paho resends goes without an alias, too, so it
+            # can't undo one we've set up since.
+            with client._out_message_mutex:
+                for message in client._out_messages.values():
+                    if message.properties and hasattr(message.properties,'TopicAlias'):
+                        if message.mid in self.pending:
+                            message._topic = self.pending[message.mid].encode('utf-8')
+                        del message.properties.TopicAlias
+            if self.pending:
+                logging.debug(f"MQTT: Restored topics for {len(self.pending)} messages sent with aliases")
+                self.pending.clear()
+        logging.debug(f"MQTT: Broker allows {self.maximum} topic aliases (we'd use up to {self.wanted})")
+
+    def publish(self,client,topic,payload,qos,retain,resource=None):
+        """Publishes with whatever properties fit. Without `resource`,
+           it's not a state or attributes topic, so it gets none."""
+        if resource is None:
+            return client.publish(topic,payload=payload,qos=qos,retain=retain)
+
+        properties = mqtt.Properties(PacketTypes.PUBLISH)
+        expiry = self.expiry(resource,retain,payload)
+        if expiry:
+            properties.MessageExpiryInterval = expiry
+        received = getattr(event_context,'received',None)
+        if received:
+            received = time.time() - (time.monotonic() - received)
+            properties.UserProperty = ('received', datetime.datetime.fromtimestamp(received).astimezone().isoformat(timespec='milliseconds'))
+        updated = (resource.get('attributes') or {}).get('updated_at')
+        if updated:
+            properties.UserProperty = ('updated_at', str(updated))
+
+        with self.lock:
+            if not self.maximum:
+                return client.publish(topic,payload=payload,qos=qos,retain=retain,properties=properties)
+            alias = self.aliases.get(topic)
+            if alias:
+                self.aliases.move_to_end(topic)
+                properties.TopicAlias = alias
+                info = client.publish('',payload=payload,qos=qos,retain=retain,properties=properties)
+                if qos > 0:
+                    self.pending[info.mid] = topic
+                metrics.count('publishes_aliased')
+                return info
+            # New to us: give it a free alias, or the least recently used one.
+            if len(self.aliases) < self.maximum:
+                alias = len(self.aliases) + 1
+            else:
+                (_, alias) = self.aliases.popitem(last=False)
+            self.aliases[topic] = alias
+            properties.TopicAlias = alias
+            return client.publish(topic,payload=payload,qos=qos,retain=retain,properties=properties)
+
+    @staticmethod
+    def expiry(resource,retain,payload):
+        """How long (in seconds) the broker will keep this message, if
+           it's not forever."""
+        expiry = type_options.get(resource['type'],{}).get('message_expiry')
+        return int(expiry) if expiry and retain and payload else None
+
+    def acked(self,mid):
+        if self.pending:
+            with self.lock:
+                self.pending.pop(mid,None)
+
+# Set up in main(), with `mqtt: protocol: 5`.
+mqtt5 = None
+
+
+class PayloadCache:
+    """Remembers a hash of the last payload published to each topic,
+       so we can skip sending exactly the same thing again. Holds at
+       most `size` topics, forgetting the least recently used first.
+       (Forgetting is harmless: it just means we'll send it again.)
+
+       Messages the broker will expire (see `MQTT5`) are only skipped
+       for half of their lifetime, so they're sent again before the
+       broker forgets them.
+    """
+
+    def __init__(self,size=0):
+        self.size = size
+        self.hashes = collections.OrderedDict()
+        self.fresh = {}         # topic -> until when an expiring one can be skipped
+        self.hits = 0
+        self.misses = 0
+        self.snapshot = None    # see `Snapshot`
+
+    @staticmethod
+    def digest(payload):
+        if isinstance(payload,str):
+            payload = payload.encode('utf-8')
+        return hashlib.blake2b(payload,digest_size=16).digest()
+
+    def unchanged(self,topic,payload,expiry=None):
+        """True if `payload` is what we last sent to `topic` (and, if it
+           expires in `expiry` seconds, the broker still has it for a
+           while yet). Otherwise, remember it as the new last thing and
+           return False.
+        """
+        if self.size <= 0:
+            return False
+        digest = self.digest(payload)
+        if self.hashes.get(topic) == digest and (not expiry or self.fresh.get(topic,0) > time.monotonic()):
+            self.hashes.move_to_end(topic)
+            self.hits += 1
+            return True
+        self.misses += 1
+        self.hashes[topic] = digest
+        self.hashes.move_to_end(topic)
+        if expiry:
+            self.fresh[topic] = time.monotonic() + expiry / 2
+        else:
+            self.fresh.pop(topic,None)
+        if self.snapshot:
+            # (Cleared topics don't need remembering.)
+            self.snapshot.record(topic,digest if payload else None)
+        if len(self.hashes) > self.size:
+            (forgotten, _) = self.hashes.popitem(last=False)
+            self.fresh.pop(forgotten,None)
+            if self.snapshot:
+                self.snapshot.record(forgotten,None)
+        return False
+
+    def forget(self,topics):
+        """Someone else has written to these (see `Shards`), so what we
+           last sent there isn't necessarily what's there now."""
+        for topic in topics:
+            if self.hashes.pop(topic,None) is not None:
+                self.fresh.pop(topic,None)
+                if self.snapshot:
+                    self.snapshot.record(topic,None)
+
+    def stats(self):
+        return f"{self.hits} unchanged (skipped), {self.misses} sent, {len(self.hashes)} topics cached"
+
+# Set up properly (with the configured size) in main()
+published = PayloadCache()
+
+
+class Snapshot:
+    """Keeps the payload cache's hashes in an SQLite file, so that after a
+       restart we remember what the broker already has, and the first
+       reset only sends what actually changed. New hashes are saved in
+       batches, every `interval` seconds, by a thread of its own.
+
+       Discovery topics are saved too, but not loaded back into the
+       cache — the retained messages on the broker are the real answer
+       for those (see `EntityRegistry`). They're used to tell whether the
+       broker still has what we left there: if none of them are there
+       (and, since `clear_on_exit` clears them, none of a few of our state
+       topics either), it's lost its retained messages, and the snapshot
+       is useless.
+
+       Topics which are cleared, or which the cache forgets, are deleted
+       from it too, so it's never much bigger than the cache.
+    """
+
+    def __init__(self,path,interval):
+        self.db = sqlite3.connect(path,check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS published (topic TEXT PRIMARY KEY, digest BLOB)")
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.pending = {}       # topic -> digest, or None to delete it
+
+    def load(self,cache,discovery_prefix):
+        """Fills `cache` in, and returns the discovery topics we had."""
+        with self.lock, self.db:
+            # Cleared topics don't need remembering. (Older versions kept
+            # them.) And only the newest `size` are any use: a replaced row
+            # gets a new rowid, so that's the order they were sent in.
+            self.db.execute("DELETE FROM published WHERE digest = ?",(PayloadCache.digest(''),))
+            self.db.execute("DELETE FROM published WHERE rowid <= (SELECT rowid FROM published ORDER BY rowid DESC LIMIT 1 OFFSET ?)",(cache.size,))
+            rows = self.db.execute("SELECT topic, digest FROM published ORDER BY rowid").fetchall()
+        discovery = set()
+        for (topic, digest) in rows:
+            if topic.startswith(f"{discovery_prefix}/"):
+                discovery.add(topic)
+            else:
+                cache.hashes[topic] = digest
+        while len(cache.hashes) > cache.size:
+            cache.hashes.popitem(last=False)
+        return discovery
+
+    def record(self,topic,digest):
+        with self.lock:
+            self.pending[topic] = digest
+
+    def save(self):
+        with self.lock:
+            (pending, self.pending) = (self.pending, {})
+            if pending:
+                with self.db:
+                    self.db.executemany("DELETE FROM published WHERE topic = ?",
+                                        [(topic,) for (topic, digest) in pending.items() if digest is None])
+                    self.db.executemany("INSERT OR REPLACE INTO published (topic, digest) VALUES (?, ?)",
+                                        [(topic, digest) for (topic, digest) in pending.items() if digest is not None])
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.save()
+            except sqlite3.Error as ex:
+                logging.error(f"Snapshot: Couldn't save: {ex}")
+
+    def close(self):
+        self.save()
+        self.db.close()
+
+
+def load_snapshot(config):
+    """Opens the snapshot (if there is one configured) and loads it
+       into the payload cache. Returns the discovery topics it had."""
+
+    if not config['snapshot']['path'] or published.size <= 0:
+        return set()
+    try:
+        snapshot = Snapshot(config['snapshot']['path'],config['snapshot']['interval'])
+        discovery = snapshot.load(published,config['homeassistant']['discovery_prefix'])
+    except sqlite3.Error as ex:
+        logging.error(f"Snapshot: Couldn't open '{config['snapshot']['path']}', so starting from scratch: {ex}")
+        return set()
+    published.snapshot = snapshot
+    threading.Thread(target=snapshot.run,name="snapshot",daemon=True).start()
+    logging.log(15,f"Snapshot: Loaded {len(published.hashes)} payload hashes and {len(discovery)} discovery topics from '{config['snapshot']['path']}'")
+    return discovery
+
+class Histogram:
+    """Counts of observations falling under each bound, Prometheus style."""
+
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self,bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)   # the last is "more than that"
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self,value):
+        self.counts[bisect.bisect_left(self.bounds,value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """(bound, how many at or under it) pairs, ending with infinity."""
+        total = 0
+        result = []
+        for (bound, count) in zip(self.bounds + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class Metrics:
+    """Counters and gauges (with labels), and a histogram of how long it
+       takes from getting an event from the MBTA to the broker acknowledging
+       the messages it turned into. See `metrics_reporter()` for where
+       these go.
+    """
+
+    latency_bounds = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = collections.Counter()   # (name, labels) -> count
+        self.gauges = {}                        # (name, labels) -> value
+        self.latency = Histogram(self.latency_bounds)
+        self.pending = {}   # message id -> when its event arrived
+        self.early = {}     # message id -> when it was acknowledged, if that beat `sent()`
+
+    def count(self,name,amount=1,**labels):
+        with self.lock:
+            self.counters[(name, tuple(labels.items()))] += amount
+
+    def gauge(self,name,value,**labels):
+        with self.lock:
+            self.gauges[(name, tuple(labels.items()))] = value
+
+    def sent(self,mid,received):
+        """We published message `mid` because of an event that arrived at `received`."""
+        if received is None:
+            return
+        with self.lock:
+            if mid in self.early:
+                self.latency.observe(self.early.pop(mid) - received)
+            else:
+                self.pending[mid] = received
+
+    def acked(self,mid):
+        """The broker acknowledged message `mid`."""
+        now = time.monotonic()
+        with self.lock:
+            received = self.pending.pop(mid,None)
+            if received is not None:
+                self.latency.observe(now - received)
+            else:
+                # Either it's not one we're timing, or paho's thread got the
+                # acknowledgement before `publish()` got around to `sent()`.
+                if len(self.early) > 1000:
+                    self.early.clear()
+                self.early[mid] = now
+
+    def collect(self):
+        """Fills in the gauges that are easier to look at than to keep track of."""
+        self.gauge('publish_inflight',len(inflight))
+        self.gauge('broker_connected',int(broker.is_set()))
+        self.gauge('payload_cache_topics',len(published.hashes))
+        self.gauge('payload_cache_hits',published.hits)
+        self.gauge('payload_cache_misses',published.misses)
+        self.gauge('entities',len(entities.known()))
+        self.gauge('stored_resources',len(store.records))
+        self.gauge('uptime_seconds',round(time.time() - self.started))
+
+    def as_dict(self):
+        """Everything, nested by label values: `{'events': {'predictions': {'update': 12}}}`."""
+        self.collect()
+        result = {}
+        with self.lock:
+            for ((name, labels), value) in list(self.counters.items()) + list(self.gauges.items()):
+                place = result
+                key = name
+                for (label, label_value) in labels:
+                    place = place.setdefault(key,{})
+                    key = str(label_value)
+                place[key] = value
+            result['publish_latency_seconds'] = {
+                'buckets': {('+Inf' if bound == float('inf') else str(bound)): count for (bound, count) in self.latency.cumulative()},
+                'sum': round(self.latency.sum,6),
+                'count': self.latency.count }
+        return result
+
+    def prometheus(self):
+        """Everything, in Prometheus' text exposition format."""
+        self.collect()
+        lines = []
+        def labelled(name,labels,extra=()):
+            labels = ','.join(f'{label}="{value}"' for (label, value) in tuple(labels) + tuple(extra))
+            return f"mbta2mqtt_{name}{{{labels}}}" if labels else f"mbta2mqtt_{name}"
+        with self.lock:
+            for (kind, values) in (('counter', self.counters), ('gauge', self.gauges)):
+                typed = set()
+                for ((name, labels), value) in sorted(values.items()):
+                    metric = f"{name}_total" if kind == 'counter' else name
+                    if metric not in typed:
+                        lines.append(f"# TYPE mbta2mqtt_{metric} {kind}")
+                        typed.add(metric)
+                    lines.append(f"{labelled(metric,labels)} {value}")
+            lines.append("# TYPE mbta2mqtt_publish_latency_seconds histogram")
+            for (bound, count) in self.latency.cumulative():
+                le = '+Inf' if bound == float('inf') else str(bound)
+                lines.append(f"{labelled('publish_latency_seconds_bucket',(),(('le', le),))} {count}")
+            lines.append(f"mbta2mqtt_publish_latency_seconds_sum {self.latency.sum}")
+            lines.append(f"mbta2mqtt_publish_latency_seconds_count {self.latency.count}")
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+
+class Profiler:
+    """Profiles a running bridge for a while, on request: SIGUSR1, or (with
+       `profiling: command`) a message to `<prefix>/command/profile` (with
+       a number of seconds, up to `profiling: seconds`, or nothing for
+       that many), starts it; SIGUSR2, or "stop", ends it early. Then it
+       writes to `profiling: directory`:
+
+       * profile-<when>.pstats and .txt — cProfile, for every thread that
+         handled events in the meantime (each turns its own on and off,
+         since cProfile only sees the thread that enabled it),
+       * memory-<when>.txt — where the allocations came from (tracemalloc),
+       * stages-<when>.json — wall time spent parsing the stream, decoding
+         JSON, handling events, and (part of that) publishing.
+
+       When it's not running, `begin()` and `end()` cost next to nothing.
+    """
+
+    stages = ('parse', 'decode', 'handle', 'publish')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = False
+        self.attached = 0       # threads with a profiler still on
+        self.session = 0
+        self.local = threading.local()
+        self.profiles = []      # this session's, once they're off
+        self.timings = {}       # stage -> [count, total, max]
+        self.config = None
+        self.topic = None       # where commands come from, if anywhere
+
+    def setup(self,config,client):
+        self.config = config
+        # (Signal handlers run on the main thread, between whatever it
+        # was doing, so they just hand the work off.)
+        if hasattr(signal,'SIGUSR1'):
+            signal.signal(signal.SIGUSR1,lambda signum,frame: threading.Thread(target=self.start,daemon=True).start())
+            signal.signal(signal.SIGUSR2,lambda signum,frame: threading.Thread(target=self.stop,daemon=True).start())
+        if config['profiling']['command']:
+            self.topic = f"{config['mqtt']['prefix']}/command/profile"
+            client.message_callback_add(self.topic,self.command)
+            self.subscribe(client)
+            logging.debug(f"Profile: Listening for commands on '{self.topic}'")
+
+    def subscribe(self,client):
+        """(Again, after a reconnect. See `mqtt_connect()`.)"""
+        if self.topic:
+            client.subscribe(self.topic)
+
+    def command(self,client,userdata,message):
+        request = message.payload.decode('utf-8','replace').strip()
+        if message.retain:
+            # Left over from some other time.
+            return
+        if request == 'stop':
+            target = self.stop
+            args = ()
+        else:
+            try:
+                args = (float(request),) if request else ()
+                if args and not (math.isfinite(args[0]) and args[0] > 0):
+                    raise ValueError
+            except ValueError:
+                logging.warning(f"Profile: Don't know what to do with '{request}' (send a number of seconds, or 'stop')")
+                return
+            target = self.start
+        threading.Thread(target=target,args=args,daemon=True).start()
+
+    def start(self,seconds=None):
+        import tracemalloc
+        # Never more than configured, however we were asked.
+        seconds = min(seconds or math.inf,self.config['profiling']['seconds'])
+        with self.lock:
+            if self.active:
+                logging.warning(f"Profile: Already profiling.")
+                return
+            self.session += 1
+            self.profiles = []
+            self.timings = {stage: [0, 0.0, 0.0] for stage in self.stages}
+            self.active = True
+            session = self.session
+        tracemalloc.start(10)
+        logging.log(25,f"Profile: Profiling for {seconds:g}s")
+        threading.Timer(seconds,self.stop,args=(session,)).start()
+
+    def stop(self,session=None):
+        with self.lock:
+            if not self.active or session not in (None, self.session):
+                return
+            self.active = False
+        import tracemalloc
+        memory = tracemalloc.take_snapshot()
+        (current, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        # Threads turn off their own profilers the next time they
+        # come by; give the busy ones a moment to.
+        deadline = time.monotonic() + 5
+        while self.attached and time.monotonic() < deadline:
+            time.sleep(0.1)
+        try:
+            self.write(memory,peak)
+        except OSError as ex:
+            logging.error(f"Profile: Couldn't write results: {ex}")
+
+    def write(self,memory,peak):
+        import pstats
+        directory = self.config['profiling']['directory'] or os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),'mbta2mqtt','profiles')
+        os.makedirs(directory,exist_ok=True)
+        when = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+        written = []
+
+        with self.lock:
+            profiles = self.profiles
+            timings = {stage: list(timing) for (stage, timing) in self.timings.items()}
+        if profiles:
+            stats = pstats.Stats(*profiles)
+            path = os.path.join(directory,f"profile-{when}.pstats")
+            stats.dump_stats(path)
+            with open(os.path.join(directory,f"profile-{when}.txt"),'w') as f:
+                stats.stream = f
+                stats.sort_stats('cumulative').print_stats(50)
+            written.append(path)
+        else:
+            logging.warning(f"Profile: No events were handled, so there's no profile.")
+
+        path = os.path.join(directory,f"memory-{when}.txt")
+        with open(path,'w') as f:
+            f.write(f"peak traced: {peak/1048576:.1f} MiB\n\n")
+            for stat in memory.statistics('lineno')[:50]:
+                f.write(f"{stat}\n")
+        written.append(path)
+
+        report = {stage: {'count': count, 'seconds': round(total,6), 'max_seconds': round(longest,6)}
+                  for (stage, (count, total, longest)) in timings.items()}
+        # Handling includes publishing; what's left is turning MBTA
+        # resources into Home Assistant's idea of things.
+        report['transform'] = {'seconds': round(timings['handle'][1] - timings['publish'][1],6)}
+        path = os.path.join(directory,f"stages-{when}.json")
+        with open(path,'w') as f:
+            json.dump(report,f,indent=2)
+        written.append(path)
+        logging.log(25,f"Profile: Wrote {', '.join(written)}")
+
+    def begin(self):
+        """Call at the start of a stage. Returns what `end()` needs."""
+        if not self.active and not self.attached:
+            return None
+        local = self.local
+        if getattr(local,'session',None) != self.session or not self.active:
+            self.detach()
+            if self.active:
+                import cProfile
+                local.profile = cProfile.Profile()
+                local.session = self.session
+                local.profile.enable()
+                with self.lock:
+                    self.attached += 1
+            else:
+                return None
+        return time.perf_counter()
+
+    def detach(self):
+        profile = getattr(self.local,'profile',None)
+        if profile:
+            profile.disable()
+            self.local.profile = None
+            with self.lock:
+                if self.local.session == self.session:
+                    self.profiles.append(profile)
+                self.attached -= 1
+
+    def end(self,stage,started):
+        if started is None:
+            return
+        elapsed = time.perf_counter() - started
+        # (Several threads can be ending stages at once.)
+        with self.lock:
+            timing = self.timings.get(stage)
+            if timing:
+                timing[0] += 1
+                timing[1] += elapsed
+                if elapsed > timing[2]:
+                    timing[2] = elapsed
+
+profiler = Profiler()
+
+# When the event we're handling arrived from the MBTA. Each stream
+# (and the async engine's publisher) has its own thread, so this is
+# per-thread. See `handle_event()` and `publish()`.
+event_context = threading.local()
+
+
+# JSON encoding and decoding. orjson (or msgspec) is a lot faster than the
+# standard library, so we use one of those if it's installed. These get
+# set by `use_json_codec()`. `json_dumps()` may return bytes or a string;
+# paho (and everything else here) is fine with either.
+json_codec = 'json'
+json_loads = json.loads
+json_dumps = json.dumps
+json_errors = (ValueError,)
+
+
+def use_json_codec(name='auto'):
+    """Picks the JSON library: 'orjson', 'msgspec', or 'json' (the standard
+       library), or 'auto' for the fastest one that's installed.
+    """
+    global json_codec, json_loads, json_dumps, json_errors
+
+    for codec in (('orjson', 'msgspec', 'json') if name == 'auto' else (name, 'json')):
+        match codec:
+            case 'orjson':
+                try:
+                    import orjson
+                except ImportError:
+                    continue
+                json_loads = orjson.loads
+                json_dumps = lambda obj: orjson.dumps(obj,option=orjson.OPT_NON_STR_KEYS)
+                json_errors = (ValueError,)
+            case 'msgspec':
+                try:
+                    import msgspec
+                except ImportError:
+                    continue
+                json_loads = msgspec.json.Decoder().decode
+                json_dumps = msgspec.json.Encoder().encode
+                json_errors = (ValueError, msgspec.DecodeError)
+            case _:
+                # The standard library is noticeably slower at decoding
+                # bytes than at decoding a string.
+                json_loads = lambda data: json.loads(data.decode('utf-8') if isinstance(data,(bytes,bytearray)) else data)
+                json_dumps = json.dumps
+                json_errors = (ValueError,)
+        if codec != name and name != 'auto':
+            logging.warning(f"Config: JSON codec '{name}' isn't available. Using '{codec}' instead.")
+        json_codec = codec
+        logging.debug(f"Engine: Using '{codec}' for JSON.")
+        return codec
+
+
+# Home Assistant discovery payload templates, by resource type (and
+# by (type, id) for individual overrides). See `compile_templates()`.
+templates = {}
+
+# Per-type settings from the `homeassistant:` sections which are for us,
+# not for Home Assistant, so they're kept out of the templates.
+type_options = {}
+bridge_options = ('coalesce', 'attributes_include', 'attributes_exclude', 'out_of_band', 'message_expiry', 'evict_after')
+
+
+class UpdateCoalescer:
+    """Holds on to updates for resource types with a `coalesce` window, so
+       that a vehicle which reports five times in three seconds makes one
+       pair of state and attribute messages, not five. The first update
+       starts the window; later ones in it just replace the one waiting;
+       and at the end, whatever's latest is sent. A thread of its own does
+       the sending, started the first time it's needed.
+
+       Removes (and adds, and resets) make any waiting update moot, so
+       they `cancel()` it — see `handle_event()`. If it's being sent right
+       then, `cancel()` waits for that to finish, so a remove can't be
+       followed by the update it was meant to cancel.
+    """
+
+    def __init__(self):
+        self.changed = threading.Condition()
+        self.pending = {}   # (type, id) -> [due, config, client, resource, stream, received]
+        self.due = []       # heap of (due, (type, id))
+        self.sending = None # ((type, id), stream) of the one being sent
+        self.thread = None
+
+    def hold(self,config,client,resource,stream,received):
+        """True if the update will be sent later, instead of now."""
+        window = type_options.get(resource['type'],{}).get('coalesce')
+        if not window:
+            return False
+        key = (resource['type'], resource['id'])
+        with self.changed:
+            if key in self.pending:
+                self.pending[key][3:] = [resource, stream, received]
+                metrics.count('updates_coalesced',type=resource['type'])
+                return True
+            due = time.monotonic() + window
+            self.pending[key] = [due, config, client, resource, stream, received]
+            heapq.heappush(self.due,(due, key))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run,name="coalescer",daemon=True)
+                self.thread.start()
+            self.changed.notify()
+        return True
+
+    def cancel(self,key=None,stream=None):
+        """Forgets a waiting update for `key`, or all of `stream`'s."""
+        with self.changed:
+            if key is not None:
+                self.pending.pop(key,None)
+            else:
+                for (waiting, item) in list(self.pending.items()):
+                    if item[4] == stream:
+                        del self.pending[waiting]
+            if threading.current_thread() is not self.thread:
+                self.changed.wait_for(lambda: not self.busy(key,stream))
+
+    def busy(self,key,stream):
+        if not self.sending:
+            return False
+        return self.sending[0] == key if key is not None else self.sending[1] == stream
+
+    def run(self):
+        while True:
+            with self.changed:
+                while True:
+                    # Skip ones that were cancelled (or sent, and then held again).
+                    while self.due and self.pending.get(self.due[0][1],[None])[0] != self.due[0][0]:
+                        heapq.heappop(self.due)
+                    wait = self.due[0][0] - time.monotonic() if self.due else None
+                    if wait is not None and wait <= 0:
+                        break
+                    self.changed.wait(wait)
+                (due, key) = heapq.heappop(self.due)
+                (due, config, client, resource, stream, received) = self.pending.pop(key)
+                self.sending = (key, stream)
+            event_context.received = received
+            try:
+                update_entity(config,client,resource)
+            except Exception as ex:
+                logging.error(f"MQTT: Couldn't send held update for '{key[0]} {key[1]}': {ex}")
+            finally:
+                with self.changed:
+                    self.sending = None
+                    self.changed.notify_all()
+
+held = UpdateCoalescer()
+
+
+class Evictions:
+    """Gets rid of predictions and schedules once they're in the past.
+       The MBTA usually sends a 'remove' when a bus has left, but not
+       always, and never for schedules that came along as an `include` —
+       so without this, their retained topics pile up on the broker (and
+       their records in memory) until the next reset.
+
+       For types with `evict_after: <seconds>`, each resource is due to go
+       that long after the later of its departure and arrival times. It
+       listens to `store`, so a new time pushes that back. When one comes
+       due, it's cleared from the broker (discovery, state, attributes,
+       and all) and forgotten everywhere, by a thread of its own.
+    """
+
+    def __init__(self):
+        self.changed = threading.Condition()
+        self.deadlines = {}     # (type, id) -> when it goes (time.time())
+        self.due = []           # heap of (deadline, (type, id))
+        self.thread = None
+        self.config = None
+        self.client = None
+
+    @staticmethod
+    def deadline(kind,attributes):
+        grace = type_options.get(kind,{}).get('evict_after')
+        if grace is None:
+            return None
+        times = [attributes[name] for name in ('departure_time', 'arrival_time') if attributes.get(name)]
+        if not times:
+            return None
+        try:
+            return max(datetime.datetime.fromisoformat(when).timestamp() for when in times) + grace
+        except (ValueError, TypeError):
+            return None
+
+    def expired(self,resource):
+        deadline = self.deadline(resource['type'],resource.get('attributes') or {})
+        return deadline is not None and deadline <= time.time()
+
+    def start(self,config,client):
+        self.config = config
+        self.client = client
+        store.listen(self.track)
+        self.thread = threading.Thread(target=self.run,name="evictions",daemon=True)
+        self.thread.start()
+
+    def track(self,changes):
+        with self.changed:
+            for (key, old, new) in changes:
+                if key[0] not in type_options or 'evict_after' not in type_options[key[0]]:
+                    continue
+                deadline = self.deadline(key[0],new.attributes) if new else None
+                if deadline is None:
+                    self.deadlines.pop(key,None)
+                elif self.deadlines.get(key) != deadline:
+                    self.deadlines[key] = deadline
+                    heapq.heappush(self.due,(deadline, key))
+            self.changed.notify()
+
+    def run(self):
+        while True:
+            with self.changed:
+                while True:
+                    # Skip ones that are gone, or have a new deadline.
+                    while self.due and self.deadlines.get(self.due[0][1]) != self.due[0][0]:
+                        heapq.heappop(self.due)
+                    wait = self.due[0][0] - time.time() if self.due else None
+                    if wait is not None and wait <= 0:
+                        break
+                    self.changed.wait(wait)
+                (deadline, key) = heapq.heappop(self.due)
+                del self.deadlines[key]
+            try:
+                self.evict(self.config,self.client,key)
+            except Exception as ex:
+                logging.error(f"MQTT: Couldn't evict '{key[0]} {key[1]}': {ex}")
+
+    def evict(self,config,client,key):
+        # It might have been pushed back just now.
+        record = store.get(*key)
+        if record:
+            deadline = self.deadline(key[0],record.attributes)
+            if deadline and deadline > time.time():
+                return
+        store.forget(key)
+        held.cancel(key)
+        topic = entities.topic_for(key)
+        if debugging:
+            logging.debug(f"MQTT: Evicting '{key[0]} {key[1]}', which is in the past")
+        metrics.count('evictions',type=key[0])
+        if not topic:
+            # Its discovery topic's gone already, but the rest might not be.
+            for status in status_topics(config,key):
+                publish(config,client,status,payload='',qos=1,retain=True)
+        elif shards and not shards.ours(topic):
+            entities.cleared(topic)
+        else:
+            clear_entity(config,client,key,topic)
+
+evictions = Evictions()
+
+
+def deferred_imports():
+    global requests, mqtt, asyncio, concurrent, http, PacketTypes
+    import requests
+    import paho.mqtt.client as mqtt
+    from paho.mqtt.packettypes import PacketTypes
+    import asyncio
+    import concurrent.futures
+    import http.server
 
 
 def main():
+    global shards, mqtt5, bundles, discovery_topic
+
+    parser = argparse.ArgumentParser(description="Bridges the MBTA's real-time streaming API to MQTT (and Home Assistant).")
+    parser.add_argument('stops', nargs='*', help="MBTA stop IDs to follow, instead of the ones in the config")
+    parser.add_argument('--check-config', action='store_true', help="just check the configuration, and exit")
+    args = parser.parse_args()
 
     # Load YAML config files
     # Log config chicken/egg problem resolved by
@@ -42,6 +1762,7 @@ def main():
     except ValueError as ex:
         logging.critical(f"Config: error configuring logging. ({ex.__cause__})")
         exit(1)
+    quiet_logging()
     logging.log(25,f"::::: Starting mbta2mqtt v{VERSION}'")
 
     # spit out any messages saved from loading the config.
@@ -58,27 +1779,27 @@ def main():
 
     # Any stops on the command line _override_ the
     # config file!
-    if sys.argv[1:]:
-        config['mbta']['stops'] = sys.argv[1:]
+    if args.stops:
+        config['mbta']['stops'] = args.stops
         logging.log(25,f"Arg!: Got stop configuration from command line.")
 
     if 'stops' not in config['mbta'] or type(config['mbta']['stops']) != list:
        logging.critical(f"Config: Need a list of MBTA stops, either in the config or on the command line.")
        exit(1)
 
-    # TODO: check if the stops are valid before continuing.
-    # As currently written, the stops are given as a filter,
-    # and if nothing ever matches because your stop id is
-    # wrong, you'll just get _nothing_.
-    logging.debug(f"Config: Note that the stop list is not (currently) validated.")
+    # The stops are given as a filter, and if nothing ever matches
+    # because your stop id is wrong, you'd just get _nothing_. So,
+    # they're checked against the static data (see below), if we
+    # fetch that.
+    if not config['mbta']['static']['enabled']:
+        logging.debug(f"Config: Note that the stop list isn't validated unless 'static' is enabled.")
 
-    # Construct the MBTA API request URL based on the config
+    use_json_codec(config['engine']['json_codec'])
+    compile_templates(config)
+
+    # Construct the MBTA API request URLs based on the config
     try:
-        url = ( f"{config['mbta']['server']}"
-                f"{config['mbta']['endpoint']}"
-                f"?filter[stop]={','.join(config['mbta']['stops'])}"
-                f"&include={','.join(config['mbta']['include'])}"
-              )
+        streams = mbta_streams(config)
     except KeyError as ex:
         logging.critical(f"Config: Could not construct MBTA API header URL. (Is {ex} defined in the mbta: section?)")
         exit(1)
@@ -104,21 +1825,64 @@ def main():
         logging.critical(f"Config: MBTA v3 API key doesn't look right. Get from: https://api-v3.mbta.com/register ('{ex}' should be a 32-byte hex value.)")
         exit(1)
 
-    logging.debug(f"MBTA: API request URL: '{url}'")
+    for (name, stream) in streams.items():
+        logging.debug(f"MBTA: API request URL for '{name}': '{stream['url']}'")
     logging.log(5,f"MBTA: API request headers: '{headers}'")
 
+    if args.check_config:
+        logging.log(25,f"Config: Looks okay.")
+        exit(0)
+    deferred_imports()
+
+    # Near-static things (stops, routes, shapes...) can come from the
+    # regular API, and a cache on disk, instead of the stream.
+    static = None
+    if config['mbta']['static']['enabled']:
+        static = StaticData(config,headers)
+        static.fetch()
+        unknown = static.unknown_stops()
+        if unknown:
+            logging.critical(f"Config: The MBTA doesn't know these stops: {', '.join(unknown)}")
+            exit(1)
 
     # Start the MQTT client. `loop_start()` runs a thread
     # in the background handling this, so we can keep our
-    # main _recieve_ loop... looping.
-    mqttc = mqtt.Client(userdata=config)
+    # main _recieve_ loop... looping. It also reconnects
+    # for us if the connection drops.
+    if str(config['mqtt']['protocol']) == '5':
+        mqtt5 = MQTT5(config)
+        mqttc = mqtt.Client(userdata=config,protocol=mqtt.MQTTv5)
+    else:
+        mqttc = mqtt.Client(userdata=config)
     mqttc.on_connect = mqtt_connect
     mqttc.on_disconnect = mqtt_disconnect
     mqttc.on_publish = mqtt_publish
+    # paho has its own (much smaller) default limit, which would
+    # otherwise quietly shrink our publish window.
+    mqttc.max_inflight_messages_set(max(config['mqtt']['publish_window'],1))
+    mqttc.reconnect_delay_set(min_delay=config['mqtt']['reconnect']['initial'],
+                              max_delay=config['mqtt']['reconnect']['maximum'])
+    published.size = config['mqtt']['dedup_cache_size']
+    remembered = load_snapshot(config)
+
+    # "last will" message — if we're disconnected, this should
+    # be sent automatically. (This has to be set up before connecting.)
+    mqttc.will_set(topic=status_topic(config),payload="offline",qos=1,retain=True)
+
     try:
-        mqttc.connect(config['mqtt']['host'],
-                  port=config['mqtt']['port'],
-                  keepalive=config['mqtt']['keepalive'])
+        if mqtt5:
+            # Tell the broker how many aliases it may use for us, too.
+            # (We don't use them for what we receive, but it asks.)
+            properties = mqtt.Properties(PacketTypes.CONNECT)
+            properties.TopicAliasMaximum = 0
+            mqttc.connect(config['mqtt']['host'],
+                      port=config['mqtt']['port'],
+                      keepalive=config['mqtt']['keepalive'],
+                      properties=properties)
+        else:
+            mqttc.connect(config['mqtt']['host'],
+                      port=config['mqtt']['port'],
+                      keepalive=config['mqtt']['keepalive'])
     except OSError as ex:
         logging.critical(f"Could not connect to MQTT Broker '{config['mqtt']['host']}:{config['mqtt']['port']}': {ex}")
         exit(1)
@@ -127,105 +1891,1246 @@ def main():
 
 
     # set ourselves as online
-    mqttc.publish(topic=f"{config['mqtt']['prefix']}/status",payload="online",qos=1,retain=True).wait_for_publish()
+    mqttc.publish(topic=status_topic(config),payload="online",qos=1,retain=True).wait_for_publish()
 
-    # "last will" message — if we're disconnected, this should
-    # be sent automatically
-    mqttc.will_set(topic=f"{config['mqtt']['prefix']}/status",payload="offline",qos=1,retain=True)
+    # With sharding, find out who else is around, and who has which
+    # stops. The streams wait until we have some. (This has to come
+    # before the discovery topics, so we know whose those are.)
+    if config['sharding']['instance']:
+        shards = Shards(config,mqttc)
+        shards.subscribe(mqttc,wait=True)
+
+    if config['homeassistant']['discovery'] == 'device':
+        bundles = DeviceBundles(config,mqttc)
 
     # Subscribe to our own Home Assistant discovery topics. We need this so
     # we can clean them up when they're no longer valid. (Like, when we get a 
     # "reset" event.) The lock is how we wait for the broker to acknowledge
     # our subscription.
-    discovery_wildcard = f"{config['homeassistant']['discovery_prefix']}/+/{config['homeassistant']['node_id']}/+/config"
-    mqttc.message_callback_add(discovery_wildcard, mqtt_discovery_message)
-    mqtt_subscribe_wait(mqttc, discovery_wildcard)
-
-    # Pre-compiled regex for splitting individual events from the streaming api.
-    # See:
-    # *  https://www.mbta.com/developers/v3-api/streaming
-    # * https://developer.mozilla.org/en-US/docs/Web/API/Server-sent_events/Using_server-sent_events
-    eventsplit = re.compile('^(?:: keep-alive\n)*event: (.*)\ndata: (.*)')
+    discovery_topic = discovery_matcher(config)
+    for discovery_wildcard in discovery_wildcards(config):
+        mqttc.message_callback_add(discovery_wildcard, mqtt_discovery_message)
+        mqtt_subscribe_wait(mqttc, discovery_wildcard)
+
+    # Being subscribed doesn't mean we've got all the retained ones yet,
+    # and the first reset needs to know about all of them to find the
+    # zombies. So, wait for the broker to catch up.
+    mqtt_sync(mqttc,config)
+    logging.log(15,f"HA: Found {len(entities.known())} discovery topics on the broker")
+    if shards:
+        # By now we've heard about every lease there is, so we won't
+        # take a stop someone else still has.
+        shards.start()
+
+    # If the broker doesn't have what we left there, it's lost its
+    # retained messages (restarted without persistence, maybe), and what
+    # the snapshot says it has is wrong. The discovery topics only tell
+    # us if we left them there — with `clear_on_exit`, we cleared them
+    # ourselves — so failing that, look for some of our state topics.
+    if published.hashes and not remembered & {DeviceBundles.split(topic)[0] for topic in entities.known()} \
+            and not mqtt_retained(mqttc,config,snapshot_probes(config)):
+        logging.warning(f"Snapshot: The broker doesn't have any of our entities any more, so ignoring the snapshot.")
+        published.hashes.clear()
+
+    metrics_reporter(config,mqttc)
+    profiler.setup(config,mqttc)
+
+    boards = None
+    if config['departures']['count']:
+        boards = DepartureBoards(config,mqttc)
+        store.listen(boards.changed)
+
+    # This goes first, so the streams' resets don't decide the static
+    # entities are leftovers.
+    if static:
+        static.publish(mqttc)
+        static.start(mqttc)
+
+    evictions.start(config,mqttc)
 
     # And here's the main loop — connect, process events, publish!
-    requests_session = requests.Session()
     rc=0
     try:
-        with requests_session.get(url, headers=headers, stream=True, timeout=(30.05,60)) as result:
+        match config['engine']['mode']:
+            case 'async':
+                run_async(config,mqttc,streams,headers)
+            case _:
+                run_sync(config,mqttc,streams,headers)
+    except requests.RequestException as ex:
+        # Network trouble is retried (see `mbta_events()`), so this
+        # is something retrying won't fix, like a bad API key.
+        logging.critical(f"MBTA: Error accessing the MBTA API: {ex}")
+        rc=2
+    except KeyboardInterrupt:
+        logging.info(f"::::: Keyboard interrupt. Shutting down.")
+
+    logging.debug(f"::::: Cleanup initiated.")
+    if broker.is_set():
+        if shards:
+            # The others will take over what's ours once we say we're
+            # offline, so leave everything be.
+            shards.release_all()
+        elif config['homeassistant']['clear_on_exit']:
+            clear_entities(config,mqttc,entities.known())
+            if boards:
+                boards.clear()
+        publish_wait()
+        logging.log(15,f"MQTT: Payload cache: {published.stats()}")
+        mqttc.publish(topic=status_topic(config),payload="offline",qos=1,retain=True).wait_for_publish()
+    else:
+        logging.warning(f"MQTT: Not connected to the broker, so can't clean up entities.")
+    if published.snapshot:
+        published.snapshot.close()
+    mqttc.disconnect()
+    logging.log(25,f"::::: Exited cleanly.")
+    exit(rc)
+
+
+class ArraySplitter:
+    """Splits a JSON array up into its elements, and decodes each one, while
+       the array is still arriving — so a huge one (like a reset's) can be
+       dealt with an element at a time, without the whole thing, raw or
+       decoded, ever being in memory at once.
+
+       Objects (which is all the MBTA sends) are found by looking for a `}`
+       followed by `,{` or `]`, where there are as many `{`s as `}`s since
+       the object started; whatever that is, if the configured codec can
+       decode it, it's the whole object. (JSON objects never start with
+       another whole object.) If it can't (there were braces in strings),
+       and for anything that isn't an object, the standard library's
+       decoder works out where the element ends.
+    """
+
+    __slots__ = ('buffer', 'opened', 'closed', 'start', 'scanned', 'depth', 'slow')
+
+    decoder = json.JSONDecoder()
+    ends = re.compile(rb'\}\s*(?:,\s*\{|\])')
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.opened = False     # seen the '['
+        self.closed = False     # seen the ']'
+        self.start = None       # where the element we're in starts
+        self.scanned = 0        # braces counted up to here
+        self.depth = 0
+        self.slow = False       # counting braces didn't work for this one
+
+    def feed(self,data,final=False):
+        """Adds `data`, and returns the elements it completes, decoded."""
+
+        if self.closed:
+            return []
+        buffer = self.buffer
+        buffer += data
+        items = []
+        pos = 0
+        while True:
+            if self.start is None:
+                # Between elements: whitespace and commas (and the '[').
+                while pos < len(buffer):
+                    if buffer[pos] in b' \t\r\n,':
+                        pos += 1
+                    elif buffer[pos] == 91 and not self.opened: # '['
+                        self.opened = True
+                        pos += 1
+                    else:
+                        break
+                if pos == len(buffer):
+                    break
+                if buffer[pos] == 93: # ']'
+                    self.closed = True
+                    pos = len(buffer)
+                    break
+                self.start = self.scanned = pos
+                self.depth = 0
+                self.slow = buffer[pos] != 123 # '{'
+            end = self.decoded(buffer,items,final) if self.slow else self.counted(buffer,items)
+            if end < 0:
+                if self.slow or not final:
+                    break
+                # (The last one, with no ']' after it.)
+                self.slow = True
+                continue
+            (pos, self.start) = (end, None)
+
+        # Keep just the element we're in the middle of.
+        if self.start is None:
+            del buffer[:pos]
+        else:
+            del buffer[:self.start]
+            self.scanned -= self.start
+            self.start = 0
+        return items
+
+    def finish(self):
+        """The array's done (or ought to be); returns whatever's left."""
+        return self.feed(b'',True)
+
+    def counted(self,buffer,items):
+        """Where the object we're in ends (after adding it to `items`), or
+           -1 if it isn't all here yet."""
+        while end := self.ends.search(buffer,self.scanned):
+            close = end.start() + 1
+            self.depth += buffer.count(b'{',self.scanned,close) - buffer.count(b'}',self.scanned,close)
+            self.scanned = close
+            if self.depth <= 0:
+                try:
+                    items.append(json_loads(buffer[self.start:close]))
+                    return close
+                except json_errors:
+                    self.slow = True
+                    return self.decoded(buffer,items,False)
+        return -1
+
+    def decoded(self,buffer,items,final):
+        text = buffer[self.start:].decode('utf-8','surrogateescape')
+        try:
+            (item, end) = self.decoder.raw_decode(text)
+        except ValueError as ex:
+            if not final:
+                # Probably just not all here yet.
+                return -1
+            logging.warning(f"MBTA JSON response not decoded. {ex}")
+            return len(buffer)
+        # (A number isn't finished until we see what's after it: "2" might
+        # be the start of "2.5".)
+        if not final and (end == len(text) or text[end] not in ' \t\r\n,]'):
+            return -1
+        items.append(item)
+        return self.start + len(text[:end].encode('utf-8','surrogateescape'))
+
+
+class SSEParser:
+    """An incremental parser for the server-sent event stream format. Feed
+       it bytes as they arrive, and it hands back each complete event as
+       (event name, data, last event id) — with the data still as bytes,
+       ready for the JSON decoder. It follows the whole grammar: CR, LF, or
+       CRLF line endings, several `data:` lines per event, `id:` and
+       `retry:` fields, and comments (like the MBTA's keep-alives).
+       See:
+       *  https://www.mbta.com/developers/v3-api/streaming
+       * https://html.spec.whatwg.org/multipage/server-sent-events.html#event-stream-interpretation
+
+       Events named in `split` whose data is a JSON array (resets, which
+       can run to megabytes) are handed back a piece at a time instead, as
+       the array arrives: '<name>:begin', then '<name>:item' for each
+       element (already decoded; see `ArraySplitter`), then '<name>:end'
+       — or, if the stream goes away first, '<name>:abandon', from
+       `close()`.
+    """
 
+    __slots__ = ('buffer', 'scanned', 'first', 'cr', 'skip_lf', 'event', 'data', 'last_id', 'retry', 'comments',
+                 'split', 'array', 'partial')
+
+    def __init__(self,split=()):
+        self.buffer = bytearray()
+        self.scanned = 0        # no line endings in buffer[:scanned]
+        self.first = True       # might need to skip a byte order mark
+        self.cr = False         # have we seen any CRs at all?
+        self.skip_lf = False    # last chunk ended with CR, which might be half of CRLF
+        self.event = b''
+        self.data = []
+        self.last_id = ''
+        self.retry = None       # milliseconds, if the server told us
+        self.comments = 0       # how many (keep-alives, mostly) we've seen
+        self.split = {name.encode('utf-8') for name in split}
+        self.array = None       # the ArraySplitter for this event, if we're splitting it
+        self.partial = False    # partway through one of its data lines
+
+    def feed(self,chunk):
+        """Adds `chunk` to what we have, and returns any events it completes."""
+
+        buffer = self.buffer
+        buffer += chunk
+        if self.first and len(buffer) >= 3:
+            if buffer.startswith(b'\xef\xbb\xbf'):
+                del buffer[:3]
+            self.first = False
+        if not self.cr and b'\r' in chunk:
+            self.cr = True
+
+        events = []
+        start = 0
+        if self.skip_lf and buffer[:1] == b'\n':
+            start = 1
+        self.skip_lf = False
+        # Slicing a memoryview doesn't copy, so each line's value
+        # gets copied out of the buffer exactly once.
+        with memoryview(buffer) as view:
+            while True:
+                end = buffer.find(b'\n', max(start,self.scanned))
+                if self.cr:
+                    # (Almost nobody uses bare CRs, so we only go looking
+                    # for them once we know we have to.)
+                    cr = buffer.find(b'\r', max(start,self.scanned), end if end >= 0 else len(buffer))
+                    if cr >= 0:
+                        end = cr
+                if end < 0:
+                    # A data line we're splitting doesn't have to be all
+                    # here before we start on it.
+                    value = self.splittable(buffer,start,len(buffer))
+                    if value >= 0:
+                        self.splitting(events,view[value:])
+                        self.partial = True
+                        start = len(buffer)
+                    break
+
+                value = self.splittable(buffer,start,end)
+                if value >= 0:
+                    self.splitting(events,view[value:end])
+                    self.partial = False
+                elif end == start:
+                    # A blank line means the event is done.
+                    if self.array:
+                        name = self.event.decode('utf-8')
+                        events.extend((f"{name}:item", item, self.last_id) for item in self.array.finish())
+                        events.append((f"{name}:end", None, self.last_id))
+                        self.array = None
+                    if self.data:
+                        data = self.data[0] if len(self.data) == 1 else b'\n'.join(self.data)
+                        events.append((self.event.decode('utf-8') or 'message', data, self.last_id))
+                    self.event = b''
+                    self.data = []
+                elif buffer[start] == 58: # ':'
+                    self.comments += 1
+                elif buffer.startswith(b'data:',start,end):
+                    value = start + 5
+                    if value < end and buffer[value] == 32:
+                        value += 1
+                    self.data.append(bytes(view[value:end]))
+                else:
+                    self.field(bytes(view[start:end]))
+
+                start = end + 1
+                if buffer[end] == 13:
+                    if start == len(buffer):
+                        self.skip_lf = True
+                    elif buffer[start] == 10:
+                        start += 1
+
+        del buffer[:start]
+        self.scanned = len(buffer)
+        return events
+
+    def splittable(self,buffer,start,end):
+        """Where the value starts, if this line is (or might turn out to
+           be) data for an event we're splitting, or else -1."""
+
+        if self.partial:
+            return start
+        if self.event not in self.split or not buffer.startswith(b'data:',start,end):
+            return -1
+        value = start + 5
+        if value < end and buffer[value] == 32:
+            value += 1
+        # Only if it's an array (and the first data line) to begin with.
+        if not self.array and (self.data or value >= end or buffer[value] != 91):
+            return -1
+        return value
+
+    def splitting(self,events,value):
+        """Hands (some of) a data line to the event's ArraySplitter."""
+
+        name = self.event.decode('utf-8')
+        if not self.array:
+            self.array = ArraySplitter()
+            events.append((f"{name}:begin", None, self.last_id))
+        elif not self.partial:
+            # (Data lines are joined with newlines.)
+            self.array.feed(b'\n')
+        events.extend((f"{name}:item", item, self.last_id) for item in self.array.feed(value))
+
+    def close(self):
+        """The stream's gone. Returns an ':abandon' for any event we were
+           partway through splitting."""
+
+        events = []
+        if self.array:
+            events.append((f"{self.event.decode('utf-8')}:abandon", None, self.last_id))
+            self.array = None
+            self.partial = False
+        return events
+
+    def field(self,line):
+        """Fields other than `data:`, which are all short."""
+
+        (field, colon, value) = line.partition(b':')
+        if value[:1] == b' ':
+            value = value[1:]
+        match field:
+            case b'event':
+                self.event = value
+            case b'data':
+                # (`data` with no colon at all)
+                self.data.append(value)
+            case b'id':
+                if b'\0' not in value:
+                    self.last_id = value.decode('utf-8')
+            case b'retry':
+                if value.isdigit():
+                    self.retry = int(value)
+            # anything else, the spec says to ignore
+
+
+class StaticData:
+    """Resources that hardly ever change — stops, routes, lines, shapes,
+       services — fetched with plain API requests instead of coming
+       through the stream over and over. Each query's response is kept
+       on disk with its `Last-Modified` time, so after that we only ask
+       whether it's changed (`If-Modified-Since`), and if the API can't
+       be reached, we use what we have.
+
+       These are published as if they came from a stream called
+       'static', which resets whenever anything changes.
+    """
+
+    def __init__(self,config,headers):
+        self.config = config
+        self.static = config['mbta']['static']
+        self.headers = dict(headers,Accept="application/vnd.api+json")
+        self.session = requests.Session()
+        self.directory = self.static['directory'] or os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),'mbta2mqtt','static')
+        self.documents = {}     # query name -> the API's response
+        self.available = False  # did we get anything at all?
+
+    def fetch(self):
+        """Fetches (or re-checks) every query. True if anything changed."""
+
+        changed = False
+        values = {'stops': ','.join(self.config['mbta']['stops']), 'routes': ''}
+        for (name, query) in self.static['fetch'].items():
+            filters = self.filters(name,query,values)
+            if filters is None:
+                continue
+            if query.get('include'):
+                filters.append(f"include={','.join(query['include'])}")
+            url = f"{self.config['mbta']['server']}{query['endpoint']}?{'&'.join(filters)}"
+            (document, modified) = self.fetch_one(name,url)
+            if document is not None:
+                self.documents[name] = document
+                changed |= modified
+                # Later queries can use the routes we've found so far.
+                values['routes'] = ','.join(sorted({r['id'] for r in self.resources() if r['type'] == 'route'}))
+        self.available = bool(self.documents)
+        return changed
+
+    @staticmethod
+    def filters(name,query,values):
+        """A query's filters, filled in from `values` — or None, if any of
+           them can't be (yet)."""
+        filters = []
+        for (key, value) in (query.get('filter') or {}).items():
+            if type(value) == list:
+                value = ','.join(value)
+            try:
+                value = str(value).format(**values)
+            except (KeyError, IndexError, ValueError) as ex:
+                logging.error(f"Config: Can't fill in filter[{key}] for static query '{name}' ({ex}), so skipping it.")
+                return None
+            if not value:
+                # Like `{routes}`, if the queries before didn't find any.
+                # An empty filter would mean everything, not nothing.
+                logging.warning(f"MBTA: Nothing to filter static '{name}' by {key} (yet), so skipping it.")
+                return None
+            filters.append(f"filter[{key}]={value}")
+        return filters
+
+    def fetch_one(self,name,url):
+        """Returns the response for one query, and whether it's new."""
+
+        path = os.path.join(self.directory,f"{name}.json")
+        cached = None
+        try:
+            with open(path,'rb') as f:
+                cached = json_loads(f.read())
+            if cached.get('url') != url:
+                cached = None
+        except (OSError, AttributeError, *json_errors):
+            pass
+
+        headers = dict(self.headers)
+        if cached and cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+        try:
+            result = self.session.get(url,headers=headers,timeout=(30.05,60))
+            if result.status_code == 304:
+                logging.log(15,f"MBTA: Static '{name}' hasn't changed since {cached['last_modified']}")
+                metrics.count('static_fetches',query=name,result='unchanged')
+                return (cached['document'], False)
             result.raise_for_status()
+            document = json_loads(result.content)
+        except (requests.RequestException, *json_errors) as ex:
+            metrics.count('static_fetches',query=name,result='error')
+            if cached:
+                logging.warning(f"MBTA: Couldn't fetch static '{name}', so using the copy from {cached.get('last_modified')}: {ex}")
+                return (cached['document'], False)
+            logging.error(f"MBTA: Couldn't fetch static '{name}': {ex}")
+            return (None, False)
+
+        metrics.count('static_fetches',query=name,result='changed')
+        logging.log(15,f"MBTA: Fetched static '{name}' ({len(result.content)} bytes)")
+        cache = json_dumps({'url': url, 'last_modified': result.headers.get('Last-Modified'), 'document': document})
+        try:
+            os.makedirs(self.directory,exist_ok=True)
+            with open(f"{path}.{os.getpid()}",'wb') as f:
+                f.write(cache if type(cache) == bytes else cache.encode('utf-8'))
+            os.replace(f"{path}.{os.getpid()}",path)
+        except OSError as ex:
+            logging.warning(f"MBTA: Couldn't save static '{name}' to '{path}': {ex}")
+        return (document, True)
+
+    def resources(self):
+        """Everything, from all of the queries, once each."""
+        found = {}
+        for document in self.documents.values():
+            for resource in (document.get('data') or []) + (document.get('included') or []):
+                found[(resource['type'], resource['id'])] = resource
+        return list(found.values())
+
+    def unknown_stops(self):
+        """Configured stops the MBTA doesn't have. (If we couldn't get
+           the stop list at all, we can't say, so that's none.)"""
+        if not self.available:
+            logging.warning(f"Config: Couldn't get static data, so not checking the stop list.")
+            return []
+        known = {r['id'] for r in self.resources() if r['type'] == 'stop'}
+        return [stop for stop in self.config['mbta']['stops'] if stop not in known]
+
+    def publish(self,client):
+        if self.available:
+            handle_event(self.config,client,'static','reset',self.resources())
+
+    def start(self,client):
+        """Re-checks every `refresh` seconds, in a thread of its own."""
+        def refresh():
+            while True:
+                time.sleep(self.static['refresh'])
+                try:
+                    if self.fetch():
+                        self.publish(client)
+                except Exception as ex:
+                    # Try again next time, rather than never again.
+                    logging.error(f"MBTA: Couldn't refresh static data: {ex}")
+        if self.static['refresh']:
+            threading.Thread(target=refresh,name="static",daemon=True).start()
+
+
+def mbta_streams(config):
+    """Works out the streams we should subscribe to, filling in defaults,
+       and stores the result back in `config['mbta']['streams']`.
+
+       With no `streams` configured, that's the one stream it's always
+       been: `endpoint`, filtered by `stops`, with the `include` list.
+       Streams without a `filter` are filtered by `stops`, too.
+    """
 
-            logging.log(25,f"MBTA: Connected to API stream at '{config['mbta']['server']}{config['mbta']['endpoint']}'")
+    configured = config['mbta'].get('streams') or {}
+    if not configured:
+        configured = {'predictions': {'endpoint': config['mbta']['endpoint'],
+                                      'include': config['mbta']['include']}}
+
+    streams = {}
+    for (name, stream) in configured.items():
+        stream = dict(stream or {})
+        stream['by_stop'] = not stream.get('filter')
+        if stream.get('include') and config['mbta']['static']['enabled']:
+            # Those come from `StaticData` instead.
+            stream['include'] = [i for i in stream['include'] if i not in config['mbta']['static']['exclude']]
+        stream['url'] = stream_url(config,stream,config['mbta']['stops'])
+        streams[str(name)] = stream
+
+    config['mbta']['streams'] = streams
+    return streams
+
+
+def stream_url(config,stream,stops):
+    """The URL for a stream — filtered by `stops`, unless it has a filter
+       of its own."""
+
+    query = []
+    for (key, value) in (stream.get('filter') or {'stop': stops}).items():
+        if type(value) == list:
+            value = ','.join(value)
+        query.append(f"filter[{key}]={value}")
+    if stream.get('include'):
+        query.append(f"include={','.join(stream['include'])}")
+    return f"{config['mbta']['server']}{stream['endpoint']}?{'&'.join(query)}"
+
+
+def mbta_events(config,stream,headers):
+    """Connects to one MBTA streaming API endpoint, and yields each
+       server-sent event as it comes in: the event name, the data
+       (still as bytes), and when it arrived.
+
+       If the connection fails, drops, or stalls, this waits a bit
+       (longer each time, with some randomness so we don't all pile on
+       at once), and connects again. Reconnecting gets us a 'reset',
+       but since we remember what we've already published, that only
+       sends what changed in the meantime. Errors which retrying can't
+       fix (like a bad API key) are raised.
+    """
 
-            # the server-sent events are separated by blank lines.
-            for chunk in result.iter_lines(delimiter=b'\n\n'):
+    requests_session = requests.Session()
+    watchdog = StallWatchdog(config,stream)
+    watchdogs[stream] = watchdog
+    attempt = 0
+    retry = None
+    parser = None
+    try:
+        while True:
+            url = config['mbta']['streams'][stream]['url']
+            if shards:
+                # Which stops (if any) are ours can change. See `Shards`.
+                url = shards.stream_url(stream)
+            try:
+                with requests_session.get(url, headers=headers, stream=True, timeout=(30.05,60)) as result:
+
+                    result.raise_for_status()
+
+                    logging.log(25,f"MBTA: Connected to API stream '{stream}' at '{config['mbta']['server']}{config['mbta']['streams'][stream]['endpoint']}'")
+                    watchdog.watch(result)
+
+                    # Reading whatever arrives (rather than whole lines at
+                    # a time) means we see keep-alives as soon as they come.
+                    # Resets come a resource at a time. (See `StreamReset`.)
+                    parser = SSEParser(split=('reset',))
+                    for data in result.iter_content(chunk_size=None):
+                        received = time.monotonic()
+                        comments = parser.comments
+                        started = profiler.begin()
+                        events = parser.feed(data)
+                        profiler.end('parse',started)
+                        watchdog.alive(keepalives=parser.comments-comments)
+                        attempt = 0
+                        retry = parser.retry
+                        for (event, data, last_id) in events:
+                            yield (event, data, received)
+                        # Time spent dealing with what we got isn't time
+                        # the stream was quiet.
+                        watchdog.alive()
+
+                if not watchdog.restart:
+                    logging.warning(f"MBTA: Stream '{stream}' ended.")
+            except requests.HTTPError as ex:
+                # 4xx means we asked for something wrong. Except for
+                # "slow down", trying again won't help.
+                if 400 <= ex.response.status_code < 500 and ex.response.status_code != 429:
+                    raise
+                logging.error(f"MBTA: Error from the MBTA API for stream '{stream}': {ex}")
+            except requests.RequestException as ex:
+                if watchdog.stalled:
+                    logging.error(f"MBTA: Stream '{stream}' stalled.")
+                elif not watchdog.restart:
+                    logging.error(f"MBTA: Error accessing the MBTA API for stream '{stream}': {ex}")
+            finally:
+                watchdog.unwatch()
+            if parser:
+                for (event, data, last_id) in parser.close():
+                    yield (event, data, time.monotonic())
+                parser = None
+
+            if watchdog.restarting():
+                logging.info(f"MBTA: Reconnecting stream '{stream}' with a new filter.")
+                continue
+
+            metrics.count('stream_reconnects',stream=stream)
+            delay = min(config['mbta']['reconnect']['maximum'],config['mbta']['reconnect']['initial'] * 2**attempt) * random.uniform(0.5,1)
+            if retry:
+                # The server can ask us to wait at least so long.
+                delay = max(delay,retry/1000)
+            attempt += 1
+            logging.info(f"MBTA: Reconnecting stream '{stream}' in {delay:.1f}s.")
+            time.sleep(delay)
+    finally:
+        watchdog.stop()
+
+
+class StallWatchdog:
+    """Notices when a stream has gone quiet for too long, and hangs up on it.
+
+       When there's nothing else to say, the MBTA sends a `: keep-alive`
+       comment every so often. We learn how often, and if a few of those
+       intervals (`mbta: stall: factor`) go by with nothing at all, the
+       connection is probably dead. That's usually a lot sooner than the
+       60-second read timeout would tell us. Until we've seen a couple
+       of keep-alives, we just leave it to the timeout.
+    """
 
-                # There seem to be "blank" messages at the end of every batch.
-                # We're just skipping those.
-                if chunk == b'':
-                    logging.log(5,"MBTA --------------------------------------------------------------------------------")
-                    continue
+    def __init__(self,config,stream):
+        self.stream = stream
+        self.factor = config['mbta']['stall']['factor']
+        self.minimum = config['mbta']['stall']['minimum']
+        self.lock = threading.Lock()
+        self.sock = None
+        self.stalled = False
+        self.restart = False
+        self.interval = None
+        self.last_keepalive = None
+        self.last_activity = time.monotonic()
+        self.stopped = threading.Event()
+        threading.Thread(target=self.run,name=f"watchdog-{stream}",daemon=True).start()
+
+    def watch(self,result):
+        # There's no public way to get at the socket, and
+        # this is the one thing we really need it for.
+        try:
+            sock = result.raw._fp.fp.raw._sock
+        except AttributeError:
+            logging.debug(f"MBTA: Can't find the socket for stream '{self.stream}', so no stall detection.")
+            sock = None
+        with self.lock:
+            self.sock = sock
+            self.stalled = False
+            self.last_keepalive = None
+            self.last_activity = time.monotonic()
+
+    def unwatch(self):
+        with self.lock:
+            self.sock = None
+
+    def alive(self,keepalives=0):
+        now = time.monotonic()
+        with self.lock:
+            self.last_activity = now
+            if keepalives:
+                if self.last_keepalive is not None:
+                    interval = now - self.last_keepalive
+                    if self.interval is None:
+                        self.interval = interval
+                    else:
+                        self.interval = 0.8 * self.interval + 0.2 * interval
+                self.last_keepalive = now
+
+    def stop(self):
+        self.stopped.set()
 
-                # Split chunks from the stream into individual events 
+    def hang_up(self):
+        """Hangs up now, so we reconnect right away — with a new URL."""
+        with self.lock:
+            self.restart = True
+            if self.sock:
                 try:
-                    event, data = eventsplit.match(chunk.decode('UTF-8')).groups()
-                except:
-                    logging.warning("Skipping an entirely unexpected response from the MBTA streaming API.")
-                    logging.debug(f"'{chunk.decode('UTF-8')}'")
+                    self.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                self.sock = None
+
+    def restarting(self):
+        with self.lock:
+            (restart, self.restart) = (self.restart, False)
+            return restart
+
+    def run(self):
+        while not self.stopped.wait(1):
+            with self.lock:
+                if self.sock is None or self.interval is None:
                     continue
+                limit = max(self.minimum,self.factor * self.interval)
+                quiet = time.monotonic() - self.last_activity
+                if quiet > limit:
+                    logging.warning(f"MBTA: Nothing from stream '{self.stream}' in {quiet:.0f}s (keep-alives come every {self.interval:.0f}s or so). Hanging up.")
+                    self.stalled = True
+                    try:
+                        self.sock.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+                    self.sock = None
 
 
-                logging.log(15,f"MBTA {event} event")
-                logging.log(5,f"MBTA {event} json: \"{data}\"")
+# The watchdog for each stream, so `Shards` can hang up on them.
+watchdogs = {}
 
-                try:
-                    resource = json.loads(data)
-                except json.decoder.JSONDecodeError as ex:
-                    logging.warning(f"MBTA JSON response not decoded. {ex}")
-                    continue
 
+def decode_event(event,data):
+    """JSON-decodes an event's data. Returns None if that doesn't work out."""
+
+    if event.startswith('reset:'):
+        # Already decoded, or nothing to decode. (See `SSEParser`.) Only
+        # the beginning and end are worth a line each, not every resource.
+        if verbose and event != 'reset:item':
+            logging.log(15,f"MBTA {event} event")
+        return (event, data)
+    if verbose:
+        logging.log(15,f"MBTA {event} event")
+    if tracing:
+        logging.log(5,f"MBTA {event} json: \"{data}\"")
+
+    started = profiler.begin()
+    try:
+        resource = json_loads(data)
+    except json_errors as ex:
+        logging.warning(f"MBTA JSON response not decoded. {ex}")
+        return None
+    finally:
+        profiler.end('decode',started)
+
+    return (event, resource)
+
+
+def handle_event(config,client,stream,event,resource,received=None):
+    """Does whatever an event from the MBTA asks for."""
+
+    started = profiler.begin()
+    try:
+        dispatch_event(config,client,stream,event,resource,received)
+    finally:
+        profiler.end('handle',started)
+
+
+def dispatch_event(config,client,stream,event,resource,received):
+    """`handle_event()`, apart from timing it. (See `Profiler`.)"""
+
+    event_context.received = received
+    # (A reset a resource at a time still counts as one reset.)
+    (counted, _, part) = event.partition(':')
+    if part in ('', 'begin'):
+        metrics.count('events',stream=stream,event=counted)
+    if type(resource) == dict and 'type' in resource:
+        metrics.count('resources',event=counted,type=resource['type'])
+    elif event == 'reset':
+        for r in resource:
+            metrics.count('resources',event=event,type=r['type'])
+
+    # Don't bother with anything that's already left. (See `Evictions`.)
+    if event in ('add', 'update') and evictions.expired(resource):
+        evictions.evict(config,client,(resource['type'],resource['id']))
+        return
+
+    match event:
+        case "reset":
+            # "resource" is actually plural in this case
+            reset = StreamReset(config,client,stream)
+            for r in resource:
+                reset.add(r)
+            reset.finish()
+        case "reset:begin":
+            # The same, a resource at a time. (See `SSEParser`.)
+            if stream in resets:
+                resets.pop(stream).abandon()
+            resets[stream] = StreamReset(config,client,stream)
+        case "reset:item":
+            if stream in resets:
+                resets[stream].add(resource)
+        case "reset:end":
+            if stream in resets:
+                resets.pop(stream).finish()
+        case "reset:abandon":
+            if stream in resets:
+                resets.pop(stream).abandon()
+        case "add":
+            # Add a single entity
+            store.put(resource,stream)
+            held.cancel((resource['type'],resource['id']))
+            add_entity(config,client,resource,stream)
+        case "update":
+            # just update existing entity (maybe after a bit; see
+            # `UpdateCoalescer`)
+            store.put(resource,stream)
+            if not entities.topic_for((resource['type'],resource['id'])):
+                # One we evicted, which turned out not to be gone after
+                # all. (A very late bus, say.)
+                held.cancel((resource['type'],resource['id']))
+                add_entity(config,client,resource,stream)
+            elif not held.hold(config,client,resource,stream,received):
+                update_entity(config,client,resource)
+        case "remove":
+            # Clear a single entity — right away.
+            store.remove(resource,stream)
+            held.cancel((resource['type'],resource['id']))
+            remove_entity(config,client,resource,stream)
+        case "error":
+            # Something's wrong!
+            logging.critical(f"MBTA: '{stream}' responded with error: {resource['errors'][0]['code']} ({resource['errors'][0]['status']})")
+        case _:
+            logging.warning(f"MBTA event {event} not recognized!")
+            logging.debug(f"MBTA unknown event data: {resource}")
+
+
+def run_sync(config,client,streams,headers):
+    """The simple engine: read an event, publish it, repeat. With more
+       than one stream, each gets its own thread doing that.
+    """
+
+    def run_stream(stream):
+        for (event, data, received) in mbta_events(config,stream,headers):
+            decoded = decode_event(event,data)
+            if decoded:
+                handle_event(config,client,stream,*decoded,received)
+
+    if len(streams) == 1:
+        run_stream(next(iter(streams)))
+        return
+
+    # If any stream stops, we all stop.
+    stopped = threading.Event()
+    failure = []
+    def run_thread(stream):
+        try:
+            run_stream(stream)
+        except Exception as ex:
+            failure.append(ex)
+        stopped.set()
+
+    for stream in streams:
+        threading.Thread(target=run_thread,args=(stream,),name=f"mbta-{stream}",daemon=True).start()
+    while not stopped.wait(1):
+        pass
+    if failure:
+        raise failure[0]
+
+
+class EventQueue:
+    """The bounded queue between decoding and publishing in the asyncio
+       engine. With the 'block' backpressure policy, it's plain first-in,
+       first-out, and the decoder just waits when it's full.
+
+       With 'coalesce', an update for a resource which already has an
+       update waiting replaces that one (in place), so a slow broker means
+       fewer, fresher messages rather than an ever-longer backlog. To keep
+       that safe, an add or remove drops any update still waiting for the
+       same resource, and a reset drops everything waiting from the same
+       stream, since it replaces all of that anyway.
+    """
+
+    def __init__(self,maxsize,policy):
+        self.maxsize = maxsize
+        self.policy = policy
+        self.items = collections.OrderedDict()
+        self.sequence = 0
+        self.coalesced = 0
+        self.changed = asyncio.Condition()
+
+    async def put(self,stream,event,resource,received):
+        key = None
+        async with self.changed:
+            if self.policy == 'coalesce':
+                if type(resource) == dict and 'type' in resource:
+                    resource_key = (resource['type'], resource.get('id'))
+                else:
+                    resource_key = None
                 match event:
-                    case "reset":
-                        # Need to:
-                        #   1. Clear all existing mqtt entries
-                        #   2. Loop through and add the individual resources
-                        reset_entities(mqttc)
-                        # "resource" is actually plural in this case
-                        for r in resource:
-                            add_entity(config,mqttc,r)
-                    case "add":
-                        # Add a single entity
-                        add_entity(config,mqttc,resource)
-                    case "update":
-                        # just update existing entity
-                        update_entity(config,mqttc,resource)
-                    case "remove":
-                        # Clear a single entity
-                        remove_entity(config,mqttc,resource)
-                    case "error":
-                        # Something's wrong!
-                        logging.critical(f"MBTA: Responded with error: {resource['errors'][0]['code']} ({resource['errors'][0]['status']})")
-                    case _:
-                        logging.warning(f"MBTA event {event} not recognized!")
-                        logging.debug(f"MBTA unknown event: {chunk.decode('UTF-8')}")
-    except requests.RequestException as ex:
-        # lumping these all together because we want to do the same
-        # thing in any case: exit.
-        logging.critical(f"MBTA: Error accessing the MBTA API: {ex}")
-        rc=2
-    except KeyboardInterrupt:
-        logging.info(f"::::: Keyboard interrupt. Shutting down.")
+                    case 'reset' | 'reset:begin':
+                        # (only this stream's, of course)
+                        for (waiting, item) in list(self.items.items()):
+                            if item[0] == stream:
+                                del self.items[waiting]
+                                self.coalesced += 1
+                                metrics.count('events_coalesced')
+                    case 'update' if resource_key:
+                        if resource_key in self.items:
+                            self.items[resource_key] = (stream, event, resource, received)
+                            self.coalesced += 1
+                            metrics.count('events_coalesced')
+                            return
+                        key = resource_key
+                    case 'add' | 'remove' if resource_key in self.items:
+                        del self.items[resource_key]
+                        self.coalesced += 1
+                        metrics.count('events_coalesced')
+
+            await self.changed.wait_for(lambda: len(self.items) < self.maxsize)
+            if key is None:
+                self.sequence += 1
+                key = self.sequence
+            self.items[key] = (stream, event, resource, received)
+            self.changed.notify_all()
+
+    async def get(self):
+        async with self.changed:
+            await self.changed.wait_for(lambda: self.items)
+            (key, item) = self.items.popitem(last=False)
+            self.changed.notify_all()
+            return item
+
+
+def run_async(config,client,streams,headers):
+    """The asyncio engine. Reading the stream, decoding events, and
+       publishing them are separate stages with bounded queues between
+       them, so a slow broker (or a big reset) doesn't stop us from
+       reading the socket. Every stream gets a reader; they all share
+       the rest.
+    """
 
-    logging.debug(f"::::: Cleanup initiated.")
-    reset_entities(mqttc)
-    mqttc.publish(topic=f"{config['mqtt']['prefix']}/status",payload="offline",qos=1,retain=True).wait_for_publish()
-    mqttc.disconnect()
-    logging.log(25,f"::::: Exited cleanly.")
+    asyncio.run(async_engine(config,client,streams,headers))
+
+
+async def async_engine(config,client,streams,headers):
+
+    loop = asyncio.get_running_loop()
+    received = asyncio.Queue(maxsize=config['engine']['queue_size'])
+    events = EventQueue(config['engine']['queue_size'],config['engine']['backpressure'])
+    failure = []
+
+    def reader(stream):
+        # requests is strictly synchronous, so each socket gets a thread
+        # of its own. It only ever waits on the (quick) decoding stage.
+        try:
+            for item in mbta_events(config,stream,headers):
+                asyncio.run_coroutine_threadsafe(received.put((stream, *item)),loop).result()
+        except Exception as ex:
+            failure.append(ex)
+        # None tells the next stages that's all there is. (If any
+        # stream stops, we all stop... so, the others may find that
+        # things have already been shut down.)
+        try:
+            asyncio.run_coroutine_threadsafe(received.put(None),loop).result()
+        except (RuntimeError, concurrent.futures.CancelledError):
+            pass
+
+    async def decoder():
+        while (item := await received.get()) is not None:
+            (stream, event, data, when) = item
+            decoded = decode_event(event,data)
+            if decoded:
+                await events.put(stream,*decoded,when)
+        await events.put(None,None,None,None)
+
+    async def publisher():
+        while (item := await events.get()) != (None, None, None, None):
+            # Publishing can block waiting on the broker, so that
+            # happens off of the event loop.
+            await asyncio.to_thread(handle_event,config,client,*item)
+
+    for stream in streams:
+        threading.Thread(target=reader,args=(stream,),name=f"mbta-{stream}",daemon=True).start()
+    await asyncio.gather(decoder(),publisher())
+
+    if events.coalesced:
+        logging.log(15,f"Engine: {events.coalesced} queued events were coalesced away.")
+    if failure:
+        raise failure[0]
+
+
+def metrics_reporter(config,client):
+    """Starts whatever's configured to report `metrics`: a thread that
+       publishes them as JSON (retained) to `<prefix>/metrics` every so
+       often, and/or a Prometheus endpoint.
+    """
+
+    interval = config['metrics']['interval']
+    if interval:
+        topic = f"{config['mqtt']['prefix']}/metrics"
+        if config['sharding']['instance']:
+            topic = f"{topic}/{config['sharding']['instance']}"
+        def report():
+            while True:
+                time.sleep(interval)
+                if broker.is_set():
+                    # Not through `publish()`: this shouldn't count itself,
+                    # or wait on the publish window.
+                    client.publish(topic,payload=json_dumps(metrics.as_dict()),qos=0,retain=True)
+        threading.Thread(target=report,name="metrics",daemon=True).start()
+        logging.log(15,f"MQTT: Publishing metrics to '{topic}' every {interval}s")
+
+    port = config['metrics']['prometheus_port']
+    if port:
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type','text/plain; version=0.0.4')
+                self.send_header('Content-Length',str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self,format,*args):
+                logging.log(5,f"Metrics: {self.address_string()} {format % args}")
+        try:
+            server = http.server.ThreadingHTTPServer(('',port),Handler)
+        except OSError as ex:
+            logging.error(f"Metrics: Can't listen on port {port}: {ex}")
+            return
+        threading.Thread(target=server.serve_forever,name="prometheus",daemon=True).start()
+        logging.log(15,f"Metrics: Serving Prometheus metrics on port {port}")
+
+
+def quiet_logging():
+    """The default config sets the root logger to level 1, and lets each
+       handler decide what it wants. That means every message gets built
+       (and formatted!) even if no handler wants it. So, raise the root
+       level to the lowest any handler actually wants, and note whether
+       TRACE, DEBUG, and VERBOSE are on at all.
+    """
+    global tracing, debugging, verbose
+
+    root = logging.getLogger()
+    if root.handlers:
+        lowest = min(handler.level or 1 for handler in root.handlers)
+        if lowest > root.level:
+            root.setLevel(lowest)
+    tracing = root.isEnabledFor(5)
+    debugging = root.isEnabledFor(logging.DEBUG)
+    verbose = root.isEnabledFor(15)
+
+
+def config_cache_path():
+    """Where to keep the parsed config: `$MBTA2MQTT_CONFIG_CACHE` if
+       that's set (empty turns the cache off), or the usual user cache
+       directory."""
+
+    path = os.environ.get('MBTA2MQTT_CONFIG_CACHE')
+    if path is None:
+        path = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),'mbta2mqtt','config.json')
+    return path
+
+
+def file_version(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def env_version(name):
+    # Just a hash, so the cache doesn't say what the API key is.
+    value = os.environ.get(name)
+    return None if value is None else hashlib.blake2b(value.encode('utf-8'),digest_size=16).hexdigest()
+
+
+class EnvValue:
+    """A config value from environment variables (`!ENV`). The cache only
+       keeps which variables, and what type the value turned out to be —
+       not the value itself, which might be (say) the API key — and it's
+       looked up again when the cache is used. See `env_resolve()`.
+    """
+
+    __slots__ = ('names', 'default', 'kind', 'value')
+
+    def __init__(self,names,default,value):
+        self.names = names
+        self.default = default
+        self.kind = type(value).__name__
+        self.value = value
+
+    @classmethod
+    def cached(cls,names,default,kind):
+        """One from the cache, which doesn't have the value."""
+        value = cls(names,default,None)
+        value.kind = kind
+        return value
+
+    def resolve(self):
+        """The value, from the environment as it is now. This doesn't have
+           YAML to hand (not importing it is half of what the cache is
+           for), but it knows what type YAML made of it last time."""
+        for name in self.names:
+            if name in os.environ:
+                value = os.environ[name]
+                match self.kind:
+                    case 'str':
+                        return value
+                    case 'int':
+                        return int(value.replace('_',''),0)
+                    case 'float':
+                        return float(value.replace('_',''))
+                    case 'bool':
+                        return value.lower() in ('yes', 'true', 'on', 'y')
+                    case 'NoneType':
+                        return None
+                # (Whatever else YAML can make, we'd rather parse the
+                # config again than get wrong.)
+                raise ValueError(f"can't make a {self.kind} from ${name}")
+        return self.default
+
+
+def env_resolve(value,fresh=False):
+    """A copy of `value` (a config, or part of one) with each `EnvValue` in
+       it replaced by its value — as it was when the config was read, or
+       with `fresh`, as it is in the environment now."""
+    if isinstance(value,EnvValue):
+        return value.resolve() if fresh else value.value
+    if type(value) == dict:
+        return {key: env_resolve(item,fresh) for (key, item) in value.items()}
+    if type(value) == list:
+        return [env_resolve(item,fresh) for item in value]
+    return value
+
+
+def cache_encode(value):
+    """A config (or part of one) as something JSON keeps as it is. YAML's
+       keys aren't always strings (`vehicle_types` are numbers), so those
+       dictionaries are kept as lists of pairs. Anything else YAML can
+       make (dates, say) can't be cached, and raises TypeError."""
+    if isinstance(value,EnvValue):
+        return {'!ENV': [value.names, cache_encode(value.default), value.kind]}
+    if type(value) == dict:
+        if all(type(key) == str for key in value) and not value.keys() & {'!ENV', '!pairs'}:
+            return {key: cache_encode(item) for (key, item) in value.items()}
+        for key in value:
+            if key is not None and type(key) not in (str, int, float, bool):
+                raise TypeError(f"can't cache a {type(key).__name__} key")
+        return {'!pairs': [[key, cache_encode(item)] for (key, item) in value.items()]}
+    if type(value) in (list, tuple):
+        return [cache_encode(item) for item in value]
+    if value is None or type(value) in (str, int, float, bool):
+        return value
+    raise TypeError(f"can't cache a {type(value).__name__}")
+
+
+def cache_decode(value):
+    """The other way around from `cache_encode()`."""
+    if type(value) == dict:
+        if value.keys() == {'!ENV'}:
+            (names, default, kind) = value['!ENV']
+            return EnvValue.cached(names,cache_decode(default),kind)
+        if value.keys() == {'!pairs'}:
+            return {key: cache_decode(item) for (key, item) in value['!pairs']}
+        return {key: cache_decode(item) for (key, item) in value.items()}
+    if type(value) == list:
+        return [cache_decode(item) for item in value]
+    return value
+
+
+def cached_config():
+    """The config and log messages `load_config()` came up with last time,
+       if none of the files it read (or looked for) and none of the
+       environment variables it used have changed since."""
+
+    path = config_cache_path()
+    if not path:
+        return None
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+        if cache['version'] != VERSION:
+            return None
+        for (name, version) in cache['files'].items():
+            if file_version(name) != version:
+                return None
+        for (name, version) in cache['environment'].items():
+            if env_version(name) != version:
+                return None
+        config = env_resolve(cache_decode(cache['config']),fresh=True)
+    except (OSError, KeyError, TypeError, AttributeError, ValueError):
+        return None
+    return (config, cache['config_log'] + [(10,f"Config: Used the cached copy in '{path}'",0)])
+
+
+def save_config_cache(config,config_log,files,environment):
+    path = config_cache_path()
+    if not path:
+        return
+    try:
+        cache = {'version': VERSION,
+                 'files': files,
+                 'environment': {name: env_version(name) for name in environment},
+                 'config': cache_encode(config),
+                 'config_log': config_log}
+        os.makedirs(os.path.dirname(path),exist_ok=True)
+        temporary = f"{path}.{os.getpid()}"
+        with os.fdopen(os.open(temporary,os.O_WRONLY|os.O_CREAT|os.O_TRUNC,0o600),'w') as f:
+            json.dump(cache,f)
+        os.replace(temporary,path)
+    except (OSError, TypeError, ValueError) as ex:
+        config_log.append((10,f"Config: Couldn't save the parsed config to '{path}': {ex}",0))
 
 
 def load_config():
     """Loads `defaults.conf` and other files defined there,
-       if any and if found.
+       if any and if found. If nothing's changed since last time,
+       that's just loading the cached result (see `cached_config()`).
     """
 
 
@@ -243,17 +3148,44 @@ def load_config():
     os.chdir(os.path.split(sys.argv[0])[0])
     defaultfile="defaults.conf"
 
+    cached = cached_config()
+    if cached:
+        return cached
+
+    import yaml
+    from yaml_env_tag import construct_env_tag
+
+    # The C one (if PyYAML was built with libyaml) is much faster.
+    loader = getattr(yaml,'CLoader',yaml.Loader)
+
+    # Which files we looked at (and when they were last changed), and
+    # which environment variables they used, for the cache.
+    files = {}
+    environment = set()
+
     # This lets us indicate environment variables in
-    # the config file. Handy!
-    yaml.Loader.add_constructor('!ENV', construct_env_tag)
+    # the config file. Handy! (They stay wrapped up until we're done, so
+    # the cache can leave the values out. See `EnvValue`.)
+    def env_tag(loader,node):
+        value = construct_env_tag(loader,node)
+        if isinstance(node,yaml.nodes.SequenceNode):
+            # (The last of several is the default.)
+            names = [child.value for child in node.value[:-1] or node.value]
+            default = loader.construct_object(node.value[-1]) if len(node.value) > 1 else None
+        else:
+            (names, default) = ([node.value], None)
+        environment.update(names)
+        return EnvValue(names,default,value)
+    loader.add_constructor('!ENV', env_tag)
 
     try:
+        files[os.path.abspath(defaultfile)] = file_version(defaultfile)
         with open(defaultfile) as cf:
-           config = yaml.load(cf, Loader=yaml.Loader)
+           config = yaml.load(cf, Loader=loader)
     except FileNotFoundError as ex:
         config_log.append((50,f"Config: Could not load 'defaults.conf'. We need that! It should be at '{defaultfile}' ({ex})",1))
         return (config,config_log)
-    except yaml.scanner.ScannerError as ex:
+    except yaml.YAMLError as ex:
         config_log.append((50,f"Config: Error parsing defaults. Since that shouldn't happen, bailing out now. ({ex})",1))
         return (config,config_log)
     else:
@@ -261,15 +3193,16 @@ def load_config():
     
     if "configpath" in config:
         config_log.append((5,f"Config: Looking for these files: {config['configpath']}",0))
-        for configfile in config['configpath']:
+        for configfile in env_resolve(config['configpath']):
+            files[os.path.abspath(configfile)] = file_version(configfile)
             try:
                 with open(configfile) as cf:
-                    additional_config = yaml.load(cf, Loader=yaml.Loader)
+                    additional_config = yaml.load(cf, Loader=loader)
             except FileNotFoundError:
                 config_log.append((10,f"Config: {configfile} not found. Skipping.",0))
             except IsADirectoryError:
                 config_log.append((40,f"Config: Error: config file is a directory rather than a file! ('{configfile}')" ,0))
-            except yaml.scanner.ScannerError as ex:
+            except yaml.YAMLError as ex:
                 config_log.append((40,f"Config: Error parsing config file! Skipping. ({ex})",0))
             else:
                 if additional_config:
@@ -277,20 +3210,26 @@ def load_config():
                     config_log.append((20,f"Config: Loaded configuration from {configfile}",0))
                 else:
                     config_log.append((30,f"Config: {configfile} found, but it seems empty. Hope that's okay.",0))
-            if "endconfig" in config and config["endconfig"]:
+            if "endconfig" in config and env_resolve(config["endconfig"]):
                 config_log.append((10,f"Config: Found 'endconfig' key in {configfile}. Will not look at later configuration files.",0))
                 break
 
-
-    return (config,config_log)
+    save_config_cache(config,config_log,files,environment)
+    return (env_resolve(config),config_log)
 
 def check_config(config):
     rc=0
 
     vitals = {
-        "mbta": ( "api_key", "server", "endpoint","include"),
-        "mqtt": ("host", "port", "prefix", "keepalive" ),
-        "homeassistant": ("discovery_prefix","node_id","entity")
+        "mbta": ( "api_key", "server", "endpoint","include", "reconnect", "stall", "static"),
+        "mqtt": ("host", "port", "prefix", "keepalive", "publish_window", "dedup_cache_size", "reconnect", "protocol", "topic_aliases" ),
+        "homeassistant": ("discovery_prefix","node_id","entity","clear_on_exit","discovery"),
+        "engine": ("mode", "queue_size", "backpressure", "json_codec"),
+        "metrics": ("interval", "prometheus_port"),
+        "departures": ("count",),
+        "snapshot": ("path", "interval"),
+        "sharding": ("instance",),
+        "profiling": ("directory", "seconds", "command")
 
     }
 
@@ -307,53 +3246,214 @@ def check_config(config):
                     rc=1
                     logging.critical(f"Config: '{section}' section missing required key '{vital}'")
 
+    if rc == 0:
+        if config['engine']['mode'] not in ('sync', 'async'):
+            rc=1
+            logging.critical(f"Config: engine mode should be 'sync' or 'async', not '{config['engine']['mode']}'")
+        if config['engine']['json_codec'] not in ('auto', 'orjson', 'msgspec', 'json'):
+            rc=1
+            logging.critical(f"Config: engine json_codec should be 'auto', 'orjson', 'msgspec', or 'json', not '{config['engine']['json_codec']}'")
+        if config['engine']['backpressure'] not in ('block', 'coalesce'):
+            rc=1
+            logging.critical(f"Config: engine backpressure should be 'block' or 'coalesce', not '{config['engine']['backpressure']}'")
+        if config['homeassistant']['discovery'] not in ('entity', 'device'):
+            rc=1
+            logging.critical(f"Config: homeassistant discovery should be 'entity' or 'device', not '{config['homeassistant']['discovery']}'")
+        if str(config['mqtt']['protocol']) not in ('3.1.1', '5'):
+            rc=1
+            logging.critical(f"Config: mqtt protocol should be '3.1.1' or '5', not '{config['mqtt']['protocol']}'")
+        if config['sharding']['instance'] and not re.match('^[A-Za-z0-9_-]+$',str(config['sharding']['instance'])):
+            rc=1
+            logging.critical(f"Config: sharding instance should be letters, numbers, - and _, not '{config['sharding']['instance']}'")
+
     return(rc)
 
 
-def mqtt_connect(client, userdata, flags, rc):
-    """Called when the mqtt client connects."""
+def mqtt_connect(client, userdata, flags, rc, properties=None):
+    """Called when the mqtt client connects (or reconnects).
+       (`properties` is only there with MQTT v5.)"""
+    global broker_connections
     if rc != 0:
+        # paho will keep trying.
         logging.critical(f"MQTT: Could not connect to Broker '{userdata['mqtt']['host']}:{userdata['mqtt']['port']}' — return code {rc}")
-        exit(1)
+        return
     logging.log(25,f"MQTT: Connected to Broker '{userdata['mqtt']['host']}:{userdata['mqtt']['port']}'")
-
-
-def mqtt_disconnect(client, userdata, rc):
+    broker_connections += 1
+    if mqtt5:
+        mqtt5.connected(client,properties)
+    if broker_connections > 1:
+        # The first time, `main()` does this (and waits for it). After that,
+        # we're coming back from a dropped connection: our last will will
+        # have said we're offline, and the subscription is gone. Everything
+        # we know about entities is still good, though.
+        client.publish(topic=status_topic(userdata),payload="online",qos=1,retain=True)
+        for discovery_wildcard in discovery_wildcards(userdata):
+            client.subscribe(discovery_wildcard)
+        if shards:
+            shards.subscribe(client)
+        profiler.subscribe(client)
+    broker.set()
+
+
+def mqtt_disconnect(client, userdata, rc, properties=None):
     """Called when the mqtt client disconnects, either intentionally or not."""
+    broker.clear()
     if rc != 0:
-        logging.critical(f"MQTT: Lost connection to Broker '{userdata['mqtt']['host']}:{userdata['mqtt']['port']}' ({mqtt.error_string(rc)})")
-        os._exit(3)
+        logging.error(f"MQTT: Lost connection to Broker '{userdata['mqtt']['host']}:{userdata['mqtt']['port']}' ({mqtt.error_string(rc)}). Reconnecting.")
+        # paho backs off exponentially before reconnecting, but
+        # exactly the same way every time. A little jitter keeps
+        # a bunch of us from all hammering the broker at once.
+        time.sleep(random.uniform(0,userdata['mqtt']['reconnect']['initial']))
+        return
     logging.info(f"MQTT: Disconnected from Broker '{userdata['mqtt']['host']}:{userdata['mqtt']['port']}'")    
 
 def mqtt_publish(client, userdata, mid):
-    logging.log(5,f"MQTT: message sent for publication ({mid})")  
+    """Called when a message is sent — or for QoS 1, acknowledged."""
+    metrics.acked(mid)
+    if mqtt5:
+        mqtt5.acked(mid)
+    if tracing:
+        logging.log(5,f"MQTT: message sent for publication ({mid})")
+
+def discovery_matcher(config):
+    """A compiled pattern for the topics `discovery_wildcards()` gets
+       us. `device` is set for device ones, and `ours` if that's ours."""
+    discovery_prefix = re.escape(config['homeassistant']['discovery_prefix'])
+    node_id = re.escape(config['homeassistant']['node_id'])
+    return re.compile(f"^{discovery_prefix}/(?:(?P<device>device/(?P<ours>{node_id}_stop_)?[^/]+)|[a-z0-9_-]+/{node_id}/[A-Za-z0-9_-]+)/config$")
+
+# Set up by main().
+discovery_topic = None
+
+
+def discovery_wildcards(config):
+    """Our Home Assistant discovery topics: per entity, and per device."""
+    return (f"{config['homeassistant']['discovery_prefix']}/+/{config['homeassistant']['node_id']}/+/config",
+            f"{config['homeassistant']['discovery_prefix']}/device/+/config")
+
 
 def mqtt_discovery_message(client, userdata, message):
     """Handles Home Assistant discovery messages.
-       Specifically: stash them in the `entities` queue
+       Specifically: note them in the `entities` registry
        so we can clean them up later if asked.
     """
 
-    try:
-        payload = str(message.payload.decode('utf-8'))
-    except UnicodeDecodeError as ex:
-        logging.warning(f"MQTT: Received message with topic '{message.topic}' and non-unicode payload! ({ex})")
-        logging.log(5,f"MQTT: Weird payload for '{message.topic}' is payload: '{message.payload}')")
+    # We see our own discovery messages come back, too, but
+    # we already know about those (and they might be out of
+    # date by the time they get here). The broker only sets
+    # the retain flag on the ones it had stored already.
+    # With sharding, we also need to hear about other
+    # instances' as they go by, though.
+    if not message.retain and not shards:
         return
 
-    logging.log(5,f"MQTT: Received message (topic: '{message.topic}', payload: '{payload}')")
+    # There can be tens of thousands of these at startup, so this
+    # only decodes the payload if it's going to be logged.
+    if tracing:
+        logging.log(5,f"MQTT: Received message (topic: '{message.topic}', payload: '{message.payload.decode('utf-8','replace')}')")
 
-
-    if not re.match(f"^{userdata['homeassistant']['discovery_prefix']}/[a-z0-9_-]+/[A-Za-z0-9_/-]+/config$",message.topic):
+    match = discovery_topic.match(message.topic)
+    if not match:
         logging.warning(f"MQTT: Got a message that doesn't look like a Home Assistant discovery topic ('{message.topic}')!")
         return
-    
-    if payload == '':
-        logging.log(5,f"MQTT: Skipping Home Assistant Discovery empty message ('{message.topic}')")
+
+    # Device discovery messages are only ours if they're for our node_id.
+    device = match['device']
+    if device and not match['ours']:
+        return
+
+    if message.payload == b'':
+        if shards and not message.retain:
+            if device and bundles:
+                bundles.cleared(message.topic)
+            else:
+                shards.dropped(message.topic)
+        if tracing:
+            logging.log(5,f"MQTT: Skipping Home Assistant Discovery empty message ('{message.topic}')")
         return
 
-    logging.debug(f"MQTT: Found Home Assistant Discovery Topic '{message.topic}'")
-    entities.put(message.topic)
+    # Each component is noted separately. (See `DeviceBundles`.) Without
+    # those, a device message is left over from before, and gets cleared.
+    if device and bundles:
+        if debugging:
+            logging.debug(f"MQTT: Found Home Assistant Device Discovery Topic '{message.topic}'")
+        bundles.found(message.topic,message.payload,message.retain)
+        return
+
+    # Whose is it? (Only matters with sharding.)
+    holder = None
+    if shards:
+        try:
+            payload = json_loads(message.payload)
+            holder = payload.get('availability_topic') or payload.get('avty_t')
+        except json_errors + (AttributeError,):
+            pass
+        if not message.retain and holder == shards.me:
+            return
+
+    if debugging:
+        logging.debug(f"MQTT: Found Home Assistant Discovery Topic '{message.topic}'")
+    entities.found(message.topic,PayloadCache.digest(message.payload),holder)
+
+
+def mqtt_sync(client,config,timeout=60):
+    """Waits until everything the broker had queued up for us before now
+       (like all the retained discovery messages from subscribing) has
+       been handled. The broker sends each client's messages in order,
+       and paho handles them in order, so once a message we send to
+       ourselves now comes back, everything before it is done.
+    """
+
+    token = os.urandom(8).hex()
+    topic = f"{config['mqtt']['prefix']}/sync/{token}"
+    done = threading.Event()
+
+    def on_sync(client, userdata, message):
+        if message.payload == token.encode('utf-8'):
+            done.set()
+
+    client.message_callback_add(topic,on_sync)
+    mqtt_subscribe_wait(client,topic)
+    client.publish(topic,payload=token,qos=1,retain=False)
+    if done.wait(timeout):
+        logging.debug(f"MQTT: In sync with the broker")
+    else:
+        logging.warning(f"MQTT: Didn't hear back from the broker in {timeout}s, so we may not know about all of its retained messages yet")
+    client.unsubscribe(topic)
+    client.message_callback_remove(topic)
+
+
+def snapshot_probes(config,count=10):
+    """A few state topics the snapshot says the broker has, which ought
+       to still be there: not ones for resource types which expire."""
+    probes = []
+    for topic in reversed(published.hashes):
+        parts = topic.split('/')
+        section = config['homeassistant'].get(parts[-3]) if len(parts) >= 3 else None
+        if parts[-1] == 'state' and not (type(section) == dict and section.get('message_expiry')):
+            probes.append(topic)
+            if len(probes) == count:
+                break
+    return probes
+
+
+def mqtt_retained(client,config,topics):
+    """Does the broker have a retained message for any of `topics`?"""
+
+    found = threading.Event()
+
+    def on_retained(client, userdata, message):
+        if message.retain and message.payload:
+            found.set()
+
+    for topic in topics:
+        client.message_callback_add(topic,on_retained)
+        mqtt_subscribe_wait(client,topic)
+    mqtt_sync(client,config)
+    for topic in topics:
+        client.unsubscribe(topic)
+        client.message_callback_remove(topic)
+    return found.is_set()
 
 
 def mqtt_subscribe_wait(client, topic):
@@ -362,7 +3462,7 @@ def mqtt_subscribe_wait(client, topic):
     subscribe_lock = threading.Lock()
     subscribe_lock.acquire(blocking=False)
     
-    def on_subscribe(client, userdata, mid, granted_qos):
+    def on_subscribe(client, userdata, mid, granted_qos, properties=None):
         """Called when the subscription succeeds."""
         logging.log(5,f"MQTT: Subscription succeeded with message id {mid} and qos {granted_qos}")
         subscribe_lock.release()
@@ -382,86 +3482,286 @@ def mqtt_subscribe_wait(client, topic):
 
 
 
-def reset_entities(client):
+def publish(config,client,topic,payload,qos=1,retain=True,resource=None):
+    """Publish a message without waiting for it to be acknowledged...
+       unless there are already `mqtt: publish_window` messages in flight,
+       in which case, wait for the oldest first. A window of 1 means waiting
+       on every message, which is slow but very polite.
+
+       If we've already sent exactly this payload to this topic (and
+       haven't sent anything else there since), don't bother. In that
+       case, this returns None.
 
-    logging.debug(f"MBTA: reset all resources")
+       `resource` is what a state or attributes message is for, which
+       MQTT v5 uses for its extras. (See `MQTT5`.)
+    """
+
+    # With several streams, there can be several of us in here at once.
+    # Holding the lock while waiting for the window is fine: everyone
+    # else would have to wait anyway.
+    with publish_lock:
+        expiry = mqtt5.expiry(resource,retain,payload) if mqtt5 and resource else None
+        if published.unchanged(topic,payload,expiry):
+            if tracing:
+                logging.log(5,f"MQTT: Skipping unchanged payload for '{topic}'")
+            metrics.count('publishes_skipped')
+            return None
+
+        if not broker.is_set():
+            logging.warning(f"MQTT: Waiting for the broker to come back...")
+            broker.wait()
+
+        started = profiler.begin()
+        if mqtt5:
+            info = mqtt5.publish(client,topic,payload,qos,retain,resource)
+        else:
+            info = client.publish(topic,payload=payload,qos=qos,retain=retain)
+        metrics.count('publishes')
+        if qos > 0:
+            metrics.sent(info.mid,getattr(event_context,'received',None))
+            inflight.append(info)
+            # cheaply forget about anything already taken care of
+            while inflight and acknowledged(inflight[0]):
+                inflight.popleft()
+            while len(inflight) >= config['mqtt']['publish_window'] and inflight:
+                acknowledged(inflight.popleft(),wait=True)
+        profiler.end('publish',started)
+        return info
+
+
+def acknowledged(info,wait=False):
+    """Has the broker acknowledged this message? (Optionally, wait until
+       it has.) If we lost the connection right as it was published, paho
+       will send it again after reconnecting, which is all we can do anyway,
+       so we'll count that as done.
+    """
 
     try:
-        while True:
-            entity = entities.get(block=False)
-            logging.debug(f"MQTT: Clearing {entity}")
+        if wait:
+            info.wait_for_publish()
+            return True
+        return info.is_published()
+    except RuntimeError:
+        return True
+
+
+def publish_wait():
+    """Wait for everything in flight to be acknowledged by the broker."""
+
+    with publish_lock:
+        while inflight:
+            acknowledged(inflight.popleft(),wait=True)
+
+
+class StreamReset:
+    """Brings the Home Assistant discovery topics from one stream in line
+       with the full list of resources it's sending us, as they arrive —
+       so the first ones go out long before the last ones have even been
+       read. New or changed discovery topics get sent as we go, and ones
+       which are just the same are left alone. At the end, the ones it
+       didn't send again get cleared (unless another stream still wants
+       them).
+    """
+
+    def __init__(self,config,client,stream):
+        logging.debug(f"MBTA: reset all resources from the '{stream}' stream")
+        self.config = config
+        self.client = client
+        self.stream = stream
+        self.start = time.monotonic()
+        self.count = 0
+        self.changed = 0
+        held.cancel(stream=stream)
+        store.reset_begin(stream)
+        self.stale = entities.owned_by(stream)
+        self.before = len(self.stale)
+        # Device messages (see `DeviceBundles`) go out once, at the end.
+        if bundles:
+            bundles.hold()
+
+    def add(self,resource):
+        # Anything that's already left is as good as not sent. (See `Evictions`.)
+        if evictions.expired(resource):
+            return
+        store.reset_item(resource,self.stream)
+        (topic, sent) = add_entity(self.config,self.client,resource,self.stream)
+        self.stale.discard(topic)
+        self.changed += sent
+        self.count += 1
+
+    def finish(self):
+        (config, stream) = (self.config, self.stream)
+        store.reset_end(stream)
+        try:
+            stale = {topic for topic in self.stale if entities.disown(topic,stream)}
+
+            # Anything that was already on the broker when we started, and which
+            # none of our streams has claimed by now, is left over from before.
+            # (With sharding, that's only if it's not another instance's, and
+            # only counting the streams we're running.)
+            reset_streams.add(stream)
+            if reset_streams >= (shards.running() if shards else set(config['mbta']['streams'])):
+                stale |= entities.orphans()
+            if shards:
+                stale = {topic for topic in stale if shards.ours(topic)}
+
+            # The ones we sent get their state and attributes cleared too:
+            # the store has already forgotten them, so nothing else will.
+            # (The ones we only found on the broker, we can't tell.)
+            for topic in stale:
+                key = entities.key_of(topic)
+                if key:
+                    clear_entity(config,self.client,key,topic)
+                else:
+                    clear_entities(config,self.client,[topic])
+        finally:
+            if bundles:
+                bundles.release()
+
+        logging.log(15,f"HA: Reset ({stream}): {self.count-self.changed} entities unchanged, {self.changed} new or changed, {len(stale)} cleared (of {self.before} known)")
+
+        # Resets are big bursts, so this is where the publish
+        # window matters. Report how long it took to get
+        # everything acknowledged, so it can be tuned.
+        publish_wait()
+        reset_time = time.monotonic()-self.start
+        metrics.gauge('reset_seconds',round(reset_time,3),stream=stream)
+        logging.info(f"MQTT: Reset of {self.count} '{stream}' resources fully published in {reset_time:.2f}s (publish window {config['mqtt']['publish_window']})")
+        logging.log(15,f"MQTT: Payload cache: {published.stats()}")
+
+    def abandon(self):
+        """The stream went away partway through. What we did get is kept,
+           but nothing's cleared, since we never saw the whole list."""
+        store.reset_end(self.stream,complete=False)
+        if bundles:
+            bundles.release()
+        logging.info(f"MQTT: Reset of '{self.stream}' resources cut short after {self.count}.")
+
+# Resets (see `SSEParser`) we're partway through, by stream.
+resets = {}
+
+
+def clear_entities(config,client,topics):
+    """Removes Home Assistant discovery topics."""
+
+    with bundles.batch() if bundles else contextlib.nullcontext():
+        for entity in topics:
+            if debugging:
+                logging.debug(f"MQTT: Clearing {entity}")
             # MQTT convention: we send an empty-string payload to clear.
             # We set qos to 1 because we want to make sure we slay the
             # zombies. retain must be true because otherwise the _last_
             # retained message will linger!
-            client.publish(entity,payload='',qos=1,retain=True).wait_for_publish()
-    except queue.Empty:
-        logging.log(5,f"MQTT: No more stored entities to clear.")
-    
+            if bundles and '#' in entity:
+                bundles.drop(entity)
+            else:
+                publish(config,client,entity,payload='',qos=1,retain=True)
+            entities.cleared(entity)
 
-def add_entity(config,client,resource):
-    """ Sends the Home Assistant MQTT discovery message
-        and then updates the status topics.
+
+def compile_templates(config):
+    """Builds the Home Assistant discovery payload templates: the
+       `entity` defaults merged with each per-type section, and
+       `individual` overrides. These only depend on the config, so
+       there's no reason to redo the merging for every resource.
     """
-    logging.debug(f"MBTA: add resource type '{resource['type']}' with id '{resource['id']}'")
 
-    # Construct discovery message payload using
-    # defaults from the configuration. 
-    if type(config['homeassistant']['entity']) == dict:
-        payload = config['homeassistant']['entity'].copy()
+    templates.clear()
+    type_options.clear()
+    ha = config['homeassistant']
+
+    if type(ha['entity']) == dict:
+        base = copy.deepcopy(ha['entity'])
     else:
         logging.error(f"Config: 'entity' should be a dictionary, and isn't.")
-        payload = {}
+        base = {}
+    templates['*'] = base
+
+    for (resource_type, section) in ha.items():
+        if resource_type in ('entity', 'device', 'individual') or type(section) != dict:
+            continue
+        section = copy.deepcopy(section)
+        type_options[resource_type] = {option: section.pop(option) for option in bridge_options if option in section}
+        template = copy.deepcopy(base)
+        merge(template,section,strategy=Strategy.ADDITIVE)
+        templates[resource_type] = template
+
+    # Allow unique configuration by id
+    # (like if you want your favorite bus to be different somehow).
+    # These get merged in _after_ everything else, so they can
+    # override even the things that come from the data.
+    if 'individual' in ha and type(ha['individual']) == dict:
+        for (resource_type, ids) in ha['individual'].items():
+            if type(ids) != dict:
+                logging.warning(f"Config: 'individual' entry for '{resource_type}' should be a dictionary of ids.")
+                continue
+            for (resource_id, override) in ids.items():
+                templates[(resource_type, str(resource_id))] = copy.deepcopy(override)
+
+    logging.debug(f"HA: Compiled discovery templates for {len([t for t in templates if type(t) == str])} resource types.")
+
+
+def location_type_name(config,resource):
+    """Human name for a stop's hard-coded numeric location type."""
+
+    if 'location_type' in resource['attributes'] and 'location_type' in config['mbta']:
+        try:
+            return config['mbta']['location_type'][resource['attributes']['location_type']]
+        except KeyError:
+            logging.warning(f"MBTA: Got an unknown location type in '{resource['type']} {resource['id']}' ('{resource['attributes']['location_type']}').")
+            return "Unknown"
+    return ""
+
 
-    # merge in (override) anything unique to the type
-    if resource['type'] in config['homeassistant'] and type(config['homeassistant'][resource['type']]) == dict:
-        merge(payload,config['homeassistant'][resource['type']],strategy=Strategy.ADDITIVE)
+def discovery_payload(config,resource):
+    """Returns the Home Assistant MQTT discovery topic and
+       payload for a resource, starting from the precompiled
+       template for its type. (See `compile_templates()`.)
+    """
 
+    node_id = config['homeassistant']['node_id']
+    payload = dict(templates.get(resource['type'], templates['*']))
 
     # and now the things that have to be from _data_
     if 'friendly_prefix' in config['homeassistant']:
         prefix = config['homeassistant']['friendly_prefix']
     else:
         prefix = ''
+    location_type = None
     match resource['type']:
         case 'line' :
             # for whatever reason, lines already have their name in the id (but with a '-')
             payload['name']=f"{prefix}{resource['id'].replace('-',' ').title()}"
-            payload['unique_id']=f"{config['homeassistant']['node_id']}_{resource['id']}"
+            payload['unique_id']=f"{node_id}_{resource['id']}"
         case 'prediction'| 'schedule':
             # predictions too. But we want to use the route for the name!
             prediction_route = resource['relationships']['route']['data']['id']
             payload['name']=f"{prediction_route}"
             # no "['resource_type']":
-            payload['unique_id']=f"{config['homeassistant']['node_id']}_{resource['id']}"
+            payload['unique_id']=f"{node_id}_{resource['id']}"
         case 'stop':
             # It's nice to put bus numbers in the name, but ugly with 'place-davis'.
             # Also, we are told if it's a stop or station -- unfortunately, by hard-coded
             # numbers in the API.
-            if 'location_type' in resource['attributes'] and 'location_type' in config['mbta']:
-                try:
-                    location_type=config['mbta']['location_type'][resource['attributes']['location_type']]
-                except KeyError:
-                    location_type="Unknown"
-                    logging.warning(f"MBTA: Got an unknown location type in '{resource['type']} {resource['id']}' ('{resource['attributes']['location_type']}').")
-            else:
-                location_type=""
+            location_type = location_type_name(config,resource)
             if resource['id'].isnumeric():
                 payload['name'] = f"{prefix}{location_type} {resource['id']} ({resource['attributes']['name']})"
             else:
                 payload['name'] = f"{prefix}{resource['attributes']['name']} {location_type}"
 
             # same as generic
-            payload['unique_id']=f"{config['homeassistant']['node_id']}_{resource['type']}_{resource['id']}"
+            payload['unique_id']=f"{node_id}_{resource['type']}_{resource['id']}"
         case _:
             payload['name']=f"{prefix}{resource['type'].replace('_',' ').capitalize()} {resource['id']}"
-            payload['unique_id']=f"{config['homeassistant']['node_id']}_{resource['type']}_{resource['id']}"
+            payload['unique_id']=f"{node_id}_{resource['type']}_{resource['id']}"
     
     # apparently commuter rail service ids can contain spaces.
     # maybe other thigns too, so... make them underscores to be safe.
     payload['object_id']=payload['unique_id'].replace(' ','_')
     
-    payload['availability_topic']=f"{config['mqtt']['prefix']}/status"
+    # (With sharding, that's per instance, which is also how the
+    # instances tell whose entity is whose.)
+    payload['availability_topic']=status_topic(config)
 
     payload['state_topic']=f"{config['mqtt']['prefix']}/{resource['type']}/{resource['id']}/state"
     payload['json_attributes_topic']=f"{config['mqtt']['prefix']}/{resource['type']}/{resource['id']}/attributes"
@@ -473,30 +3773,13 @@ def add_entity(config,client,resource):
     # info here.
     # TODO: config-file options for individual stop ids
     if type(config['homeassistant']['device']) == dict:
-        match resource['type']:
-            case 'stop':
-                stop_id = resource['id']
-                logging.debug(f"HA: Associating Stop {stop_id} with a device.")
-            case 'prediction':
-                stop_id = resource['relationships']['stop']['data']['id']
-                logging.debug(f"HA: Associating Prediction {resource['id']} with the device for Stop {stop_id}.")
-            case _:
-                stop_id = ""
+        stop_id = device_stop(resource)
+        if debugging and stop_id:
+            logging.debug(f"HA: Associating {resource['type'].capitalize()} {resource['id']} with the device for Stop {stop_id}.")
         if stop_id in config['mbta']['stops']:
             payload['device'] = config['homeassistant']['device'].copy()
             payload['device']['identifiers'] =  f"mbta stop {stop_id}"
             if resource['type'] == 'stop':
-                # It's nice to put bus numbers in the name, but ugly with 'place-davis'.
-                # Also, we can tell if it's a stop or station -- unfortunately, by hard-coded
-                # numbers in the API.
-                if 'location_type' in resource['attributes'] and 'location_type' in config['mbta']:
-                    try:
-                        location_type=config['mbta']['location_type'][resource['attributes']['location_type']]
-                    except KeyError:
-                        location_type="Unknown"
-                        logging.warning(f"MBTA: Got an unknown location type in '{resource['type']} {resource['id']}' ('{resource['attributes']['location_type']}').")
-                else:
-                    location_type=""
                 if stop_id.isnumeric():
                     payload['device']['name'] = f"{prefix}{location_type} {stop_id} ({resource['attributes']['name']})"
                 else:
@@ -504,32 +3787,91 @@ def add_entity(config,client,resource):
     else:
         logging.debug(f"Config: 'device' is not a dictionary, so not creating devices.")
 
-    # Allow unique configuration by id
-    # (like if you want your favorite bus to be different somehow)
-    try:
-        merge(payload,config['homeassistant']['individual'][resource['type']][resource['id']],strategy=Strategy.ADDITIVE)
-        logging.debug(f"HA: Using individual entity config for {[resource['type']]}:{[resource['id']]}")
-    except KeyError:
-        # it's fine. we don't need to do anything.
-        pass
+    # Individual overrides (rare) get merged over everything. The
+    # template's nested dictionaries are shared, so copy them first.
+    individual = templates.get((resource['type'],resource['id']))
+    if individual is not None:
+        payload = copy.deepcopy(payload)
+        merge(payload,copy.deepcopy(individual),strategy=Strategy.ADDITIVE)
+        if debugging:
+            logging.debug(f"HA: Using individual entity config for {[resource['type']]}:{[resource['id']]}")
 
+    topic = f"{config['homeassistant']['discovery_prefix']}/sensor/{node_id}/{payload['object_id']}/config"
 
-    topic = f"{config['homeassistant']['discovery_prefix']}/sensor/{config['homeassistant']['node_id']}/{payload['object_id']}/config"
+    return (topic, payload)
 
-    # todo: make qos configurable
-    logging.debug(f"MQTT: Sending discovery message for '{payload['name']}'")
-    logging.log(5,f"MQTT: Discovery topic for '{resource['type']} {resource['id']}' is {topic}")
-    logging.log(5,f"MQTT: Discovery payload for '{resource['type']} {resource['id']}' is {payload}")
-    client.publish(topic,payload=json.dumps(payload),qos=1,retain=True).wait_for_publish()
-    
+
+def device_stop(resource):
+    """The stop whose device a resource would belong to (if it's one we follow)."""
+    match resource['type']:
+        case 'stop':
+            return resource['id']
+        case 'prediction':
+            return resource['relationships']['stop']['data']['id']
+    return ""
+
+
+def add_entity(config,client,resource,stream):
+    """ Sends the Home Assistant MQTT discovery message (if it's
+        new or different) and then updates the status topics.
+        Returns the discovery topic, and whether it was sent.
+    """
+    if debugging:
+        logging.debug(f"MBTA: add resource type '{resource['type']}' with id '{resource['id']}'")
+
+    (topic, payload) = discovery_payload(config,resource)
+    stop = None
+    if bundles:
+        # Part of a stop's device message, or short keys on its own.
+        if 'device' in payload:
+            stop = device_stop(resource)
+            device = payload['device']
+            payload = bundles.component(payload)
+            topic = bundles.topic(stop,payload['obj_id'])
+        else:
+            payload = abbreviate(payload)
+    if stop:
+        digest = PayloadCache.digest(json_dumps(payload))
+    else:
+        payload = json_dumps(payload)
+        digest = PayloadCache.digest(payload)
+
+    # With sharding, another instance might already have this one.
+    # Then it's theirs to keep up to date, for as long as they're up.
+    if shards and shards.elsewhere(topic):
+        entities.interested((resource['type'],resource['id']),topic,stream)
+        return (topic, False)
+
+    # If Home Assistant already has exactly this, leave it be.
+    sent = not entities.unchanged(topic,digest)
+    if sent:
+        # todo: make qos configurable
+        if debugging:
+            logging.debug(f"MQTT: Sending discovery message for '{resource['type']} {resource['id']}'")
+        if tracing:
+            logging.log(5,f"MQTT: Discovery topic for '{resource['type']} {resource['id']}' is {topic}")
+            logging.log(5,f"MQTT: Discovery payload for '{resource['type']} {resource['id']}' is {payload}")
+        if not stop:
+            publish(config,client,topic,payload=payload,qos=1,retain=True)
+    elif tracing:
+        logging.log(5,f"MQTT: Discovery message for '{resource['type']} {resource['id']}' is unchanged")
+    if stop:
+        bundles.put(stop,device,payload,sent)
+    entities.published((resource['type'],resource['id']),topic,digest,stream,status_topic(config))
 
     # and then update the and attributes
     update_entity(config,client,resource)
-    
+
+    return (topic, sent)
+
 def update_entity(config,client,resource):
     """Update state and attribute topics."""
 
-    logging.debug(f"MBTA: update resource type '{resource['type']}' with id '{resource['id']}'")
+    if debugging:
+        logging.debug(f"MBTA: update resource type '{resource['type']}' with id '{resource['id']}'")
+
+    if shards and shards.elsewhere(entities.topic_for((resource['type'],resource['id']))):
+        return
 
     # We're doing attributes before state,
     # because we are going to set the state
@@ -562,19 +3904,22 @@ def update_entity(config,client,resource):
             try:
                 payload[target] = config['mbta']['vehicle_types'][index]
             except KeyError:
-                logging.debug(f"Config: No mapping for vehicle type {index}")
+                if debugging:
+                    logging.debug(f"Config: No mapping for vehicle type {index}")
 
     # These are also hard-coded in the API
     if resource['type']=='route_pattern' and 'typicality' in payload and 'route_pattern_typicality' in config['mbta']:
         try:
             payload['typicality_desc'] = config['mbta']['route_pattern_typicality'][payload['typicality']]
         except KeyError:
-            logging.debug(f"Config: No mapping for route typicality {payload['typicality']}")
+            if debugging:
+                logging.debug(f"Config: No mapping for route typicality {payload['typicality']}")
     if resource['type']=='stop' and 'location_type' in payload and 'location_type' in config['mbta']:
         try:
             payload['location_type'] = config['mbta']['location_type'][payload['location_type']]
         except KeyError:
-            logging.debug(f"Config: No mapping for route location_type {payload['location_type']}")
+            if debugging:
+                logging.debug(f"Config: No mapping for route location_type {payload['location_type']}")
 
     # There are also these 'relationships',
     # and the MBTA structure for them is kind of silly.
@@ -595,10 +3940,36 @@ def update_entity(config,client,resource):
             else:
                 logging.warning(f"MBTA: Got an unknown relationship in '{resource['type']} {resource['id']}' ('{relationdata}').")
 
+    # Per-type trimming, if configured. (Home Assistant's recorder keeps
+    # every version of these, so it's worth it for the big ones.) That's
+    # only for the attributes message; the state comes from all of them.
+    attributes = payload
+    options = type_options.get(resource['type'])
+    if options:
+        if options.get('attributes_include'):
+            attributes = {key: value for (key, value) in payload.items() if key in options['attributes_include']}
+        else:
+            attributes = payload.copy()
+        for key in options.get('attributes_exclude') or ():
+            attributes.pop(key,None)
+        # And big fields which hardly ever change (like a shape's polyline)
+        # get a retained topic of their own. The attributes just say where,
+        # and a hash, so they only change when the field does.
+        for key in options.get('out_of_band') or ():
+            if key in attributes:
+                value = attributes.pop(key)
+                value = value if type(value) == str else json_dumps(value)
+                topic = f"{config['mqtt']['prefix']}/{resource['type']}/{resource['id']}/{key}"
+                attributes[f"{key}_topic"] = topic
+                attributes[f"{key}_hash"] = PayloadCache.digest(value).hex()
+                publish(config,client,topic,payload=value,qos=1,retain=True)
+
     topic = f"{config['mqtt']['prefix']}/{resource['type']}/{resource['id']}/attributes"
-    logging.log(5,f"MQTT: Attributes for '{resource['type']} {resource['id']}': {payload}")
-    logging.debug(f"MQTT: Sending attribute message for '{resource['type']} {resource['id']}'")
-    client.publish(topic,payload=json.dumps(payload),qos=1,retain=True)
+    if tracing:
+        logging.log(5,f"MQTT: Attributes for '{resource['type']} {resource['id']}': {attributes}")
+    if debugging:
+        logging.debug(f"MQTT: Sending attribute message for '{resource['type']} {resource['id']}'")
+    publish(config,client,topic,payload=json_dumps(attributes),qos=1,retain=True,resource=resource)
 
     # Ok, now state:
 
@@ -633,20 +4004,57 @@ def update_entity(config,client,resource):
             state='see attributes'
 
     topic = f"{config['mqtt']['prefix']}/{resource['type']}/{resource['id']}/state"
-    logging.log(5,f"MQTT: State for '{resource['type']} {resource['id']}': {state}")
-    logging.debug(f"MQTT: Sending state message for '{resource['type']} {resource['id']}'")
-    client.publish(topic,payload=state,qos=1,retain=True)
+    if tracing:
+        logging.log(5,f"MQTT: State for '{resource['type']} {resource['id']}': {state}")
+    if debugging:
+        logging.debug(f"MQTT: Sending state message for '{resource['type']} {resource['id']}'")
+    publish(config,client,topic,payload=state,qos=1,retain=True,resource=resource)
 
 
-def remove_entity(config,client,resource):
+def remove_entity(config,client,resource,stream):
 
-    logging.debug(f"MBTA: remove resource type '{resource['type']}' with id '{resource['id']}'")
+    if debugging:
+        logging.debug(f"MBTA: remove resource type '{resource['type']}' with id '{resource['id']}'")
 
-    object_id = f"{config['homeassistant']['node_id']}_{resource['type']}_{resource['id']}"
-    topic = f"{config['homeassistant']['discovery_prefix']}/sensor/{config['homeassistant']['node_id']}/{object_id}/config"
+    # 'remove' events only have the type and id, which isn't always enough
+    # to work out the topic (predictions, for example, are named by route).
+    # So, use the one we sent, if we know it.
+    topic = entities.topic_for((resource['type'],resource['id']))
+    if not topic:
+        object_id = f"{config['homeassistant']['node_id']}_{resource['type']}_{resource['id']}"
+        topic = f"{config['homeassistant']['discovery_prefix']}/sensor/{config['homeassistant']['node_id']}/{object_id}/config"
     
-    logging.debug(f"MQTT: Sending remove message for '{resource['type']} {resource['id']}'")
-    client.publish(topic,payload='',qos=1,retain=True)
+    # Another stream might still be interested, though!
+    if entities.has(topic) and not entities.disown(topic,stream):
+        if debugging:
+            logging.debug(f"MBTA: '{resource['type']} {resource['id']}' removed from '{stream}', but still used by another stream")
+        return
+
+    # Or it's another instance's to take care of.
+    if shards and not shards.ours(topic):
+        entities.cleared(topic)
+        return
+
+    if debugging:
+        logging.debug(f"MQTT: Sending remove message for '{resource['type']} {resource['id']}'")
+    clear_entity(config,client,(resource['type'],resource['id']),topic)
+
+
+def clear_entity(config,client,key,topic):
+    """Clears a resource's discovery topic, and then its retained state,
+       attributes, and out-of-band topics, so they don't hang around on
+       the broker forever."""
+
+    clear_entities(config,client,[topic])
+    for status in status_topics(config,key):
+        publish(config,client,status,payload='',qos=1,retain=True)
+
+
+def status_topics(config,key):
+    """A resource's state, attributes, and out-of-band topics."""
+
+    base = f"{config['mqtt']['prefix']}/{key[0]}/{key[1]}"
+    return [f"{base}/{name}" for name in ('state', 'attributes', *(type_options.get(key[0],{}).get('out_of_band') or ()))]
     
     
 
@@ -0,0 +1,113 @@
+import collections, os, sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import mbta2mqtt
+
+
+class Info:
+    def __init__(self, mid):
+        self.mid = mid
+
+    def is_published(self):
+        return True
+
+    def wait_for_publish(self, timeout=None):
+        return True
+
+
+class FakeClient:
+    """Stands in for paho: keeps what a broker would have retained."""
+
+    def __init__(self):
+        self.sent = []          # (topic, payload, retain)
+        self.retained = {}
+        self.mid = 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        payload = payload.encode() if isinstance(payload, str) else payload
+        self.sent.append((topic, payload, retain))
+        if retain:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+        self.mid += 1
+        return Info(self.mid)
+
+    def message_callback_add(self, topic, callback):
+        pass
+
+    def subscribe(self, topic, *args, **kwargs):
+        pass
+
+
+@pytest.fixture
+def config():
+    import yaml
+    from yaml_env_tag import construct_env_tag
+
+    class Loader(yaml.SafeLoader):
+        pass
+    Loader.add_constructor('!ENV', construct_env_tag)
+    with open(os.path.join(ROOT, 'defaults.conf')) as f:
+        config = yaml.load(f, Loader=Loader)
+    config['mbta']['api_key'] = '0' * 32
+    config['mbta']['stops'] = ['110']
+    return config
+
+
+@pytest.fixture
+def client():
+    return FakeClient()
+
+
+@pytest.fixture
+def bridge(config, monkeypatch):
+    """The module's globals, fresh for each test."""
+    m = mbta2mqtt
+    m.use_json_codec('json')
+    m.compile_templates(config)
+    m.mbta_streams(config)
+    monkeypatch.setattr(m, 'entities', m.EntityRegistry())
+    monkeypatch.setattr(m, 'store', m.ResourceStore())
+    monkeypatch.setattr(m, 'published', m.PayloadCache(config['mqtt']['dedup_cache_size']))
+    monkeypatch.setattr(m, 'held', m.UpdateCoalescer())
+    monkeypatch.setattr(m, 'evictions', m.Evictions())
+    monkeypatch.setattr(m, 'metrics', m.Metrics())
+    monkeypatch.setattr(m, 'reset_streams', set())
+    monkeypatch.setattr(m, 'resets', {})
+    monkeypatch.setattr(m, 'inflight', collections.deque())
+    monkeypatch.setattr(m, 'shards', None)
+    monkeypatch.setattr(m, 'bundles', None)
+    monkeypatch.setattr(m, 'mqtt5', None)
+    m.broker.set()
+    yield m
+    m.templates.clear()
+    m.type_options.clear()
+
+
+def stop(id='110', name='Mass Ave'):
+    return {'type': 'stop', 'id': id,
+            'attributes': {'name': name, 'location_type': 0},
+            'relationships': {'parent_station': {'data': None}}}
+
+
+def prediction(id, stop='110', departure='2026-10-17T10:00:00-04:00', route='77', vehicle=None):
+    return {'type': 'prediction', 'id': id,
+            'attributes': {'departure_time': departure, 'arrival_time': None,
+                           'direction_id': 0, 'stop_sequence': 5},
+            'relationships': {'route': {'data': {'id': route, 'type': 'route'}},
+                              'stop': {'data': {'id': stop, 'type': 'stop'}},
+                              'trip': {'data': {'id': f"t{id}", 'type': 'trip'}},
+                              'vehicle': {'data': vehicle and {'id': vehicle, 'type': 'vehicle'}}}}
+
+
+def reset(m, config, client, stream, resources):
+    resetting = m.StreamReset(config, client, stream)
+    for resource in resources:
+        resetting.add(resource)
+    resetting.finish()
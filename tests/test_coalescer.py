@@ -0,0 +1,80 @@
+"""UpdateCoalescer: holding rapid updates back, and sending only the latest."""
+
+import time
+
+import pytest
+
+from conftest import prediction
+
+
+@pytest.fixture
+def coalescing(bridge):
+    bridge.type_options['prediction'] = {'coalesce': 0.2}
+    return bridge
+
+
+def event(m, config, client, event, resource):
+    m.handle_event(config, client, 'predictions', event, resource)
+
+
+def later(minutes):
+    return prediction('p1', departure=f"2026-10-17T10:{minutes:02d}:00-04:00")
+
+
+def settle(m):
+    deadline = time.monotonic() + 2
+    while m.held.pending or m.held.sending:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def state(client):
+    return client.retained.get('mbta2mqtt/prediction/p1/state')
+
+
+def test_only_the_latest_is_sent(coalescing, config, client):
+    event(coalescing, config, client, 'add', later(0))
+    client.sent.clear()
+    for minutes in (1, 2, 3):
+        event(coalescing, config, client, 'update', later(minutes))
+    assert client.sent == []
+    settle(coalescing)
+    assert len(client.sent) == 2
+    assert state(client) == b'2026-10-17T10:03:00-04:00'
+    assert coalescing.metrics.counters[('updates_coalesced', (('type', 'prediction'),))] == 2
+
+
+def test_other_types_go_right_away(coalescing, config, client):
+    vehicle = {'type': 'vehicle', 'id': 'v1', 'attributes': {'current_status': 'STOPPED_AT'}}
+    event(coalescing, config, client, 'add', vehicle)
+    client.sent.clear()
+    vehicle = dict(vehicle, attributes={'current_status': 'IN_TRANSIT_TO'})
+    event(coalescing, config, client, 'update', vehicle)
+    assert client.retained['mbta2mqtt/vehicle/v1/state'] == b'IN_TRANSIT_TO'
+
+
+def test_remove_cancels_what_was_held(coalescing, config, client):
+    event(coalescing, config, client, 'add', later(0))
+    event(coalescing, config, client, 'update', later(1))
+    event(coalescing, config, client, 'remove', {'type': 'prediction', 'id': 'p1'})
+    time.sleep(0.3)
+    settle(coalescing)
+    assert not any('/p1/' in topic for topic in client.retained)
+
+
+def test_add_replaces_what_was_held(coalescing, config, client):
+    event(coalescing, config, client, 'add', later(0))
+    event(coalescing, config, client, 'update', later(1))
+    event(coalescing, config, client, 'add', later(2))
+    assert state(client) == b'2026-10-17T10:02:00-04:00'
+    time.sleep(0.3)
+    settle(coalescing)
+    assert state(client) == b'2026-10-17T10:02:00-04:00'
+
+
+def test_reset_cancels_the_streams_holds(coalescing, config, client):
+    event(coalescing, config, client, 'add', later(0))
+    event(coalescing, config, client, 'update', later(1))
+    event(coalescing, config, client, 'reset', [])
+    assert coalescing.held.pending == {}
+    assert not any('/p1/' in topic for topic in client.retained)
@@ -0,0 +1,76 @@
+"""The parsed config, cached between runs."""
+
+import json
+import os
+
+import pytest
+
+import mbta2mqtt
+from conftest import ROOT
+
+KEY = '0123456789abcdef' * 2
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    path = tmp_path / 'config.json'
+    monkeypatch.setenv('MBTA2MQTT_CONFIG_CACHE', str(path))
+    monkeypatch.setenv('MBTA_API_KEY', KEY)
+    monkeypatch.setattr('sys.argv', [os.path.join(ROOT, 'mbta2mqtt.py')])
+    monkeypatch.chdir(tmp_path)
+    return path
+
+
+def test_encoding_round_trip():
+    config = {'a': [1, 2.5, None, True, 'x'], 'types': {0: 'Light Rail', 3: 'Bus'},
+              'odd': {'!ENV': 'not really'}, 'key': mbta2mqtt.EnvValue(['MBTA_API_KEY'], None, KEY)}
+    decoded = mbta2mqtt.cache_decode(json.loads(json.dumps(mbta2mqtt.cache_encode(config))))
+    assert decoded['key'].names == ['MBTA_API_KEY']
+    assert decoded['key'].value is None
+    decoded['key'] = config['key']
+    assert decoded == config
+
+
+def test_encoding_refuses_what_json_cant_keep():
+    import datetime
+    with pytest.raises(TypeError):
+        mbta2mqtt.cache_encode({'when': datetime.date(2026, 10, 17)})
+
+
+def test_cached_config_is_the_same(cache):
+    (config, log) = mbta2mqtt.load_config()
+    assert cache.exists()
+    (again, log) = mbta2mqtt.load_config()
+    assert "Used the cached copy" in log[-1][1]
+    assert again == config
+    assert again['mbta']['api_key'] == KEY
+
+
+def test_cache_leaves_out_the_api_key(cache):
+    mbta2mqtt.load_config()
+    assert KEY not in cache.read_text()
+
+
+def test_cache_follows_the_environment(cache, monkeypatch):
+    mbta2mqtt.load_config()
+    monkeypatch.setenv('MBTA_API_KEY', 'f' * 32)
+    (config, log) = mbta2mqtt.load_config()
+    assert config['mbta']['api_key'] == 'f' * 32
+    assert not any("Used the cached copy" in message for (level, message, rc) in log)
+
+
+def test_cache_follows_the_files(cache):
+    mbta2mqtt.load_config()
+    cached = json.loads(cache.read_text())
+    (name, version) = next(iter(cached['files'].items()))
+    cached['files'][name] = (version or 0) - 1
+    cache.write_text(json.dumps(cached))
+    assert mbta2mqtt.cached_config() is None
+
+
+@pytest.mark.parametrize('contents', ['', 'not json', '[]', '{"version": "0.1.0"}', '\x80\x04\x95'])
+def test_broken_cache_is_ignored(cache, contents):
+    cache.write_text(contents)
+    assert mbta2mqtt.cached_config() is None
+    (config, log) = mbta2mqtt.load_config()
+    assert config['mbta']['api_key'] == KEY
@@ -0,0 +1,102 @@
+"""DepartureBoards: the next few departures per stop and direction."""
+
+import json
+
+import pytest
+
+from conftest import prediction, stop
+
+
+def trip(id, headsign='Harvard', stops=()):
+    trip = {'type': 'trip', 'id': id, 'attributes': {'headsign': headsign},
+            'relationships': {'route': {'data': {'id': '77', 'type': 'route'}}}}
+    if stops:
+        trip['relationships']['stops'] = {'data': [{'id': s, 'type': 'stop'} for s in stops]}
+    return trip
+
+
+def vehicle(id, trip, at, sequence=1):
+    return {'type': 'vehicle', 'id': id, 'attributes': {'current_status': 'IN_TRANSIT_TO', 'current_stop_sequence': sequence},
+            'relationships': {'trip': {'data': {'id': trip, 'type': 'trip'}},
+                              'stop': {'data': {'id': at, 'type': 'stop'}}}}
+
+
+def at(minute, direction=0, **kwargs):
+    resource = prediction(f"p{minute}-{direction}", departure=f"2026-10-17T10:{minute:02d}:00-04:00", **kwargs)
+    resource['attributes']['direction_id'] = direction
+    return resource
+
+
+@pytest.fixture
+def boards(bridge, config, client):
+    config['departures']['count'] = 2
+    boards = bridge.DepartureBoards(config, client)
+    bridge.store.listen(boards.changed)
+    return boards
+
+
+def board(client, stop='110'):
+    return json.loads(client.retained[f"mbta2mqtt/departures/{stop}"])
+
+
+def put(m, *resources):
+    for resource in resources:
+        m.store.put(resource, 'predictions')
+
+
+def test_soonest_first_in_each_direction(bridge, boards, client):
+    put(bridge, at(30), at(10), at(20), at(15, direction=1))
+    shown = board(client)
+    assert [d['time'][11:16] for d in shown['directions']['0']] == ['10:10', '10:20']
+    assert [d['time'][11:16] for d in shown['directions']['1']] == ['10:15']
+
+
+def test_changes_move_predictions(bridge, boards, client):
+    put(bridge, at(10), at(20), at(30))
+    bridge.store.remove({'type': 'prediction', 'id': 'p10-0'}, 'predictions')
+    assert [d['prediction'] for d in board(client)['directions']['0']] == ['p20-0', 'p30-0']
+    moved = at(20)
+    moved['attributes']['departure_time'] = '2026-10-17T10:40:00-04:00'
+    put(bridge, moved)
+    assert [d['prediction'] for d in board(client)['directions']['0']] == ['p30-0', 'p20-0']
+
+
+def test_only_sent_when_it_changes(bridge, boards, client):
+    put(bridge, at(10), at(20))
+    client.sent.clear()
+    # Not on the board, so the board's the same.
+    put(bridge, at(30))
+    assert client.sent == []
+
+
+def test_parent_station(bridge, boards, config, client):
+    platform = stop('70061')
+    platform['relationships']['parent_station'] = {'data': {'id': '110', 'type': 'stop'}}
+    put(bridge, platform, at(10, stop='70061'))
+    assert [d['prediction'] for d in board(client)['directions']['0']] == ['p10-0']
+
+
+def test_other_stops_are_left_out(bridge, boards, client):
+    put(bridge, at(10, stop='999'))
+    assert client.retained == {}
+
+
+def test_trip_and_vehicle(bridge, boards, client):
+    put(bridge, trip('tp10-0', stops=['1', '2', '110']), at(10, vehicle='v1'), vehicle('v1', 'tp10-0', '1'))
+    (shown,) = board(client)['directions']['0']
+    assert (shown['headsign'], shown['vehicle'], shown['stops_away']) == ('Harvard', 'v1', 2)
+    # The trip changing changes the board too.
+    put(bridge, trip('tp10-0', headsign='Dudley', stops=['1', '2', '110']))
+    assert board(client)['directions']['0'][0]['headsign'] == 'Dudley'
+
+
+def test_vehicle_on_another_trip(bridge, boards, client):
+    put(bridge, trip('tp10-0'), at(10, vehicle='v1'), vehicle('v1', 'elsewhere', '1'))
+    (shown,) = board(client)['directions']['0']
+    assert (shown['vehicle'], shown['stops_away']) == ('v1', None)
+
+
+def test_clear(bridge, boards, client):
+    put(bridge, at(10))
+    boards.clear()
+    assert client.retained == {}
@@ -0,0 +1,72 @@
+"""Evictions: predictions and schedules going away once they're in the past."""
+
+import datetime
+import time
+
+import pytest
+
+from conftest import prediction, reset
+
+
+def when(seconds):
+    return datetime.datetime.fromtimestamp(time.time() + seconds).astimezone().isoformat()
+
+
+@pytest.fixture
+def evicting(bridge):
+    bridge.type_options['prediction'] = {'evict_after': 60}
+    bridge.store.listen(bridge.evictions.track)
+    return bridge
+
+
+def add(m, config, client, resource):
+    m.store.put(resource, 'predictions')
+    m.add_entity(config, client, resource, 'predictions')
+
+
+def test_deadline(evicting):
+    departure = time.time() + 100
+    attributes = prediction('p1', departure=when(100))['attributes']
+    assert evicting.Evictions.deadline('prediction', attributes) == pytest.approx(departure + 60, abs=1)
+    assert evicting.Evictions.deadline('prediction', {'departure_time': None, 'arrival_time': None}) is None
+    assert evicting.Evictions.deadline('vehicle', attributes) is None
+
+
+def test_track_follows_the_store(evicting, config, client):
+    add(evicting, config, client, prediction('p1', departure=when(100)))
+    first = evicting.evictions.deadlines[('prediction', 'p1')]
+    add(evicting, config, client, prediction('p1', departure=when(200)))
+    assert evicting.evictions.deadlines[('prediction', 'p1')] == pytest.approx(first + 100, abs=1)
+    evicting.store.remove({'type': 'prediction', 'id': 'p1'}, 'predictions')
+    assert ('prediction', 'p1') not in evicting.evictions.deadlines
+
+
+def test_evict_clears_everything(evicting, config, client):
+    add(evicting, config, client, prediction('p1', departure=when(-100)))
+    assert len(client.retained) == 3
+    evicting.evictions.evict(config, client, ('prediction', 'p1'))
+    assert client.retained == {}
+    assert evicting.store.get('prediction', 'p1') is None
+    assert evicting.entities.topic_for(('prediction', 'p1')) is None
+
+
+def test_evict_without_a_discovery_topic(evicting, config, client):
+    add(evicting, config, client, prediction('p1', departure=when(-100)))
+    topic = evicting.entities.topic_for(('prediction', 'p1'))
+    evicting.clear_entities(config, client, [topic])
+    evicting.evictions.evict(config, client, ('prediction', 'p1'))
+    assert client.retained == {}
+
+
+def test_evict_skips_what_was_pushed_back(evicting, config, client):
+    add(evicting, config, client, prediction('p1', departure=when(100)))
+    evicting.evictions.evict(config, client, ('prediction', 'p1'))
+    assert len(client.retained) == 3
+    assert evicting.store.get('prediction', 'p1')
+
+
+def test_reset_skips_what_already_left(evicting, config, client):
+    reset(evicting, config, client, 'predictions', [prediction('p1', departure=when(-100)), prediction('p2', departure=when(100))])
+    assert evicting.store.get('prediction', 'p1') is None
+    assert not any('/p1/' in topic for topic in client.retained)
+    assert 'mbta2mqtt/prediction/p2/state' in client.retained
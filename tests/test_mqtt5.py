@@ -0,0 +1,87 @@
+"""MQTT v5: topic aliases, and putting topics back for paho to resend."""
+
+import pytest
+
+from conftest import prediction
+
+mqtt = pytest.importorskip('paho.mqtt.client')
+
+
+class Properties:
+    def __init__(self, maximum):
+        self.TopicAliasMaximum = maximum
+
+
+@pytest.fixture
+def v5(bridge, config):
+    bridge.deferred_imports()
+    config['mqtt']['topic_aliases'] = 2
+    bridge.type_options['prediction'] = {'message_expiry': 3600}
+    return bridge.MQTT5(config)
+
+
+@pytest.fixture
+def paho():
+    # Never connected, so everything with QoS 1 stays waiting to be sent.
+    return mqtt.Client(protocol=mqtt.MQTTv5)
+
+
+def waiting(paho):
+    return [(message._topic.decode(), getattr(message.properties, 'TopicAlias', None))
+            for message in paho._out_messages.values()]
+
+
+def test_aliases_after_the_first_time(v5, paho):
+    v5.connected(paho, Properties(10))
+    resource = prediction('p1')
+    for _ in range(2):
+        v5.publish(paho, 'mbta2mqtt/prediction/p1/state', 'x', 1, True, resource)
+    assert waiting(paho) == [('mbta2mqtt/prediction/p1/state', 1), ('', 1)]
+
+
+def test_least_recently_used_alias_is_reused(v5, paho):
+    v5.connected(paho, Properties(10))
+    resource = prediction('p1')
+    for topic in ('a', 'b', 'a', 'c'):
+        v5.publish(paho, topic, 'x', 1, True, resource)
+    assert v5.aliases == {'a': 1, 'c': 2}
+
+
+def test_no_more_aliases_than_the_broker_allows(v5, paho):
+    v5.connected(paho, Properties(0))
+    for _ in range(2):
+        v5.publish(paho, 'a', 'x', 1, True, prediction('p1'))
+    assert waiting(paho) == [('a', None), ('a', None)]
+
+
+def test_reconnecting_puts_topics_back(v5, paho):
+    v5.connected(paho, Properties(10))
+    resource = prediction('p1')
+    for _ in range(2):
+        v5.publish(paho, 'mbta2mqtt/prediction/p1/state', 'x', 1, True, resource)
+    v5.connected(paho, Properties(10))
+    assert waiting(paho) == [('mbta2mqtt/prediction/p1/state', None)] * 2
+    assert v5.pending == {}
+    assert v5.aliases == {}
+
+
+def test_acknowledged_ones_are_forgotten(v5, paho):
+    v5.connected(paho, Properties(10))
+    for _ in range(2):
+        info = v5.publish(paho, 'a', 'x', 1, True, prediction('p1'))
+    assert info.mid in v5.pending
+    v5.acked(info.mid)
+    assert v5.pending == {}
+
+
+def test_expiry(v5):
+    assert v5.expiry(prediction('p1'), True, 'x') == 3600
+    assert v5.expiry(prediction('p1'), True, '') is None
+    assert v5.expiry(prediction('p1'), False, 'x') is None
+    assert v5.expiry({'type': 'stop', 'id': '1'}, True, 'x') is None
+
+
+def test_unknown_paho_gets_no_aliases(bridge, config, monkeypatch):
+    import paho.mqtt
+    monkeypatch.setattr(paho.mqtt, '__version__', '3.0.0')
+    assert bridge.MQTT5(config).wanted == 0
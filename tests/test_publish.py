@@ -0,0 +1,57 @@
+"""publish(): skipping what the broker already has."""
+
+from conftest import prediction
+
+
+def topics(client):
+    return [topic for (topic, payload, retain) in client.sent]
+
+
+def test_unchanged_payloads_are_skipped(bridge, config, client):
+    assert bridge.publish(config, client, 'a', 'x')
+    assert bridge.publish(config, client, 'a', 'x') is None
+    assert bridge.publish(config, client, 'a', 'y')
+    assert bridge.publish(config, client, 'b', 'y')
+    assert topics(client) == ['a', 'a', 'b']
+    assert bridge.metrics.counters[('publishes_skipped', ())] == 1
+
+
+def test_clearing_is_a_change_too(bridge, config, client):
+    bridge.publish(config, client, 'a', 'x')
+    bridge.publish(config, client, 'a', '')
+    bridge.publish(config, client, 'a', 'x')
+    assert client.retained == {'a': b'x'}
+    assert len(client.sent) == 3
+
+
+def test_without_the_cache_everything_goes(bridge, config, client, monkeypatch):
+    monkeypatch.setattr(bridge, 'published', bridge.PayloadCache(0))
+    bridge.publish(config, client, 'a', 'x')
+    bridge.publish(config, client, 'a', 'x')
+    assert len(client.sent) == 2
+
+
+def test_updates_only_send_what_changed(bridge, config, client):
+    bridge.add_entity(config, client, prediction('p1'), 'predictions')
+    client.sent.clear()
+    bridge.update_entity(config, client, prediction('p1'))
+    assert client.sent == []
+    changed = prediction('p1')
+    changed['attributes']['stop_sequence'] = 6
+    bridge.update_entity(config, client, changed)
+    # The state is the departure time, which is the same.
+    assert topics(client) == ['mbta2mqtt/prediction/p1/attributes']
+
+
+def test_discovery_is_only_sent_when_it_changes(bridge, config, client):
+    (topic, sent) = bridge.add_entity(config, client, prediction('p1'), 'predictions')
+    assert sent
+    (topic, sent) = bridge.add_entity(config, client, prediction('p1'), 'predictions')
+    assert not sent
+    # Retained ones we find on the broker count, too.
+    (other, payload) = bridge.discovery_payload(config, prediction('p2'))
+    bridge.entities.found(other, bridge.PayloadCache.digest(bridge.json_dumps(payload)))
+    client.sent.clear()
+    (topic, sent) = bridge.add_entity(config, client, prediction('p2'), 'predictions')
+    assert not sent
+    assert other not in topics(client)
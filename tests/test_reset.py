@@ -0,0 +1,67 @@
+"""Resets: bringing what's on the broker in line with what a stream has."""
+
+from conftest import prediction, reset, stop
+
+
+def about(client, id):
+    return sorted(topic for topic in client.retained if f"/{id}/" in topic or topic.endswith(f"_{id}/config"))
+
+
+def test_reset_publishes_everything(bridge, config, client):
+    reset(bridge, config, client, 'predictions', [prediction('p1'), prediction('p2')])
+    assert len(about(client, 'p1')) == 3
+    assert len(about(client, 'p2')) == 3
+
+
+def test_reset_clears_all_of_a_dropped_resource(bridge, config, client):
+    reset(bridge, config, client, 'predictions', [prediction('p1'), prediction('p2')])
+    reset(bridge, config, client, 'predictions', [prediction('p1')])
+    assert about(client, 'p2') == []
+    assert len(about(client, 'p1')) == 3
+    assert bridge.entities.topic_for(('prediction', 'p2')) is None
+    assert bridge.store.get('prediction', 'p2') is None
+
+
+def test_reset_clears_out_of_band_topics(bridge, config, client):
+    bridge.type_options['prediction'] = {'out_of_band': ['stop_sequence']}
+    reset(bridge, config, client, 'predictions', [prediction('p1'), prediction('p2')])
+    assert 'mbta2mqtt/prediction/p2/stop_sequence' in client.retained
+    reset(bridge, config, client, 'predictions', [prediction('p1')])
+    assert about(client, 'p2') == []
+
+
+def test_reset_sends_only_what_changed(bridge, config, client):
+    reset(bridge, config, client, 'predictions', [prediction('p1'), prediction('p2')])
+    client.sent.clear()
+    reset(bridge, config, client, 'predictions', [prediction('p1'), prediction('p2', departure='2026-10-17T10:05:00-04:00')])
+    assert sorted(topic for (topic, payload, retain) in client.sent) == \
+        ['mbta2mqtt/prediction/p2/attributes', 'mbta2mqtt/prediction/p2/state']
+
+
+def test_reset_keeps_what_another_stream_has(bridge, config, client):
+    reset(bridge, config, client, 'predictions', [prediction('p1'), stop()])
+    reset(bridge, config, client, 'stops', [stop()])
+    reset(bridge, config, client, 'predictions', [prediction('p1')])
+    assert len(about(client, '110')) == 3
+
+
+def test_reset_leaves_a_moved_resource_alone(bridge, config, client):
+    # A stop's discovery topic can change (say, with `individual`), and then
+    # its state and attributes are the new topic's.
+    reset(bridge, config, client, 'predictions', [stop()])
+    old = bridge.entities.topic_for(('stop', '110'))
+    bridge.templates[('stop', '110')] = {'object_id': 'renamed'}
+    reset(bridge, config, client, 'predictions', [stop()])
+    assert bridge.entities.topic_for(('stop', '110')) != old
+    assert old not in client.retained
+    assert 'mbta2mqtt/stop/110/state' in client.retained
+    assert 'mbta2mqtt/stop/110/attributes' in client.retained
+
+
+def test_abandoned_reset_clears_nothing(bridge, config, client):
+    reset(bridge, config, client, 'predictions', [prediction('p1'), prediction('p2')])
+    resetting = bridge.StreamReset(config, client, 'predictions')
+    resetting.add(prediction('p1'))
+    resetting.abandon()
+    assert len(about(client, 'p2')) == 3
+    assert bridge.store.get('prediction', 'p2')
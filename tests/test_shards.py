@@ -0,0 +1,131 @@
+"""Sharding: splitting stops between instances, and taking over from each other."""
+
+import time
+
+import pytest
+
+from conftest import prediction
+
+
+class Message:
+    def __init__(self, topic, payload, retain=True):
+        self.topic = topic
+        self.payload = payload.encode()
+        self.retain = retain
+
+
+def until(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def sharded(bridge, config, client, monkeypatch):
+    config['sharding']['instance'] = 'a'
+    config['mbta']['stops'] = [str(stop) for stop in range(20)]
+    monkeypatch.setattr(bridge, 'shards', bridge.Shards(config, client))
+    return bridge
+
+
+def online(shards, client, name, payload='online'):
+    shards.instance_message(client, None, Message(f"mbta2mqtt/instances/{name}", payload))
+
+
+def test_owner_moves_only_what_it_must(sharded, client):
+    shards = sharded.shards
+    alone = {stop: shards.owner(stop) for stop in range(100)}
+    assert set(alone.values()) == {'a'}
+    online(shards, client, 'b')
+    shared = {stop: shards.owner(stop) for stop in range(100)}
+    assert 20 < list(shared.values()).count('b') < 80
+    online(shards, client, 'c')
+    three = {stop: shards.owner(stop) for stop in range(100)}
+    # Nothing moves between a and b, only to c.
+    assert all(three[stop] in (shared[stop], 'c') for stop in range(100))
+
+
+def test_nothing_claimed_before_start(sharded, client):
+    shards = sharded.shards
+    shards.rebalance()
+    assert shards.stops == set()
+    shards.start()
+    until(lambda: len(shards.stops) == 20)
+    assert {topic for topic in client.retained if '/lease/' in topic} == {f"mbta2mqtt/lease/{stop}" for stop in range(20)}
+
+
+def test_live_leases_are_left_alone(sharded, client):
+    shards = sharded.shards
+    online(shards, client, 'b')
+    mine = {str(stop) for stop in range(20) if shards.owner(str(stop)) == 'a'}
+    held = sorted(mine)[0]
+    shards.lease_message(client, None, Message(f"mbta2mqtt/lease/{held}", 'b'))
+    shards.start()
+    until(lambda: shards.stops == mine - {held})
+    # Until b lets go.
+    shards.lease_message(client, None, Message(f"mbta2mqtt/lease/{held}", ''))
+    until(lambda: shards.stops == mine)
+
+
+def test_release_only_what_is_ours(sharded, client):
+    shards = sharded.shards
+    shards.leases.update({'1': 'a', '2': 'b'})
+    shards.release(['1', '2', '3'])
+    assert [topic for (topic, payload, retain) in client.sent] == ['mbta2mqtt/lease/1']
+
+
+def test_takeover_resends_what_another_instance_changed(sharded, config, client):
+    resource = prediction('p1', stop='1')
+    sharded.store.put(resource, 'predictions')
+    sharded.add_entity(config, client, resource, 'predictions')
+    topic = sharded.entities.topic_for(('prediction', 'p1'))
+    assert len(client.retained) == 3
+
+    # b took it over while we were away, and changed it.
+    online(sharded.shards, client, 'b')
+    sharded.entities.found(topic, b'b', 'mbta2mqtt/instances/b')
+    for status in ('state', 'attributes'):
+        client.retained[f"mbta2mqtt/prediction/p1/{status}"] = b'from b'
+
+    # Then b goes away.
+    client.sent.clear()
+    online(sharded.shards, client, 'b', 'offline')
+    until(lambda: len(client.sent) == 3)
+    assert client.retained["mbta2mqtt/prediction/p1/state"] != b'from b'
+    assert sharded.entities.holder_of(topic) == 'mbta2mqtt/instances/a'
+
+
+def test_dropped_resends_what_another_instance_cleared(sharded, config, client):
+    resource = prediction('p1', stop='1')
+    sharded.store.put(resource, 'predictions')
+    sharded.add_entity(config, client, resource, 'predictions')
+    topic = sharded.entities.topic_for(('prediction', 'p1'))
+
+    # b had it, and cleared all of it.
+    online(sharded.shards, client, 'b')
+    sharded.entities.found(topic, b'b', 'mbta2mqtt/instances/b')
+    client.retained.clear()
+    sharded.shards.dropped(topic)
+    until(lambda: len(client.retained) == 3)
+
+
+def test_dropped_forgets_what_we_no_longer_want(sharded, config, client):
+    resource = prediction('p1', stop='1')
+    sharded.add_entity(config, client, resource, 'predictions')
+    topic = sharded.entities.topic_for(('prediction', 'p1'))
+    sharded.entities.disown(topic, 'predictions')
+    sharded.entities.found(topic, b'b', 'mbta2mqtt/instances/b')
+    sharded.shards.dropped(topic)
+    until(lambda: 'mbta2mqtt/prediction/p1/state' not in sharded.published.hashes)
+    assert not sharded.entities.has(topic)
+
+
+def test_updates_skip_what_another_instance_has(sharded, config, client):
+    resource = prediction('p1', stop='1')
+    online(sharded.shards, client, 'b')
+    (topic, _) = sharded.discovery_payload(config, resource)
+    sharded.entities.found(topic, b'b', 'mbta2mqtt/instances/b')
+    assert sharded.add_entity(config, client, resource, 'predictions') == (topic, False)
+    assert client.sent == []
+    assert sharded.entities.topic_for(('prediction', 'p1')) == topic
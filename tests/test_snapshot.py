@@ -0,0 +1,101 @@
+"""The payload cache, and the snapshot that keeps it across restarts."""
+
+import sqlite3
+
+from mbta2mqtt import PayloadCache, Snapshot
+
+
+def rows(path):
+    with sqlite3.connect(path) as db:
+        return dict(db.execute("SELECT topic, digest FROM published"))
+
+
+def test_cache_skips_repeats():
+    cache = PayloadCache(10)
+    assert not cache.unchanged('a', 'one')
+    assert cache.unchanged('a', 'one')
+    assert not cache.unchanged('a', 'two')
+    assert not cache.unchanged('a', 'one')
+    assert (cache.hits, cache.misses) == (1, 3)
+
+
+def test_cache_forgets_the_least_recently_used():
+    cache = PayloadCache(2)
+    cache.unchanged('a', 'x')
+    cache.unchanged('b', 'x')
+    cache.unchanged('a', 'x')
+    cache.unchanged('c', 'x')
+    assert list(cache.hashes) == ['a', 'c']
+
+
+def test_cache_resends_expiring_messages(monkeypatch):
+    cache = PayloadCache(10)
+    now = [1000.0]
+    monkeypatch.setattr('mbta2mqtt.time.monotonic', lambda: now[0])
+    assert not cache.unchanged('a', 'x', expiry=60)
+    now[0] += 29
+    assert cache.unchanged('a', 'x', expiry=60)
+    now[0] += 2
+    assert not cache.unchanged('a', 'x', expiry=60)
+
+
+def test_disabled_cache_skips_nothing():
+    cache = PayloadCache(0)
+    assert not cache.unchanged('a', 'x')
+    assert not cache.unchanged('a', 'x')
+
+
+def test_snapshot_round_trip(tmp_path):
+    path = tmp_path / 'snapshot.db'
+    cache = PayloadCache(10)
+    cache.snapshot = Snapshot(path, 60)
+    cache.unchanged('mbta2mqtt/stop/1/state', 'x')
+    cache.unchanged('homeassistant/sensor/mbta/mbta_1/config', '{}')
+    cache.snapshot.close()
+
+    again = PayloadCache(10)
+    snapshot = Snapshot(path, 60)
+    assert snapshot.load(again, 'homeassistant') == {'homeassistant/sensor/mbta/mbta_1/config'}
+    assert again.unchanged('mbta2mqtt/stop/1/state', 'x')
+    snapshot.close()
+
+
+def test_snapshot_forgets_cleared_topics(tmp_path):
+    path = tmp_path / 'snapshot.db'
+    cache = PayloadCache(10)
+    cache.snapshot = Snapshot(path, 60)
+    cache.unchanged('a', 'x')
+    cache.unchanged('b', 'x')
+    cache.snapshot.save()
+    cache.unchanged('a', '')
+    cache.snapshot.close()
+    assert set(rows(path)) == {'b'}
+
+
+def test_snapshot_forgets_what_the_cache_does(tmp_path):
+    path = tmp_path / 'snapshot.db'
+    cache = PayloadCache(3)
+    cache.snapshot = Snapshot(path, 60)
+    for topic in 'abcdef':
+        cache.unchanged(topic, 'x')
+        cache.snapshot.save()
+    cache.snapshot.close()
+    assert set(rows(path)) == {'d', 'e', 'f'}
+
+
+def test_snapshot_load_keeps_only_the_newest(tmp_path):
+    path = tmp_path / 'snapshot.db'
+    cache = PayloadCache(10)
+    cache.snapshot = Snapshot(path, 60)
+    for topic in 'abcdef':
+        cache.unchanged(topic, 'x')
+        cache.snapshot.save()
+    cache.unchanged('a', 'y')
+    cache.snapshot.close()
+
+    smaller = PayloadCache(3)
+    snapshot = Snapshot(path, 60)
+    snapshot.load(smaller, 'homeassistant')
+    snapshot.close()
+    assert list(smaller.hashes) == ['e', 'f', 'a']
+    assert set(rows(path)) == {'e', 'f', 'a'}
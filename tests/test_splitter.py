@@ -0,0 +1,126 @@
+"""Resets handed back a resource at a time: ArraySplitter, and SSEParser's `split`."""
+
+import json
+import random
+
+import pytest
+
+from mbta2mqtt import ArraySplitter, SSEParser
+
+RESOURCES = [{'type': 'stop', 'id': str(i), 'attributes': {'name': f"Stop {i}", 'list': [1, {'a': None}]}}
+             for i in range(30)]
+RESOURCES[3]['attributes']['name'] = 'weird } { " \\ name'
+RESOURCES[7]['attributes']['name'] = 'a { in a string'
+RESOURCES[8]['attributes']['name'] = '}, {'
+RESOURCES[9:12] = ["scalar", 12345, [1, [2, {}]]]
+
+
+def split(data, sizes):
+    splitter = ArraySplitter()
+    items = []
+    (i, n) = (0, 0)
+    while i < len(data):
+        size = sizes[n % len(sizes)]
+        items += splitter.feed(data[i:i+size])
+        (i, n) = (i + size, n + 1)
+    return items + splitter.finish()
+
+
+@pytest.mark.parametrize('separators', [(',', ':'), (', ', ': ')])
+@pytest.mark.parametrize('size', [1, 2, 7, 64, 100000])
+def test_splitter(separators, size):
+    data = json.dumps(RESOURCES, separators=separators).encode()
+    assert split(data, [size]) == RESOURCES
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_splitter_random_chunks(seed):
+    rng = random.Random(seed)
+    data = json.dumps(RESOURCES, indent=rng.choice([None, 2])).encode()
+    assert split(data, [rng.randint(1, 50) for _ in range(50)]) == RESOURCES
+
+
+@pytest.mark.parametrize('data, items', [
+    (b'[]', []),
+    (b' [ ] ', []),
+    (b'[1, 2.5, "x", null, true]', [1, 2.5, "x", None, True]),
+    (b'[{"a": 1}]', [{'a': 1}]),
+])
+def test_splitter_small(data, items):
+    assert split(data, [1]) == items
+    assert split(data, [100]) == items
+
+
+def test_splitter_number_at_the_end_of_a_chunk():
+    splitter = ArraySplitter()
+    assert splitter.feed(b'[12') == []
+    assert splitter.feed(b'34,') == [1234]
+    assert splitter.finish() == []
+
+
+def test_splitter_missing_close():
+    assert split(b'[{"a": 1}, {"b": 2}', [3]) == [{'a': 1}, {'b': 2}]
+
+
+def test_splitter_garbage():
+    splitter = ArraySplitter()
+    assert splitter.feed(b'[{"a": 1}, {"b": nope}]') == [{'a': 1}]
+    assert splitter.finish() == []
+
+
+def test_splitter_ignores_what_follows():
+    assert split(b'[1] [2]', [1]) == [1]
+
+
+def reset(resources, before=b"", after=b""):
+    return before + b"event: reset\ndata: " + json.dumps(resources).encode() + b"\n\n" + after
+
+
+def events(stream, sizes, parser):
+    out = []
+    (i, n) = (0, 0)
+    while i < len(stream):
+        size = sizes[n % len(sizes)]
+        out += parser.feed(stream[i:i+size])
+        (i, n) = (i + size, n + 1)
+    return out
+
+
+@pytest.mark.parametrize('ending', [b'\n', b'\r\n', b'\r'])
+@pytest.mark.parametrize('seed', range(10))
+def test_parser_splits_resets(ending, seed):
+    rng = random.Random(seed)
+    stream = reset(RESOURCES, b": keep-alive\nid: 5\n", b"event: update\ndata: {\"id\": \"1\"}\n\n")
+    stream = stream.replace(b'\n', ending)
+    got = events(stream, [rng.randint(1, 40) for _ in range(50)], SSEParser(split=('reset',)))
+    assert got == ([('reset:begin', None, '5')] +
+                   [('reset:item', item, '5') for item in RESOURCES] +
+                   [('reset:end', None, '5'), ('update', b'{"id": "1"}', '5')])
+
+
+def test_parser_several_data_lines():
+    stream = b'event: reset\ndata: [{"a":\ndata: 1}, 2,\ndata: 3]\n\n'
+    got = events(stream, [4], SSEParser(split=('reset',)))
+    assert got == [('reset:begin', None, ''), ('reset:item', {'a': 1}, ''), ('reset:item', 2, ''),
+                   ('reset:item', 3, ''), ('reset:end', None, '')]
+
+
+def test_parser_empty_reset():
+    got = SSEParser(split=('reset',)).feed(b"event: reset\ndata: []\n\n")
+    assert got == [('reset:begin', None, ''), ('reset:end', None, '')]
+
+
+def test_parser_truncated_reset():
+    parser = SSEParser(split=('reset',))
+    stream = reset(RESOURCES[:3])
+    got = parser.feed(stream[:stream.index(b'"2"')])
+    assert got == [('reset:begin', None, ''), ('reset:item', RESOURCES[0], ''), ('reset:item', RESOURCES[1], '')]
+    assert parser.close() == [('reset:abandon', None, '')]
+    assert parser.close() == []
+
+
+def test_parser_only_splits_arrays():
+    parser = SSEParser(split=('reset',))
+    assert parser.feed(b'event: reset\ndata: {"a": 1}\n\nevent: update\ndata: [1]\n\n') == \
+        [('reset', b'{"a": 1}', ''), ('update', b'[1]', '')]
+    assert SSEParser().feed(b'event: reset\ndata: [1]\n\n') == [('reset', b'[1]', '')]
@@ -0,0 +1,80 @@
+"""SSEParser: the server-sent event grammar, however the bytes arrive."""
+
+import random
+
+import pytest
+
+from mbta2mqtt import SSEParser
+
+
+def feed(stream, sizes, parser=None):
+    """Feeds `stream` in pieces of the given sizes (cycling), and returns
+       every event."""
+    parser = parser or SSEParser()
+    events = []
+    (i, n) = (0, 0)
+    while i < len(stream):
+        size = sizes[n % len(sizes)]
+        events += parser.feed(stream[i:i+size])
+        (i, n) = (i + size, n + 1)
+    return events
+
+
+STREAM = (b": keep-alive\n"
+          b"event: reset\ndata: [{\"id\":\"1\"}]\n\n"
+          b"event: update\nid: 7\ndata: {\"id\":\"1\",\n"
+          b"data: \"x\":2}\n\n"
+          b"retry: 2500\n"
+          b"data:no space\n\n")
+
+EXPECTED = [('reset', b'[{"id":"1"}]', ''),
+            ('update', b'{"id":"1",\n"x":2}', '7'),
+            ('message', b'no space', '7')]
+
+
+@pytest.mark.parametrize('ending', [b'\n', b'\r\n', b'\r'])
+@pytest.mark.parametrize('size', [1, 2, 3, 5, 1000])
+def test_line_endings_and_chunks(ending, size):
+    parser = SSEParser()
+    assert feed(STREAM.replace(b'\n', ending), [size], parser) == EXPECTED
+    assert parser.retry == 2500
+    assert parser.comments == 1
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_random_chunks(seed):
+    rng = random.Random(seed)
+    ending = rng.choice([b'\n', b'\r\n', b'\r'])
+    sizes = [rng.randint(1, 20) for _ in range(50)]
+    assert feed(STREAM.replace(b'\n', ending), sizes) == EXPECTED
+
+
+def test_crlf_split_across_chunks():
+    parser = SSEParser()
+    assert parser.feed(b"data: a\r") == []
+    # (That LF is the rest of the CRLF, not a blank line.)
+    assert parser.feed(b"\ndata: b\r") == []
+    assert parser.feed(b"\n\r") == [('message', b'a\nb', '')]
+    assert parser.feed(b"\n") == []
+
+
+def test_byte_order_mark():
+    assert feed(b"\xef\xbb\xbfdata: x\n\n", [1]) == [('message', b'x', '')]
+
+
+def test_blank_lines_and_fields_ignored():
+    stream = b"\n\nfoo: bar\nid: a\0b\nretry: soon\nevent: x\n\n"
+    parser = SSEParser()
+    assert parser.feed(stream) == []
+    assert parser.last_id == ''
+    assert parser.retry is None
+
+
+def test_data_without_colon():
+    assert SSEParser().feed(b"data\ndata\n\n") == [('message', b'\n', '')]
+
+
+def test_incomplete_event_held_back():
+    parser = SSEParser()
+    assert parser.feed(b"event: update\ndata: {}\n") == []
+    assert parser.feed(b"\n") == [('update', b'{}', '')]
@@ -0,0 +1,101 @@
+"""ResourceStore: every resource, with the links between them kept up to date."""
+
+import pytest
+
+from mbta2mqtt import ResourceStore
+from conftest import prediction, stop
+
+
+def trip(id, route='77'):
+    return {'type': 'trip', 'id': id, 'attributes': {'headsign': 'Harvard'},
+            'relationships': {'route': {'data': {'id': route, 'type': 'route'}}}}
+
+
+@pytest.fixture
+def store():
+    store = ResourceStore()
+    store.heard = []
+    store.listen(store.heard.extend)
+    return store
+
+
+def test_put_and_get(store):
+    store.put(prediction('p1'), 'predictions')
+    record = store.get('prediction', 'p1')
+    assert record.attributes['departure_time']
+    assert record.related['stop'] == (('stop', '110'),)
+    assert 'vehicle' not in record.related
+    assert store.get('prediction', 'p2') is None
+
+
+def test_related_and_referring(store):
+    store.put(stop('110'), 'predictions')
+    store.put(trip('tp1'), 'predictions')
+    store.put(prediction('p1'), 'predictions')
+    store.put(prediction('p2'), 'predictions')
+    p1 = store.get('prediction', 'p1')
+    assert [record.key for record in store.related(p1, 'stop')] == [('stop', '110')]
+    # (The route itself isn't in the store.)
+    assert store.related(p1, 'route') == []
+    assert sorted(record.key[1] for record in store.referring(('stop', '110'))) == ['p1', 'p2']
+    assert [record.key for record in store.referring(('route', '77'), 'trip')] == [('trip', 'tp1')]
+
+
+def test_index_follows_changes(store):
+    store.put(prediction('p1', stop='110'), 'predictions')
+    store.put(prediction('p1', stop='2168'), 'predictions')
+    assert store.referring(('stop', '110')) == []
+    assert [record.key for record in store.referring(('stop', '2168'))] == [('prediction', 'p1')]
+    store.remove({'type': 'prediction', 'id': 'p1'}, 'predictions')
+    assert store.referring(('stop', '2168')) == []
+    assert store.referrers == {}
+
+
+def test_several_streams(store):
+    store.put(stop('110'), 'predictions')
+    store.put(stop('110'), 'stops')
+    store.remove({'type': 'stop', 'id': '110'}, 'predictions')
+    assert store.get('stop', '110')
+    store.remove({'type': 'stop', 'id': '110'}, 'stops')
+    assert store.get('stop', '110') is None
+
+
+def test_forget_drops_it_from_every_stream(store):
+    store.put(stop('110'), 'predictions')
+    store.put(stop('110'), 'stops')
+    store.forget(('stop', '110'))
+    assert store.get('stop', '110') is None
+
+
+def test_listeners_hear_what_changed(store):
+    store.put(prediction('p1'), 'predictions')
+    store.put(prediction('p1', departure='2026-10-17T10:05:00-04:00'), 'predictions')
+    store.remove({'type': 'prediction', 'id': 'p1'}, 'predictions')
+    assert [(key, old is None, new is None) for (key, old, new) in store.heard] == \
+        [(('prediction', 'p1'), True, False), (('prediction', 'p1'), False, False), (('prediction', 'p1'), False, True)]
+
+
+def test_reset_replaces_what_a_stream_had(store):
+    for id in ('p1', 'p2'):
+        store.put(prediction(id), 'predictions')
+    store.put(stop('110'), 'stops')
+    store.heard.clear()
+    store.reset_begin('predictions')
+    store.reset_item(prediction('p1'), 'predictions')
+    store.reset_item(prediction('p3'), 'predictions')
+    # Nobody hears anything until the end.
+    assert store.heard == []
+    store.reset_end('predictions')
+    assert store.get('prediction', 'p2') is None
+    assert store.get('prediction', 'p3')
+    assert store.get('stop', '110')
+    assert sorted((key[1], new is None) for (key, old, new) in store.heard) == [('p1', False), ('p2', True), ('p3', False)]
+
+
+def test_cut_short_reset_drops_nothing(store):
+    store.put(prediction('p2'), 'predictions')
+    store.reset_begin('predictions')
+    store.reset_item(prediction('p1'), 'predictions')
+    store.reset_end('predictions', complete=False)
+    assert store.get('prediction', 'p1')
+    assert store.get('prediction', 'p2')